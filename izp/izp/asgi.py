@@ -0,0 +1,52 @@
+"""
+ASGI config for izp project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Django 1.11 has no ASGI handler, so the WSGI application is wrapped
+by asgiref and every request runs in a thread of the pool of the event loop,
+while the ASGI server keeps accepting connections of other clients.
+
+For more information on ASGI servers, see
+https://asgi.readthedocs.io/en/latest/implementations.html
+"""
+
+import os
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "izp.settings")
+
+
+class ThreadedWsgiToAsgiInstance(WsgiToAsgiInstance):
+    # asgiref runs thread sensitive code in a single thread,
+    # which would serve one request at a time
+    run_wsgi_app = sync_to_async(
+        WsgiToAsgiInstance.__dict__['run_wsgi_app'].func,
+        thread_sensitive=False)
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await ThreadedWsgiToAsgiInstance(self.wsgi_application)(
+            scope, receive, send)
+
+
+def closing(wsgi_application):
+    """
+    Closes responses after sending them, which asgiref does not do,
+    so Django sends request_finished and releases database connections.
+    """
+    def application(environ, start_response):
+        response = wsgi_application(environ, start_response)
+        try:
+            yield from response
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+
+    return application
+
+
+application = ThreadedWsgiToAsgi(closing(get_wsgi_application()))
@@ -16,7 +16,6 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'easy_pdf',
-    'nested_admin',
 ]
 
 MIDDLEWARE = [
@@ -47,17 +46,109 @@ TEMPLATES = [
     },
 ]
 
+# Production template mode: templates are parsed once per process
+# and kept in memory by the cached loader
+
+if not DEBUG or os.environ.get('POLLS_CACHED_TEMPLATES') == '1':
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = [
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]
+
 WSGI_APPLICATION = 'izp.wsgi.application'
 
 # Database
 
+DATABASE_NAME = os.environ.get('POLLS_DATABASE',
+                               os.path.join(BASE_DIR, 'db.sqlite3'))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+        'NAME': DATABASE_NAME,
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': DATABASE_NAME,
+    },
 }
 
+# Optional sharding: aliases of databases keeping votes, access codes,
+# ballots and comments of polls, each poll in one of them, chosen by
+# its id or pinned in POLLS_SHARD_MAP of poll ids to aliases.
+# POLLS_SHARDS environment variable lists names of SQLite shards
+# created next to the default database.
+
+POLLS_SHARDS = [name for name in os.environ.get('POLLS_SHARDS', '').split(',')
+                if name]
+POLLS_SHARD_MAP = {}
+
+for name in POLLS_SHARDS:
+    DATABASES.setdefault(name, {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(os.path.dirname(DATABASE_NAME),
+                             name + '.sqlite3'),
+    })
+
+DATABASE_ROUTERS = ['polls.routers.ShardRouter',
+                    'polls.routers.ReplicaRouter']
+
+# Alias of the database read by listing and results views,
+# None reads everything from the default database
+
+POLLS_READ_REPLICA = None
+POLLS_REPLICA_STICKY_SECONDS = 10
+
+# Cache, shared by all worker processes unless local memory is used.
+# Backend is chosen by POLLS_CACHE environment variable.
+
+CACHE_BACKENDS = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+    },
+    'memcached': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': '127.0.0.1:11211',
+    },
+}
+
+CACHES = {
+    'default': CACHE_BACKENDS[os.environ.get('POLLS_CACHE', 'locmem')],
+}
+
+# Relay mode: URL of polls on the central server, for example
+# 'http://example.com/polls/', and token shared by the central server
+# with its relays, which lets them copy access codes of polls
+
+POLLS_UPSTREAM_URL = os.environ.get('POLLS_UPSTREAM_URL')
+POLLS_RELAY_TOKEN = os.environ.get('POLLS_RELAY_TOKEN')
+POLLS_RELAY_ID = os.environ.get('POLLS_RELAY_ID')
+
+# Sampling profiler of slow polls views, switched on by superusers
+# at /polls/profiles/. Views are not wrapped at all when it is off.
+
+POLLS_PROFILING = os.environ.get('POLLS_PROFILING') == '1'
+POLLS_PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+POLLS_PROFILE_MAX_FILES = 200
+POLLS_PROFILE_INTERVAL = 0.001
+POLLS_PROFILE_SECONDS = 600
+
+# Limit of WSGI application cold start, checked by startup_report command
+# and the test suite
+
+POLLS_COLD_START_SECONDS = 3
+
+# Directory of columnar snapshots of polls written by export_columns command
+
+POLLS_COLUMNS_DIR = os.path.join(BASE_DIR, 'columns')
+
 # Password validation
 
 AUTH_PASSWORD_VALIDATORS = [
@@ -1,11 +1,182 @@
+from django.conf import settings
 from django.contrib import admin
-import nested_admin
+from django.db import router
+from django.forms.models import BaseInlineFormSet
+from django.http import QueryDict
 
-from .models import Choice, Poll, Question, SimpleQuestion, OpenQuestion
+from .codes import normalize_code
+from .models import AccessCode, Choice, Poll, Question, SimpleQuestion, \
+    OpenQuestion, MultipleChoiceQuestion, RankedQuestion, Vote, \
+    normalize_choice_text
+from .pagination import EstimatedCountPaginator
+from .routers import SHARDED_MODELS, shard_for
 
+INLINE_PER_PAGE = 20
 
-class ChoiceInline(admin.TabularInline):
+
+class PaginatedInlineFormSet(BaseInlineFormSet):
+    """
+    Inline formset showing one page of related objects,
+    chosen by '<prefix>-page' query parameter.
+    """
+
+    page_number = 1
+    query = QueryDict()
+
+    def get_queryset(self):
+        if not hasattr(self, '_queryset'):
+            queryset = super(PaginatedInlineFormSet, self).get_queryset()
+            # Related rows of sharded models are in the shard of the poll
+            queryset = queryset.using(router.db_for_read(
+                self.model, instance=self.instance))
+            self.object_count = queryset.count()
+            self.num_pages = max(1, -(-self.object_count
+                                      // INLINE_PER_PAGE))
+            self.page_number = min(max(1, self.page_number), self.num_pages)
+            start = (self.page_number - 1) * INLINE_PER_PAGE
+            self._queryset = queryset[start:start + INLINE_PER_PAGE]
+        return self._queryset
+
+    @property
+    def page_param(self):
+        return self.prefix + '-page'
+
+    def page_links(self):
+        """
+        Returns page numbers with query strings of their pages,
+        keeping other query parameters, like pages of other inlines.
+        """
+        links = []
+        for number in range(1, self.num_pages + 1):
+            query = self.query.copy()
+            query[self.page_param] = number
+            links.append((number, query.urlencode()))
+        return links
+
+
+class PaginatedInline(admin.TabularInline):
+    formset = PaginatedInlineFormSet
+    template = 'admin/polls/paginated_tabular.html'
+    show_change_link = True
+
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super(PaginatedInline, self).get_formset(request, obj,
+                                                           **kwargs)
+        page = request.GET.get(formset.get_default_prefix() + '-page', '')
+        formset.page_number = int(page) if page.isdigit() else 1
+        formset.query = request.GET
+        return formset
+
+
+class PollFilter(admin.SimpleListFilter):
+    title = 'głosowanie'
+    parameter_name = 'poll'
+
+    def __init__(self, request, params, model, model_admin):
+        self.model_admin = model_admin
+        super(PollFilter, self).__init__(request, params, model, model_admin)
+
+    def lookups(self, request, model_admin):
+        return Poll.objects.order_by('-pk').values_list('pk', 'poll_name')
+
+    def queryset(self, request, queryset):
+        if self.value() and self.value().isdigit():
+            return self.model_admin.filter_poll(queryset, int(self.value()))
+        return queryset
+
+
+def filtered_poll(request):
+    """
+    Returns id of the poll chosen in PollFilter of the admin list,
+    also from list filters preserved in links to change views.
+    """
+    value = request.GET.get(PollFilter.parameter_name) or QueryDict(
+        request.GET.get('_changelist_filters', '')).get(
+        PollFilter.parameter_name, '')
+    return int(value) if value.isdigit() else None
+
+
+class ReadOnlyAdmin(admin.ModelAdmin):
+    """
+    Admin listing rows which are created only by voting.
+    With sharding on only rows of the poll chosen in the filter
+    are listed, read from its shard.
+    """
+
+    actions = None
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def filter_poll(self, queryset, poll_id):
+        return queryset.filter(poll_id=poll_id)
+
+    def get_list_filter(self, request):
+        if not getattr(settings, 'POLLS_SHARDS', None):
+            return self.list_filter
+        return tuple(self.list_filter) + (PollFilter, )
+
+    def get_queryset(self, request):
+        queryset = super(ReadOnlyAdmin, self).get_queryset(request)
+        if not getattr(settings, 'POLLS_SHARDS', None):
+            return queryset
+        poll_id = filtered_poll(request)
+        if poll_id is None:
+            return queryset.none()
+        return queryset.using(shard_for(poll_id))
+
+    def get_list_select_related(self, request):
+        if not getattr(settings, 'POLLS_SHARDS', None):
+            return self.list_select_related
+        # Rows of models outside shards can not be joined there
+        return tuple(
+            name for name in self.list_select_related
+            if self.model._meta.get_field(name).related_model._meta.model_name
+            in SHARDED_MODELS)
+
+    def get_readonly_fields(self, request, obj=None):
+        return [field.name for field in self.model._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return request.method in ('GET', 'HEAD') and super(
+            ReadOnlyAdmin, self).has_change_permission(request, obj)
+
+    def change_view(self, request, object_id, form_url='',
+                    extra_context=None):
+        extra_context = dict(extra_context or {}, show_save=False,
+                             show_save_and_continue=False)
+        return super(ReadOnlyAdmin, self).change_view(
+            request, object_id, form_url, extra_context)
+
+    def get_search_results(self, request, queryset, search_term):
+        # Codes are searched in the stored form, as typed on cards
+        return super(ReadOnlyAdmin, self).get_search_results(
+            request, queryset, normalize_code(search_term))
+
+
+class ChoiceInlineFormSet(PaginatedInlineFormSet):
+    def clean(self):
+        super(ChoiceInlineFormSet, self).clean()
+        # Choices of one submission are saved only after validation
+        texts = set()
+        for form in self.forms:
+            data = getattr(form, 'cleaned_data', {})
+            if not data.get('choice_text') or data.get('DELETE'):
+                continue
+            text = normalize_choice_text(data['choice_text'])
+            if text in texts:
+                form.add_error('choice_text', "Taka odpowiedź już istnieje")
+            texts.add(text)
+
+
+class ChoiceInline(PaginatedInline):
     model = Choice
+    formset = ChoiceInlineFormSet
     fields = ('choice_text', )
     extra = 2
     verbose_name = 'Odpowiedzi'
@@ -13,7 +184,11 @@ class ChoiceInline(admin.TabularInline):
 
 class BaseQuestionAdmin(admin.ModelAdmin):
     fields = ('poll', 'question_text')
-    list_display = ('question_text', )
+    list_display = ('question_text', 'poll')
+    list_select_related = ('poll', )
+    raw_id_fields = ('poll', )
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     verbose_name = 'Pytanie'
 
 
@@ -21,42 +196,86 @@ class QuestionAdmin(BaseQuestionAdmin):
     inlines = [ChoiceInline]
 
 
-class NestedChoiceInline(nested_admin.NestedTabularInline):
-    model = Choice
-    fields = ("choice_text", )
-    extra = 2
-    verbose_name = "Odpowiedzi"
+class MultipleChoiceQuestionAdmin(QuestionAdmin):
+    fields = ('poll', 'question_text', 'max_choices')
 
 
-class SimpleQuestionInline(nested_admin.NestedStackedInline):
+class SimpleQuestionInline(PaginatedInline):
     model = SimpleQuestion
     fields = ("question_text", )
     extra = 2
     verbose_name = "Pytania zamknięte"
 
 
-class QuestionInline(nested_admin.NestedStackedInline):
+class QuestionInline(PaginatedInline):
     model = Question
     fields = ("question_text",)
     extra = 1
     verbose_name = "Pytania"
-    inlines = [NestedChoiceInline]
 
 
-class OpenQuestionInline(nested_admin.NestedStackedInline):
+class OpenQuestionInline(PaginatedInline):
     model = OpenQuestion
     fields = ("question_text", )
     extra = 1
     verbose_name = "Pytania otwarte"
-    inlines = [NestedChoiceInline]
 
 
-class PollAdmin(nested_admin.NestedModelAdmin):
-    fields = ('poll_name', 'date')
-    inlines = [SimpleQuestionInline, QuestionInline, OpenQuestionInline]
+class MultipleChoiceQuestionInline(PaginatedInline):
+    model = MultipleChoiceQuestion
+    fields = ("question_text", "max_choices")
+    extra = 0
+    verbose_name = "Pytania wielokrotnego wyboru"
+
+
+class RankedQuestionInline(PaginatedInline):
+    model = RankedQuestion
+    fields = ("question_text", )
+    extra = 0
+    verbose_name = "Pytania rankingowe"
+
+
+class PollAdmin(admin.ModelAdmin):
+    fields = ('poll_name', 'date', 'quorum_percent', 'quorum_minimum')
+    list_display = ('poll_name', 'date')
+    inlines = [SimpleQuestionInline, QuestionInline, OpenQuestionInline,
+               MultipleChoiceQuestionInline, RankedQuestionInline]
+
+
+class ChoiceAdmin(admin.ModelAdmin):
+    fields = ('question', 'choice_text')
+    list_display = ('choice_text', 'question', 'votes')
+    list_select_related = ('question', )
+    raw_id_fields = ('question', )
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+class AccessCodeAdmin(ReadOnlyAdmin):
+    list_display = ('formatted_code', 'poll', 'counter', 'weight')
+    list_select_related = ('poll', )
+    search_fields = ('=code', )
+
+
+class VoteAdmin(ReadOnlyAdmin):
+    list_display = ('id', 'question', 'choice', 'code', 'date')
+    list_select_related = ('question', 'choice', 'code')
+    search_fields = ('=code__code', )
+    ordering = ('-id', )
+
+    def filter_poll(self, queryset, poll_id):
+        # Questions are not in shards, so their ids are read first
+        return queryset.filter(question_id__in=list(
+            Question.objects.filter(poll_id=poll_id).values_list(
+                'pk', flat=True)))
 
 
 admin.site.register(Poll, PollAdmin)
 admin.site.register(Question, QuestionAdmin)
 admin.site.register(SimpleQuestion, BaseQuestionAdmin)
 admin.site.register(OpenQuestion, QuestionAdmin)
+admin.site.register(MultipleChoiceQuestion, MultipleChoiceQuestionAdmin)
+admin.site.register(RankedQuestion, QuestionAdmin)
+admin.site.register(Choice, ChoiceAdmin)
+admin.site.register(AccessCode, AccessCodeAdmin)
+admin.site.register(Vote, VoteAdmin)
@@ -0,0 +1,72 @@
+"""
+Vote history compaction module.
+After a question is closed only the last vote of each code matters
+for results, so earlier votes are moved to the ArchivedVote table.
+The Vote table then grows with the number of voters,
+while vote_history still returns every vote ever cast.
+"""
+
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import ArchivedVote, Question, Vote
+from .routers import poll_atomic
+
+BATCH_SIZE = 500
+VOTE_FIELDS = ('id', 'question_id', 'choice_id', 'code_id', 'date',
+               'chain_hash')
+
+
+def closed_questions(polls=None):
+    """
+    Returns questions which can no longer be voted on,
+    optionally limited to given polls.
+    """
+    questions = Question.objects.filter(deactivation_time__lte=timezone.now())
+    if polls is not None:
+        questions = questions.filter(poll__in=polls)
+    return questions
+
+
+def superseded_votes(question):
+    """
+    Returns votes of the question which are not the last vote of their code.
+    """
+    last_votes = Vote.objects.filter(question=question).values(
+        'code').annotate(last=Max('pk')).values('last')
+    return Vote.objects.filter(question=question).exclude(pk__in=last_votes)
+
+
+def compact_question(question):
+    """
+    Moves superseded votes of the closed question to the archive.
+    Returns number of moved votes.
+    """
+    if question.is_active():
+        raise ValueError("Question is still active")
+
+    fields = VOTE_FIELDS + ('weight',)
+    moved = 0
+    with poll_atomic(question.poll_id):
+        while True:
+            batch = [ArchivedVote(**dict(zip(fields, row)))
+                     for row in superseded_votes(question).order_by(
+                         'pk').values_list(*fields)[:BATCH_SIZE]]
+            if not batch:
+                return moved
+            ArchivedVote.objects.bulk_create(batch)
+            Vote.objects.filter(pk__in=[vote.pk for vote in batch]).delete()
+            moved += len(batch)
+
+
+def vote_history(question, after=0):
+    """
+    Returns every vote cast on the question, both live and archived,
+    as tuples of VOTE_FIELDS in the order they were cast,
+    optionally only votes with id greater than after.
+    """
+    live = Vote.objects.filter(question=question, pk__gt=after).values_list(
+        *VOTE_FIELDS)
+    archived = ArchivedVote.objects.filter(
+        question=question, pk__gt=after).values_list(*VOTE_FIELDS)
+    return live.union(archived, all=True).order_by('id')
@@ -0,0 +1,162 @@
+"""
+Vote audit module.
+History of a single access code is read from the Vote and ArchivedVote
+tables through their (code, date) indexes, page by page,
+merging keyset pages of both tables.
+Anomalies of a poll are found in one pass over its votes
+ordered by code and date, with a sliding time window per code.
+Hash chains of questions are verified from their last checkpoint.
+"""
+
+from collections import deque
+from heapq import merge
+from itertools import chain, groupby, islice
+from operator import itemgetter
+
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+
+from .archive import vote_history
+from .chain import GENESIS, verify_rows
+from .models import AccessCode, ArchivedVote, ChainCheckpoint, Choice, \
+    Question, Vote
+from .pagination import KeysetPage, KeysetPaginator
+from .routers import for_poll, shard_for
+
+AUDIT_PER_PAGE = 50
+# Votes of one code closer in time than that are too fast for a person
+MIN_VOTE_SECONDS = 2
+# That many votes of one code within BURST_SECONDS form a burst
+BURST_VOTES = 10
+BURST_SECONDS = 60
+
+
+def code_history(code, cursor=None, per_page=AUDIT_PER_PAGE):
+    """
+    Returns page of votes of the access code, newest first,
+    including votes archived after compaction.
+    Raises InvalidCursor if the cursor is malformed.
+    """
+    sharded = shard_for(code.poll_id) is not None
+    querysets = [model.objects.filter(code=code)
+                 for model in (Vote, ArchivedVote)]
+    if not sharded:
+        querysets = [queryset.select_related('question', 'choice')
+                     for queryset in querysets]
+    paginators = [KeysetPaginator(queryset, 'date', per_page)
+                  for queryset in querysets]
+    with for_poll(code.poll_id):
+        pages = [paginator.page(cursor) for paginator in paginators]
+
+    rows = sorted(chain.from_iterable(pages),
+                  key=lambda vote: (vote.date, vote.pk), reverse=True)
+    next_cursor = None
+    if len(rows) > per_page or any(page.has_next() for page in pages):
+        rows = rows[:per_page]
+        next_cursor = paginators[0].encode_cursor(rows[-1])
+
+    if sharded:
+        # Votes are kept in a shard, away from their questions and choices
+        questions = Question.objects.in_bulk(
+            {vote.question_id for vote in rows})
+        choices = Choice.objects.in_bulk({vote.choice_id for vote in rows})
+        for vote in rows:
+            vote.question = questions[vote.question_id]
+            vote.choice = choices[vote.choice_id]
+    return KeysetPage(rows, next_cursor, cursor or None)
+
+
+def _votes_by_code(model, question_ids):
+    return model.objects.filter(question_id__in=question_ids).order_by(
+        'code_id', 'date', 'pk').values_list('code_id', 'date').iterator()
+
+
+def anomalies(poll):
+    """
+    Returns codes of the poll which voted implausibly fast
+    or in bursts, with number of their votes, number of votes
+    cast less than MIN_VOTE_SECONDS after the previous one
+    and the largest number of votes within BURST_SECONDS.
+    """
+    question_ids = list(poll.question_set.values_list('pk', flat=True))
+    with for_poll(poll.pk):
+        votes = merge(_votes_by_code(Vote, question_ids),
+                      _votes_by_code(ArchivedVote, question_ids))
+        report = _anomalies(votes)
+        codes = dict(AccessCode.objects.filter(
+            pk__in=[row['code_id'] for row in report]).values_list(
+            'pk', 'formatted_code'))
+    for row in report:
+        row['code'] = codes[row.pop('code_id')]
+    report.sort(key=lambda row: (-row['fast_votes'], -row['max_burst']))
+    return report
+
+
+def _anomalies(votes):
+    report = []
+    for code_id, code_votes in groupby(votes, key=itemgetter(0)):
+        window = deque()
+        count = fast = burst = 0
+        for _, date in code_votes:
+            if window and \
+                    (date - window[-1]).total_seconds() < MIN_VOTE_SECONDS:
+                fast += 1
+            window.append(date)
+            while (date - window[0]).total_seconds() > BURST_SECONDS:
+                window.popleft()
+            burst = max(burst, len(window))
+            count += 1
+        if fast or burst >= BURST_VOTES:
+            report.append({'code_id': code_id, 'votes': count,
+                           'fast_votes': fast, 'max_burst': burst})
+    return report
+
+
+def verify_question(question, full=False, checkpoint=True):
+    """
+    Re-hashes the vote chain of the question, from its last checkpoint
+    or from the first vote if full, and compares it with the hash
+    of the last vote and the number of votes counted by the question.
+    Votes appended during verification are not checked.
+    After successful verification of new votes a checkpoint is saved,
+    unless checkpoint is False.
+    Returns dictionary with number of checked votes, result
+    and id of the first vote not matching its hash.
+    """
+    shard = shard_for(question.poll_id)
+    if shard is None:
+        last_votes = Vote.objects.filter(
+            question=OuterRef('pk')).order_by('-pk').values('chain_hash')
+        length, head = Question.objects.filter(pk=question.pk).annotate(
+            head=Subquery(last_votes[:1])).values_list(
+            'chain_length', 'head').get()
+    else:
+        # Locking the question, like Vote.save does, waits for votes
+        # being appended, so the last vote in the shard matches the length
+        with transaction.atomic():
+            length = Question.objects.select_for_update().filter(
+                pk=question.pk).values_list('chain_length', flat=True).get()
+            head = Vote.objects.using(shard).filter(
+                question_id=question.pk).order_by('-pk').values_list(
+                'chain_hash', flat=True).first()
+    start = None
+    if not full:
+        start = question.chaincheckpoint_set.order_by('-vote_id').first()
+    if start:
+        previous, after, verified = (start.chain_hash, start.vote_id,
+                                     start.chain_length)
+    else:
+        previous, after, verified = GENESIS, 0, 0
+
+    with for_poll(question.poll_id):
+        rows = islice(vote_history(question, after).iterator(),
+                      length - verified)
+        last_hash, count, last_id, broken = verify_rows(rows, previous)
+    valid = broken is None and count == length - verified \
+        and (last_hash == head or not length)
+    if valid and count and checkpoint:
+        ChainCheckpoint.objects.create(question=question, vote_id=last_id,
+                                       chain_hash=last_hash,
+                                       chain_length=length)
+    return {'question': question.pk, 'checked': count, 'valid': valid,
+            'broken_at': broken}
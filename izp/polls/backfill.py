@@ -0,0 +1,126 @@
+"""
+Upgrade backfill module.
+Fills columns added to existing tables for rows created before them,
+after the schema was migrated. Every step only touches rows
+which were not filled yet, so it can be run again at any time.
+"""
+
+from .archive import vote_history
+from .chain import GENESIS, vote_hash
+from .codes import format_code
+from .models import AccessCode, ArchivedVote, Ballot, ChainCheckpoint, \
+    Choice, Poll, Question, Vote, normalize_choice_text
+from .routers import poll_atomic, shards_of
+
+BATCH_SIZE = 500
+
+
+def backfill_choices():
+    """
+    Fills normalized text of choices which do not have it yet.
+    Choices equal to another choice of their question after
+    normalization are left empty, as they would break the unique key,
+    and are returned for review together with number of filled choices.
+    """
+    filled = 0
+    duplicates = []
+    for choice in Choice.objects.filter(
+            normalized_text__isnull=True).order_by('pk').iterator():
+        text = normalize_choice_text(choice.choice_text)
+        if Choice.objects.filter(question_id=choice.question_id,
+                                 normalized_text=text).exists():
+            duplicates.append(choice)
+            continue
+        Choice.objects.filter(pk=choice.pk).update(normalized_text=text)
+        filled += 1
+    return filled, duplicates
+
+
+def _rechain(question):
+    """
+    Hashes every vote of the question again from the first one
+    and returns their number.
+    """
+    previous, length, after = GENESIS, 0, 0
+    while True:
+        rows = list(vote_history(question, after)[:BATCH_SIZE])
+        if not rows:
+            return length
+        for vote_id, question_id, choice_id, code_id, date, stored in rows:
+            previous = vote_hash(previous, question_id, choice_id, code_id,
+                                 date)
+            if previous != stored and not Vote.objects.filter(
+                    pk=vote_id).update(chain_hash=previous):
+                ArchivedVote.objects.filter(pk=vote_id).update(
+                    chain_hash=previous)
+        length += len(rows)
+        after = rows[-1][0]
+
+
+def backfill_chains():
+    """
+    Builds hash chains of questions with votes cast before votes
+    were chained, from their first vote, and sets their chain lengths.
+    Votes chained after the upgrade are hashed again as well,
+    as their chains started from scratch.
+    Old checkpoints of those questions are removed.
+    Returns number of rebuilt questions.
+    """
+    rebuilt = 0
+    for question in Question.objects.order_by('pk').iterator():
+        with poll_atomic(question.poll_id):
+            if not any(model.objects.filter(question=question,
+                                            chain_hash='').exists()
+                       for model in (Vote, ArchivedVote)):
+                continue
+            # Locks the question, like Vote.save, until the chain is built
+            Question.objects.filter(pk=question.pk).update(chain_length=0)
+            length = _rechain(question)
+            Question.objects.filter(pk=question.pk).update(
+                chain_length=length)
+            ChainCheckpoint.objects.filter(question=question).delete()
+        rebuilt += 1
+    return rebuilt
+
+
+def backfill_voters():
+    """
+    Sets numbers of voters of questions, codes with a vote
+    or a ballot of the question, where they were not counted
+    from the first vote. Returns number of corrected questions.
+    """
+    corrected = 0
+    for question in Question.objects.order_by('pk').iterator():
+        with poll_atomic(question.poll_id):
+            # Locks the question, so votes cast meanwhile are counted once
+            Question.objects.select_for_update().filter(
+                pk=question.pk).exists()
+            voters = Vote.objects.filter(question=question).values(
+                'code_id').distinct().count() + Ballot.objects.filter(
+                question=question).count()
+            corrected += Question.objects.filter(pk=question.pk).exclude(
+                voters=voters).update(voters=voters)
+    return corrected
+
+
+def backfill_codes():
+    """
+    Fills printable form of access codes which do not have it yet.
+    Returns number of filled codes.
+    """
+    filled = 0
+    for shard, poll_ids in shards_of(
+            Poll.objects.values_list('pk', flat=True)).items():
+        codes = AccessCode.objects.using(shard).filter(
+            poll_id__in=poll_ids, formatted_code='').order_by('pk')
+        after = 0
+        while True:
+            batch = list(codes.filter(pk__gt=after).values_list(
+                'pk', 'code')[:BATCH_SIZE])
+            if not batch:
+                break
+            for pk, code in batch:
+                filled += AccessCode.objects.using(shard).filter(
+                    pk=pk).update(formatted_code=format_code(code))
+            after = batch[-1][0]
+    return filled
@@ -0,0 +1,288 @@
+"""
+Ballot engine module.
+Ballots of MultipleChoiceQuestion and RankedQuestion are stored
+one row per code, with chosen choice ids packed into a string.
+Tallies group identical ballots in the database and sum their weights,
+so counting works on distinct ballots instead of single rows.
+Ranked ballots are counted with instant-runoff method
+on arrays of choice indexes.
+Ballots with client generated ids are counted only once,
+and batches of them, sent by kiosks and relays, in one transaction.
+"""
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .codes import normalize_code
+from .routers import poll_atomic, shard_for, shards_of
+from .models import AccessCode, Ballot, BallotReceipt, Choice, \
+    MultipleChoiceQuestion, Question, Vote
+
+SEPARATOR = ','
+MAX_BALLOT_ID_LENGTH = 64
+
+
+def encode(choice_ids):
+    return SEPARATOR.join(str(choice_id) for choice_id in choice_ids)
+
+
+def decode(ranking):
+    return tuple(int(choice_id) for choice_id in ranking.split(SEPARATOR)
+                 if choice_id)
+
+
+def cast_ballot(question, code, choice_ids):
+    """
+    Stores ballot of the code, replacing its previous ballot
+    with a new row, so ids of ballots grow in the order they were cast.
+    Returns True if it is the first ballot of the code.
+    """
+    with poll_atomic(question.poll_id):
+        # Updating the code first locks its row until commit,
+        # so concurrent ballots of the code replace one another
+        AccessCode.objects.filter(pk=code.pk).update(
+            counter=F('counter') + 1)
+        replaced, _ = Ballot.objects.filter(question=question,
+                                            code=code).delete()
+        Ballot.objects.create(question=question, code=code,
+                              ranking=encode(choice_ids), weight=code.weight)
+        if not replaced:
+            Question.objects.filter(pk=question.pk).update(
+                voters=F('voters') + 1)
+    return not replaced
+
+
+def cast_vote(question, code, choice):
+    """
+    Stores vote of the code for a single choice,
+    moving weight its previous vote was cast with.
+    """
+    with poll_atomic(question.poll_id):
+        # Updating the code first locks its row until commit,
+        # so concurrent votes of the code find each other as previous
+        AccessCode.objects.filter(pk=code.pk).update(
+            counter=F('counter') + 1)
+        prev_vote = Vote.objects.filter(
+            question=question, code=code).only('choice_id', 'weight').last()
+        if prev_vote:
+            Choice.objects.filter(pk=prev_vote.choice_id).update(
+                votes=F('votes') - prev_vote.weight)
+        else:
+            Question.objects.filter(pk=question.pk).update(
+                voters=F('voters') + 1)
+
+        Choice.objects.filter(pk=choice.pk).update(
+            votes=F('votes') + code.weight)
+        Vote.objects.create(question=question, choice=choice, code=code,
+                            weight=code.weight)
+
+
+def count_once(ballot_id, question, code, cast):
+    """
+    Calls cast unless ballot with given id was already counted.
+    Ballots without id are always counted.
+    Returns True if the ballot was counted now.
+    """
+    with poll_atomic(question.poll_id):
+        if ballot_id:
+            try:
+                with transaction.atomic(using=shard_for(question.poll_id)):
+                    BallotReceipt.objects.create(
+                        ballot_id=ballot_id, question=question, code=code)
+            except IntegrityError:
+                return False
+        cast()
+    return True
+
+
+def check_selection(question, selected, choice_ids, max_choices=None):
+    """
+    Returns error message if selected choice ids are not a valid ballot
+    of the question, otherwise None.
+    """
+    if not selected:
+        return "Nie wybrano odpowiedzi"
+    if not set(selected) <= set(choice_ids):
+        return "Odpowiedź nie istnieje"
+    if len(set(selected)) != len(selected):
+        return "Odpowiedzi nie mogą się powtarzać"
+    if not (question.is_multiple or question.is_ranked) \
+            and len(selected) > 1:
+        return "Można wybrać tylko jedną odpowiedź"
+    if question.is_multiple and max_choices \
+            and len(selected) > max_choices:
+        return "Można wybrać najwyżej {} odpowiedzi".format(max_choices)
+    return None
+
+
+def _parse_entry(entry):
+    ballot_id = entry.get('id')
+    if not isinstance(ballot_id, str) \
+            or not 0 < len(ballot_id) <= MAX_BALLOT_ID_LENGTH:
+        raise ValueError("Niewłaściwy identyfikator głosu")
+    question_id, code, selected = (entry.get('question'), entry.get('code'),
+                                   entry.get('choices'))
+    if not isinstance(question_id, int) or not isinstance(code, str) \
+            or not isinstance(selected, list) \
+            or not all(isinstance(pk, int) for pk in selected):
+        raise ValueError("Niewłaściwy format głosu")
+    date = entry.get('date')
+    if date is not None:
+        date = isinstance(date, str) and parse_datetime(date)
+        if not date or timezone.is_naive(date):
+            raise ValueError("Niewłaściwy czas oddania głosu")
+    return ballot_id, question_id, normalize_code(code), selected, date
+
+
+def submit_batch(entries):
+    """
+    Counts batch of ballots in one transaction.
+    Each entry is a dictionary with client generated ballot id,
+    question id, access code and list of chosen choice ids,
+    in order of preference for RankedQuestion, and optionally time
+    the ballot was cast as ISO 8601 string, so ballots a relay
+    forwards after the question was closed are counted if they were
+    cast while it was active. Times in the future are taken as now.
+    Returns list of results with status of each ballot:
+    accepted, duplicate if it was already counted, or rejected
+    with error message.
+    """
+    results = []
+    parsed = []
+    for entry in entries:
+        try:
+            parsed.append(_parse_entry(entry))
+            results.append({'id': entry['id'], 'status': 'accepted'})
+        except ValueError as error:
+            parsed.append(None)
+            results.append({'id': entry.get('id'), 'status': 'rejected',
+                            'error': str(error)})
+
+    valid = [entry for entry in parsed if entry]
+    question_ids = {question_id for _, question_id, _, _, _ in valid}
+    questions = Question.objects.with_state().in_bulk(question_ids)
+    max_choices = dict(MultipleChoiceQuestion.objects.filter(
+        pk__in=question_ids).values_list('pk', 'max_choices'))
+    choice_ids = {}
+    for question_id, choice_id in Choice.objects.filter(
+            question_id__in=question_ids).values_list('question_id', 'pk'):
+        choice_ids.setdefault(question_id, set()).add(choice_id)
+    codes = {}
+    counted = set()
+    for shard, poll_ids in shards_of(
+            {q.poll_id for q in questions.values()}).items():
+        codes.update(((code.poll_id, code.code), code)
+                     for code in AccessCode.objects.using(shard).filter(
+                         poll_id__in=poll_ids,
+                         code__in={code for _, _, code, _, _ in valid}))
+        counted.update(BallotReceipt.objects.using(shard).filter(
+            pk__in=[entry[0] for entry in valid]).values_list(
+            'pk', flat=True))
+
+    now = timezone.now()
+    with transaction.atomic():
+        for entry, result in zip(parsed, results):
+            if entry is None:
+                continue
+            ballot_id, question_id, code, selected, date = entry
+            question = questions.get(question_id)
+            if question is None \
+                    or not question.was_active_at(min(date or now, now)):
+                error = "Głosowanie nie jest aktywne"
+            elif (question.poll_id, code) not in codes:
+                error = "Niewłaściwy kod uwierzytelniający"
+            else:
+                error = check_selection(question, selected,
+                                        choice_ids.get(question_id, ()),
+                                        max_choices.get(question_id))
+            if error:
+                result.update(status='rejected', error=error)
+                continue
+
+            code = codes[(question.poll_id, code)]
+            if question.is_multiple or question.is_ranked:
+                def cast():
+                    cast_ballot(question, code, selected)
+            else:
+                def cast():
+                    cast_vote(question, code, Choice(pk=selected[0]))
+            if ballot_id in counted \
+                    or not count_once(ballot_id, question, code, cast):
+                result['status'] = 'duplicate'
+            counted.add(ballot_id)
+    return results
+
+
+def ballot_groups(question):
+    """
+    Returns list of (choice ids, summed weight) of distinct ballots.
+    """
+    groups = Ballot.objects.filter(question=question).values(
+        'ranking').annotate(weight=Sum('weight')).order_by()
+    return [(decode(group['ranking']), group['weight']) for group in groups]
+
+
+def approval_tally(groups, choice_ids):
+    """
+    Returns summed weight of ballots approving each choice.
+    """
+    tally = dict.fromkeys(choice_ids, 0)
+    for ranking, weight in groups:
+        for choice_id in ranking:
+            if choice_id in tally:
+                tally[choice_id] += weight
+    return tally
+
+
+def instant_runoff(groups, choice_ids):
+    """
+    Counts ranked ballots with instant-runoff method.
+    In every round each ballot counts for its highest ranked choice
+    still in the race, and the choice with the least weight is eliminated
+    until one choice has majority of counted weight.
+    Ties are broken by eliminating the choice given later in choice_ids.
+    Only ballots of the eliminated choice are moved in each round.
+    Returns list of rounds, each being a dictionary of choice weights,
+    and the winning choice id or None if there were no ballots.
+    """
+    choice_ids = list(choice_ids)
+    index = {choice_id: i for i, choice_id in enumerate(choice_ids)}
+    ballots = [[index[choice_id] for choice_id in ranking
+                if choice_id in index] for ranking, _ in groups]
+    weights = [weight for _, weight in groups]
+    positions = [0] * len(ballots)
+    eliminated = [False] * len(choice_ids)
+    tally = [0] * len(choice_ids)
+    piles = [[] for _ in choice_ids]
+    for i, ballot in enumerate(ballots):
+        if ballot:
+            piles[ballot[0]].append(i)
+            tally[ballot[0]] += weights[i]
+
+    rounds = []
+    while True:
+        remaining = [c for c in range(len(choice_ids)) if not eliminated[c]]
+        rounds.append({choice_ids[c]: tally[c] for c in remaining})
+        total = sum(tally)
+        if total == 0:
+            return rounds, None
+
+        leader = max(remaining, key=lambda c: tally[c])
+        if tally[leader] * 2 > total or len(remaining) == 1:
+            return rounds, choice_ids[leader]
+
+        loser = min(reversed(remaining), key=lambda c: tally[c])
+        eliminated[loser] = True
+        for i in piles[loser]:
+            ballot = ballots[i]
+            position = positions[i] + 1
+            while position < len(ballot) and eliminated[ballot[position]]:
+                position += 1
+            positions[i] = position
+            if position < len(ballot):
+                piles[ballot[position]].append(i)
+                tally[ballot[position]] += weights[i]
+        piles[loser] = []
+        tally[loser] = 0
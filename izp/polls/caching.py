@@ -0,0 +1,127 @@
+"""
+Shared cache module.
+Keys of cached polls data include version tokens of the objects
+they depend on, and saving an object replaces its token,
+so outdated entries are never read again.
+get_or_compute protects expensive values from cache stampedes:
+only one client recomputes a missing value while others wait for it,
+and values are recomputed early, before they expire,
+with probability growing as expiry approaches.
+Hits and misses are counted in the cache, so they are shared
+by all processes using the same cache backend.
+"""
+
+import math
+import random
+import time
+from uuid import uuid4
+
+from django.core.cache import cache
+
+LOCK_SECONDS = 30
+WAIT_SECONDS = 5
+WAIT_INTERVAL = 0.05
+EARLY_RECOMPUTE_BETA = 1.0
+STATS = ('hits', 'misses', 'early_recomputes', 'waits')
+
+
+def _version_key(name, pk):
+    return 'polls:version:{}:{}'.format(name, pk)
+
+
+def version(name, pk):
+    """
+    Returns current version token of the object.
+    """
+    token = cache.get(_version_key(name, pk))
+    if token is None:
+        token = uuid4().hex
+        if not cache.add(_version_key(name, pk), token, None):
+            token = cache.get(_version_key(name, pk), token)
+    return token
+
+
+def bump(name, pk):
+    """
+    Replaces version token of the object, outdating its cached entries.
+    """
+    cache.set(_version_key(name, pk), uuid4().hex, None)
+
+
+def versioned_key(prefix, *objects):
+    """
+    Builds key from prefix and versions of given (name, pk) pairs.
+    """
+    parts = ['polls', prefix]
+    for name, pk in objects:
+        parts.append('{}{}-{}'.format(name, pk, version(name, pk)))
+    return ':'.join(parts)
+
+
+def _count(stat):
+    key = 'polls:stats:' + stat
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+def stats():
+    """
+    Returns hit and miss counters of get_or_compute.
+    """
+    values = cache.get_many(['polls:stats:' + stat for stat in STATS])
+    return {stat: values.get('polls:stats:' + stat, 0) for stat in STATS}
+
+
+def _wait_for(key):
+    deadline = time.time() + WAIT_SECONDS
+    while time.time() < deadline:
+        time.sleep(WAIT_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+    return None
+
+
+def get_or_compute(key, compute, timeout):
+    """
+    Returns cached value of the key, calling compute to fill the cache.
+    """
+    lock = key + ':lock'
+    token = uuid4().hex
+    locked = False
+    entry = cache.get(key)
+    if entry is not None:
+        value, duration, expiry = entry
+        early = duration * EARLY_RECOMPUTE_BETA * math.log(
+            1 - random.random())
+        if time.time() - early < expiry:
+            _count('hits')
+            return value
+        locked = cache.add(lock, token, LOCK_SECONDS)
+        if not locked:
+            _count('hits')
+            return value
+        _count('early_recomputes')
+    else:
+        _count('misses')
+        locked = cache.add(lock, token, LOCK_SECONDS)
+        if not locked:
+            _count('waits')
+            entry = _wait_for(key)
+            if entry is not None:
+                return entry[0]
+
+    try:
+        start = time.time()
+        value = compute()
+        duration = time.time() - start
+        cache.set(key, (value, duration, time.time() + timeout), timeout)
+    finally:
+        # A waiter which gave up computes without the lock and must not
+        # release the lock of the client still computing
+        if locked and cache.get(lock) == token:
+            cache.delete(lock)
+    return value
@@ -0,0 +1,43 @@
+"""
+Vote hash chain module.
+Every vote stores a hash of the previous vote of its question
+and its own question, choice, code and date, so editing, removing
+or reordering any earlier vote of the question changes all later hashes.
+Vote.save appends to the chain, audit.verify_question checks it.
+"""
+
+import hashlib
+from datetime import datetime, timedelta, timezone
+
+GENESIS = '0' * 64
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def vote_hash(previous, question_id, choice_id, code_id, date):
+    """
+    Returns hex digest chaining the vote to the previous hash.
+    The date is hashed as microseconds since epoch,
+    which does not depend on its time zone.
+    """
+    data = '%s|%d|%d|%d|%d' % (previous, question_id, choice_id, code_id,
+                               (date - EPOCH) // MICROSECOND)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def verify_rows(rows, previous=GENESIS):
+    """
+    Re-hashes rows of (id, question id, choice id, code id, date, hash)
+    in the chain order, starting from the previous hash.
+    Returns last hash, number of checked rows, id of the last row
+    and id of the first row not matching its hash or None.
+    """
+    count = 0
+    last_id = None
+    for vote_id, question_id, choice_id, code_id, date, stored in rows:
+        previous = vote_hash(previous, question_id, choice_id, code_id, date)
+        if previous != stored:
+            return previous, count, last_id, vote_id
+        count += 1
+        last_id = vote_id
+    return previous, count, last_id, None
@@ -1,13 +1,18 @@
 """
 Access code generation module.
 Used for creating random unique codes
-from digits and uppercase letters.
-In other modules use the generate_codes function only.
+from digits and uppercase letters,
+normalizing codes typed by users to the stored form
+and formatting codes in dashed groups for printing.
 """
 
+import re
 from string import digits, ascii_uppercase
 from random import choice, seed
 
+GROUP_LENGTH = 4
+_GROUPED_CODE = re.compile(r'(?:[^-]{4}-)*[^-]{1,4}\Z')
+
 
 def _create_code(char_base, length):
     """
@@ -35,3 +40,25 @@ def generate_codes(number_of_codes, code_length):
             generated_codes.append(new_code)
 
     return generated_codes
+
+
+def normalize_code(code):
+    """
+    Returns stored form of the code typed by user:
+    uppercase, without whitespace and group separators.
+    Returns empty string if separators are misplaced.
+    """
+    code = ''.join(code.split()).upper()
+    if '-' not in code:
+        return code
+    if not _GROUPED_CODE.match(code):
+        return ''
+    return code.replace('-', '')
+
+
+def format_code(code):
+    """
+    Returns the code split into dashed groups of four characters.
+    """
+    return '-'.join(code[i:i + GROUP_LENGTH]
+                    for i in range(0, len(code), GROUP_LENGTH))
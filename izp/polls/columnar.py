@@ -0,0 +1,373 @@
+"""
+Columnar snapshot module.
+A poll is exported to one file with its questions, choices,
+access codes, full vote history and ballots of MultipleChoiceQuestion
+and RankedQuestion stored as columns of int64, so analytics can
+memory-map the file and aggregate whole columns without touching
+the database.
+Foreign keys are stored as row indexes of the referenced table
+and times as microseconds since epoch. Votes and ballots are ordered
+by question and id, so votes of a question form one contiguous range
+of rows, and so do its ballots. Chosen choices of ballots, in order
+of preference, form contiguous ranges of the rankings table.
+Columns are memoryviews in the native byte order, which array.array,
+struct and numpy.frombuffer can read without copying.
+
+File layout: MAGIC, length of the JSON header as uint64, the header
+padded to a multiple of 8 bytes, then all columns one after another.
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from heapq import merge
+
+from django.conf import settings
+
+from .ballots import approval_tally, decode, instant_runoff
+from .chain import EPOCH, MICROSECOND
+from .models import AccessCode, ArchivedVote, Ballot, Choice, \
+    MultipleChoiceQuestion, Question, RankedQuestion, Vote
+from .routers import shard_for
+
+MAGIC = b'POLLCOL3'
+PREFIX = struct.Struct('<8sQ')
+# Stored instead of missing times
+MISSING = -2 ** 63
+# Kinds of questions
+VOTES, MULTIPLE, RANKED = range(3)
+
+TABLES = (
+    ('questions', ('id', 'kind', 'activation', 'deactivation',
+                   'votes_start', 'votes_end', 'ballots_start',
+                   'ballots_end')),
+    ('choices', ('id', 'question')),
+    ('codes', ('id', 'weight')),
+    ('votes', ('id', 'question', 'choice', 'code', 'date', 'weight',
+               'archived')),
+    ('ballots', ('id', 'question', 'code', 'date', 'weight',
+                 'rankings_start', 'rankings_end')),
+    ('rankings', ('choice', )),
+)
+
+
+def microseconds(date):
+    if date is None:
+        return MISSING
+    return (date - EPOCH) // MICROSECOND
+
+
+def snapshot_path(poll_id):
+    return os.path.join(settings.POLLS_COLUMNS_DIR,
+                        'poll-{}.cols'.format(poll_id))
+
+
+def write_columns(path, header, columns):
+    """
+    Writes the file with given header and columns, dictionary
+    of table names to dictionaries of column names to arrays of 'q'.
+    The file is replaced atomically.
+    """
+    header = dict(header, byteorder=sys.byteorder, tables={})
+    for table, names in TABLES:
+        rows = len(columns[table][names[0]])
+        if any(len(columns[table][name]) != rows for name in names):
+            raise ValueError('Columns of {} differ in length'.format(table))
+        header['tables'][table] = {'rows': rows, 'columns': names}
+    data = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    data += b' ' * (-len(data) % 8)
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as output:
+        output.write(PREFIX.pack(MAGIC, len(data)))
+        output.write(data)
+        for table, names in TABLES:
+            for name in names:
+                columns[table][name].tofile(output)
+    os.replace(tmp, path)
+
+
+def _vote_rows(question_ids, using):
+    """
+    Yields live and archived votes of the questions ordered
+    by question and id, merging both tables read in that order
+    without loading them into memory.
+    """
+    fields = ('question_id', 'id', 'choice_id', 'code_id', 'date', 'weight')
+
+    def rows(model, archived_flag):
+        for row in model.objects.using(using).filter(
+                question_id__in=question_ids).order_by(
+                'question_id', 'id').values_list(*fields).iterator():
+            yield row + (archived_flag,)
+
+    return merge(rows(Vote, 0), rows(ArchivedVote, 1))
+
+
+def export_poll(poll, path=None, using=None):
+    """
+    Writes columnar snapshot of the poll with its whole vote history,
+    reading from the database alias using, by default the read replica
+    if one is configured, and from the shard of the poll if sharding is on.
+    Returns path of the file.
+    """
+    using = using or getattr(settings, 'POLLS_READ_REPLICA', None) \
+        or 'default'
+    shard = shard_for(poll.pk) or using
+    path = path or snapshot_path(poll.pk)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    columns = {table: {name: array('q') for name in names}
+               for table, names in TABLES}
+
+    questions = list(Question.objects.using(using).filter(
+        poll=poll).order_by('pk').values_list(
+        'pk', 'question_text', 'activation_time', 'deactivation_time'))
+    kinds = {}
+    for kind, model in ((MULTIPLE, MultipleChoiceQuestion),
+                        (RANKED, RankedQuestion)):
+        kinds.update(dict.fromkeys(model.objects.using(using).filter(
+            poll=poll).values_list('pk', flat=True), kind))
+    question_index = {}
+    for index, (pk, _, activation, deactivation) in enumerate(questions):
+        question_index[pk] = index
+        columns['questions']['id'].append(pk)
+        columns['questions']['kind'].append(kinds.get(pk, VOTES))
+        columns['questions']['activation'].append(microseconds(activation))
+        columns['questions']['deactivation'].append(
+            microseconds(deactivation))
+
+    choices = list(Choice.objects.using(using).filter(
+        question__poll=poll).order_by('pk').values_list(
+        'pk', 'question_id', 'choice_text'))
+    choice_index = {}
+    for index, (pk, question_id, _) in enumerate(choices):
+        choice_index[pk] = index
+        columns['choices']['id'].append(pk)
+        columns['choices']['question'].append(question_index[question_id])
+
+    code_index = {}
+    for index, (pk, weight) in enumerate(AccessCode.objects.using(
+            shard).filter(poll=poll).order_by('pk').values_list(
+            'pk', 'weight').iterator()):
+        code_index[pk] = index
+        columns['codes']['id'].append(pk)
+        columns['codes']['weight'].append(weight)
+
+    votes = columns['votes']
+    for question_id, pk, choice_id, code_id, date, weight, archived \
+            in _vote_rows(list(question_index), shard):
+        votes['id'].append(pk)
+        votes['question'].append(question_index[question_id])
+        votes['choice'].append(choice_index[choice_id])
+        votes['code'].append(code_index[code_id])
+        votes['date'].append(microseconds(date))
+        votes['weight'].append(weight)
+        votes['archived'].append(archived)
+
+    ballots, rankings = columns['ballots'], columns['rankings']['choice']
+    ballot_rows = Ballot.objects.using(shard).filter(
+        question_id__in=list(question_index)).order_by(
+        'question_id', 'pk').values_list(
+        'question_id', 'pk', 'code_id', 'date', 'weight', 'ranking')
+    for question_id, pk, code_id, date, weight, ranking \
+            in ballot_rows.iterator():
+        ballots['id'].append(pk)
+        ballots['question'].append(question_index[question_id])
+        ballots['code'].append(code_index[code_id])
+        ballots['date'].append(microseconds(date))
+        ballots['weight'].append(weight)
+        ballots['rankings_start'].append(len(rankings))
+        # Choices deleted after the ballot was cast are skipped
+        rankings.extend(choice_index[choice_id]
+                        for choice_id in decode(ranking)
+                        if choice_id in choice_index)
+        ballots['rankings_end'].append(len(rankings))
+
+    for index in range(len(questions)):
+        for table in ('votes', 'ballots'):
+            rows = columns[table]['question']
+            columns['questions'][table + '_start'].append(
+                bisect_left(rows, index))
+            columns['questions'][table + '_end'].append(
+                bisect_left(rows, index + 1))
+
+    header = {'poll': {'id': poll.pk, 'poll_name': poll.poll_name,
+                       'date': poll.date.isoformat()},
+              'question_text': [question[1] for question in questions],
+              'choice_text': [choice[2] for choice in choices]}
+    write_columns(path, header, columns)
+    return path
+
+
+class PollColumns:
+    """
+    Memory-mapped columnar snapshot of a poll.
+    Columns are available as self.columns[table][name]
+    and should not be used after the snapshot is closed.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot:
+            self._mmap = mmap.mmap(snapshot.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        magic, length = PREFIX.unpack_from(self._mmap)
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError('Not a columnar snapshot: ' + path)
+        self.header = json.loads(
+            self._mmap[PREFIX.size:PREFIX.size + length].decode('utf-8'))
+        if self.header['byteorder'] != sys.byteorder:
+            self._mmap.close()
+            raise ValueError('Snapshot written with different byte order')
+
+        self._views = [memoryview(self._mmap)]
+        offset = PREFIX.size + length
+        self.columns = {}
+        for table, names in TABLES:
+            rows = self.header['tables'][table]['rows']
+            self.columns[table] = {}
+            for name in names:
+                column = self._views[0][offset:offset + 8 * rows].cast('q')
+                self._views.append(column)
+                self.columns[table][name] = column
+                offset += 8 * rows
+        self._questions = {pk: index for index, pk in
+                           enumerate(self.columns['questions']['id'])}
+
+    def close(self):
+        for view in reversed(self._views):
+            view.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def poll(self):
+        return self.header['poll']
+
+    def question_ids(self):
+        return list(self.columns['questions']['id'])
+
+    def question_votes(self, question_id, name, table='votes'):
+        """
+        Returns column of votes, or of other table ordered by question,
+        of the question, without copying.
+        """
+        questions = self.columns['questions']
+        index = self._questions[question_id]
+        start = questions[table + '_start'][index]
+        end = questions[table + '_end'][index]
+        return self.columns[table][name][start:end]
+
+    def ballot_groups(self, question_id):
+        """
+        Returns list of (choice ids, summed weight) of distinct ballots
+        of the question, as polls.ballots.ballot_groups does.
+        """
+        choice_ids = self.columns['choices']['id']
+        rankings = self.columns['rankings']['choice']
+        groups = Counter()
+        for start, end, weight in zip(
+                self.question_votes(question_id, 'rankings_start', 'ballots'),
+                self.question_votes(question_id, 'rankings_end', 'ballots'),
+                self.question_votes(question_id, 'weight', 'ballots')):
+            groups[tuple(choice_ids[choice]
+                         for choice in rankings[start:end])] += weight
+        return list(groups.items())
+
+    def final_choices(self, question_id):
+        """
+        Returns dictionary of code indexes to choice indexes
+        of the last vote of each code in the question.
+        """
+        return {code: choice for code, (choice, _) in
+                self._final_votes(question_id).items()}
+
+    def _final_votes(self, question_id):
+        return dict(zip(self.question_votes(question_id, 'code'),
+                        zip(self.question_votes(question_id, 'choice'),
+                            self.question_votes(question_id, 'weight'))))
+
+    def tally(self, question_id):
+        """
+        Returns dictionary of choice ids to summed weights
+        the last votes of codes in the question were cast with,
+        or to weights of ballots approving each choice
+        of MultipleChoiceQuestion or the last instant-runoff round
+        of RankedQuestion, leaving out choices without any weight.
+        """
+        choice_ids = self.columns['choices']['id']
+        index = self._questions[question_id]
+        kind = self.columns['questions']['kind'][index]
+        if kind != VOTES:
+            choices = [choice_ids[i] for i, question in enumerate(
+                self.columns['choices']['question']) if question == index]
+            groups = self.ballot_groups(question_id)
+            if kind == RANKED:
+                tally = instant_runoff(groups, choices)[0][-1]
+            else:
+                tally = approval_tally(groups, choices)
+            return {choice: total for choice, total in tally.items()
+                    if total}
+        totals = Counter()
+        for choice, weight in self._final_votes(question_id).values():
+            totals[choice] += weight
+        return {choice_ids[index]: total for index, total in totals.items()}
+
+    def turnout(self, question_id):
+        # A code has at most one ballot in a question
+        return len(set(self.question_votes(question_id, 'code'))) \
+            + len(self.question_votes(question_id, 'code', 'ballots'))
+
+    def revotes(self, question_id):
+        """
+        Returns number of votes replaced by a later vote of the same code.
+        Replaced ballots are not kept, so they are not counted.
+        """
+        codes = self.question_votes(question_id, 'code')
+        return len(codes) - len(set(codes))
+
+    def response_times(self, question_id):
+        """
+        Returns sorted array of microseconds between activation
+        of the question and each of its votes and ballots.
+        """
+        activation = self.columns['questions']['activation'][
+            self._questions[question_id]]
+        if activation == MISSING:
+            return array('q')
+        return array('q', sorted(
+            date - activation
+            for table in ('votes', 'ballots')
+            for date in self.question_votes(question_id, 'date', table)))
+
+    def votes_per_day(self):
+        """
+        Returns dictionary of dates in UTC to numbers of votes
+        and ballots cast then.
+        """
+        day = 24 * 60 * 60 * 10 ** 6
+        counts = Counter(date // day for table in ('votes', 'ballots')
+                         for date in self.columns[table]['date'])
+        return {(EPOCH + MICROSECOND * day * days).date(): count
+                for days, count in sorted(counts.items())}
+
+
+def histogram(values, edges):
+    """
+    Returns numbers of sorted values falling between consecutive edges,
+    the last bin including values equal to its upper edge.
+    Found by binary search of each edge instead of binning every value.
+    """
+    positions = [bisect_left(values, edge) for edge in edges[:-1]]
+    positions.append(bisect_right(values, edges[-1]))
+    return [end - start for start, end in zip(positions, positions[1:])]
@@ -0,0 +1,72 @@
+"""
+Comment threads cache module.
+Pages of question comments are cached under a per-question version,
+which is replaced whenever a comment is added or removed,
+so stale pages are never read again and expire on their own.
+The id of the newest comment is cached too, under the same version,
+letting clients poll for new comments without touching the database.
+It is read from the database only after the version was replaced,
+so the id stored by a post racing with a newer one is left
+under an outdated version and never read.
+"""
+
+from django.apps import apps
+from django.core.cache import cache
+from django.db.models import Max
+
+from .caching import bump, versioned_key
+from .pagination import KeysetPaginator
+
+COMMENTS_PER_PAGE = 20
+
+
+def _last_id_key(question_id):
+    return versioned_key('comments:last_id', ('comments', question_id))
+
+
+def invalidate_thread(question_id, using=None):
+    """
+    Drops cached pages of the question comments
+    and remembers id of its newest comment.
+    """
+    bump('comments', question_id)
+    key = _last_id_key(question_id)
+    last_id = apps.get_model('polls', 'Comment').objects.using(using).filter(
+        question_id=question_id).aggregate(last=Max('pk'))['last']
+    cache.set(key, last_id or 0)
+
+
+def comments_page(question, cursor=None):
+    """
+    Returns page of the question comments, newest first.
+    """
+    key = versioned_key('comments:' + (cursor or ''),
+                        ('comments', question.pk))
+    page = cache.get(key)
+    if page is None:
+        paginator = KeysetPaginator(question.comments.all(), 'date',
+                                    COMMENTS_PER_PAGE)
+        page = paginator.page(cursor)
+        cache.set(key, page)
+    return page
+
+
+def has_comments_since(question_id, since_id):
+    """
+    Returns False only if it is known without a query
+    that the question has no comments newer than since_id.
+    """
+    last_id = cache.get(_last_id_key(question_id))
+    return last_id is None or last_id > since_id
+
+
+def comments_since(question, since_id):
+    """
+    Returns comments added after the one with since_id, oldest first.
+    """
+    key = _last_id_key(question.pk)
+    comments = list(question.comments.filter(
+        pk__gt=since_id).order_by('pk')[:COMMENTS_PER_PAGE])
+    if 0 < len(comments) < COMMENTS_PER_PAGE:
+        cache.add(key, comments[-1].pk)
+    return comments
@@ -0,0 +1,249 @@
+"""
+Dataset factory module.
+Builds polls of any size for performance tests with bulk inserts:
+codes, texts and votes are drawn from random generators seeded
+with a fixed seed, so the same parameters always give the same data.
+Votes are drawn twice from the same seed: the first pass only counts
+them, so questions, choices and codes are inserted with final counters,
+and the second pass inserts the votes with their hash chains.
+A database built once by the build_dataset command can be copied
+into the test database by load_dataset, which is much faster
+than building it again.
+"""
+
+import random
+import sqlite3
+from datetime import datetime, timedelta
+from itertools import islice
+from string import ascii_uppercase, digits
+
+from django.apps import apps
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+from django.utils import timezone
+
+from .caching import bump
+from .chain import GENESIS, vote_hash
+from .codes import format_code
+from .models import AccessCode, Choice, Poll, Question, Vote, \
+    normalize_choice_text
+from .routers import shard_for
+
+BATCH_SIZE = 5000
+CODE_LENGTH = 8
+START = datetime(2020, 1, 1, 8, tzinfo=timezone.utc)
+# Mean time between votes of a question in microseconds
+MEAN_VOTE_GAP = 10 ** 6
+QUESTION_GAP = timedelta(minutes=1)
+
+
+def _codes(seed, number):
+    rng = random.Random('{}:codes'.format(seed))
+    alphabet = digits + ascii_uppercase
+    codes = {}
+    while len(codes) < number:
+        code = ''.join(rng.choice(alphabet) for _ in range(CODE_LENGTH))
+        codes.setdefault(code, None)
+    return list(codes)
+
+
+def _votes(seed, questions, codes, choices, votes):
+    """
+    Yields question, code and choice indexes and microseconds
+    since activation of the question of every vote, question by question.
+    """
+    rng = random.Random('{}:votes'.format(seed))
+    for question in range(questions):
+        offset = 0
+        for _ in range(votes // questions + (question < votes % questions)):
+            offset += rng.randint(1, 2 * MEAN_VOTE_GAP - 1)
+            yield (question, rng.randrange(codes), rng.randrange(choices),
+                   offset)
+
+
+def _count_votes(votes, questions, codes, choices):
+    """
+    Returns numbers of votes and voters and duration of each question,
+    votes of each choice, counting the last vote of every code,
+    and number of votes of each code.
+    """
+    counters = {'votes': [0] * questions, 'voters': [0] * questions,
+                'duration': [0] * questions,
+                'choices': [[0] * choices for _ in range(questions)],
+                'codes': [0] * codes}
+    last_choices = {}
+
+    def close(question):
+        counters['voters'][question] = len(last_choices)
+        for choice in last_choices.values():
+            counters['choices'][question][choice] += 1
+        last_choices.clear()
+
+    current = None
+    for question, code, choice, offset in votes:
+        if question != current:
+            if current is not None:
+                close(current)
+            current = question
+        counters['votes'][question] += 1
+        counters['duration'][question] = offset
+        counters['codes'][code] += 1
+        last_choices[code] = choice
+    if current is not None:
+        close(current)
+    return counters
+
+
+def _batches(objects):
+    objects = iter(objects)
+    batch = list(islice(objects, BATCH_SIZE))
+    while batch:
+        yield batch
+        batch = list(islice(objects, BATCH_SIZE))
+
+
+def build_poll(codes=82, questions=1, choices=2, votes=0, seed=0,
+               using=None):
+    """
+    Creates a poll with given number of access codes and closed
+    questions with given number of choices each, and given number
+    of votes spread evenly over questions, cast by random codes
+    for random choices. Counters of questions, choices and codes
+    and hash chains of votes are the same as if votes were cast one by one.
+    Access codes and votes are kept in the shard of the poll,
+    if sharding is on. Returns the poll.
+    """
+    if votes and not (codes and questions and choices):
+        raise ValueError("Votes need codes, questions and choices")
+    counters = _count_votes(_votes(seed, questions, codes, choices, votes),
+                            questions, codes, choices)
+
+    with transaction.atomic(using=using):
+        # Poll.save would generate random codes
+        poll = Poll(poll_name='Ankieta {}'.format(seed), date=START.date())
+        models.Model.save(poll, using=using)
+        shard = shard_for(poll.pk) or using
+
+        activations = []
+        deactivation = START - QUESTION_GAP
+        for index in range(questions):
+            activation = deactivation + QUESTION_GAP
+            deactivation = activation + timedelta(
+                microseconds=counters['duration'][index] + 1)
+            activations.append((activation, deactivation))
+        Question.objects.using(using).bulk_create(
+            Question(poll=poll, question_text='Pytanie {}'.format(index + 1),
+                     activation_time=activation,
+                     deactivation_time=deactivation,
+                     voters=counters['voters'][index],
+                     chain_length=counters['votes'][index])
+            for index, (activation, deactivation) in enumerate(activations))
+        question_ids = list(Question.objects.using(using).filter(
+            poll=poll).order_by('pk').values_list('pk', flat=True))
+
+        Choice.objects.using(using).bulk_create(
+            Choice(question_id=question_id,
+                   choice_text='Odpowiedź {}'.format(index + 1),
+                   normalized_text=normalize_choice_text(
+                       'Odpowiedź {}'.format(index + 1)),
+                   votes=counters['choices'][question][index])
+            for question, question_id in enumerate(question_ids)
+            for index in range(choices))
+        choice_ids = list(Choice.objects.using(using).filter(
+            question__poll=poll).order_by('pk').values_list('pk', flat=True))
+
+        with transaction.atomic(using=shard):
+            for batch in _batches(
+                    AccessCode(poll=poll, code=code,
+                               formatted_code=format_code(code),
+                               counter=counters['codes'][index])
+                    for index, code in enumerate(_codes(seed, codes))):
+                AccessCode.objects.using(shard).bulk_create(batch)
+            code_ids = list(AccessCode.objects.using(shard).filter(
+                poll=poll).order_by('pk').values_list('pk', flat=True))
+
+            previous = [GENESIS] * questions
+
+            def new_votes():
+                for question, code, choice, offset in _votes(
+                        seed, questions, codes, choices, votes):
+                    vote = Vote(question_id=question_ids[question],
+                                choice_id=choice_ids[
+                                    question * choices + choice],
+                                code_id=code_ids[code],
+                                date=activations[question][0] + timedelta(
+                                    microseconds=offset))
+                    vote.chain_hash = previous[question] = vote_hash(
+                        previous[question], vote.question_id,
+                        vote.choice_id, vote.code_id, vote.date)
+                    yield vote
+
+            for batch in _batches(new_votes()):
+                Vote.objects.using(shard).bulk_create(batch)
+
+    bump('poll', poll.pk)
+    return poll
+
+
+def _drop_indexes(connection, cursor, table):
+    """
+    Drops secondary indexes of the SQLite table, which are built
+    several times faster after loading than during loading.
+    Returns statements creating them again.
+    """
+    if connection.vendor != 'sqlite':
+        return []
+    cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+                   "AND tbl_name = %s AND sql IS NOT NULL", [table])
+    indexes = cursor.fetchall()
+    for name, _ in indexes:
+        cursor.execute('DROP INDEX {}'.format(connection.ops.quote_name(name)))
+    return [sql for _, sql in indexes]
+
+
+def load_dataset(path, using=DEFAULT_DB_ALIAS):
+    """
+    Copies every polls table of the SQLite database at path,
+    built by the build_dataset command, into the database using,
+    keeping ids of rows, so it should not contain polls yet.
+    Raises ValueError if the dataset has another schema.
+    """
+    connection = connections[using]
+    source = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    tables = []
+    try:
+        for model in apps.get_app_config('polls').get_models():
+            table = model._meta.db_table
+            columns = [field.column
+                       for field in model._meta.local_concrete_fields]
+            stored = [row[1] for row in source.execute(
+                'PRAGMA table_info("{}")'.format(table))]
+            if sorted(stored) != sorted(columns):
+                raise ValueError('Dataset {} has another schema of {}, '
+                                 'build it again'.format(path, table))
+            tables.append((model, table, columns))
+
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            for model, table, columns in tables:
+                rows = source.execute('SELECT {} FROM "{}"'.format(
+                    ', '.join('"{}"'.format(column) for column in columns),
+                    table))
+                insert = 'INSERT INTO {} ({}) VALUES ({})'.format(
+                    connection.ops.quote_name(table),
+                    ', '.join(connection.ops.quote_name(column)
+                              for column in columns),
+                    ', '.join(['%s'] * len(columns)))
+                indexes = _drop_indexes(connection, cursor, table)
+                batch = rows.fetchmany(BATCH_SIZE)
+                while batch:
+                    cursor.executemany(insert, batch)
+                    batch = rows.fetchmany(BATCH_SIZE)
+                for sql in indexes:
+                    cursor.execute(sql)
+            for sql in connection.ops.sequence_reset_sql(
+                    no_style(), [model for model, _, _ in tables]):
+                cursor.execute(sql)
+    finally:
+        source.close()
+    for poll_id in Poll.objects.using(using).values_list('pk', flat=True):
+        bump('poll', poll_id)
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from polls.backfill import backfill_chains, backfill_choices, \
+    backfill_codes, backfill_voters
+
+
+class Command(BaseCommand):
+    help = ('Fills columns added by upgrades for rows created before them. '
+            'Run after migrate, it can be repeated safely.')
+
+    def handle(self, *args, **options):
+        filled, duplicates = backfill_choices()
+        self.stdout.write('Normalized {} choices'.format(filled))
+        for choice in duplicates:
+            self.stdout.write('Choice {} "{}" of question {} duplicates '
+                              'another choice, merge it by hand'.format(
+                                  choice.pk, choice.choice_text,
+                                  choice.question_id))
+        self.stdout.write('Chained votes of {} questions'.format(
+            backfill_chains()))
+        self.stdout.write('Counted voters of {} questions'.format(
+            backfill_voters()))
+        self.stdout.write('Formatted {} access codes'.format(
+            backfill_codes()))
@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.template.loader import render_to_string
+
+from polls.codes import format_code
+from polls.streaming import render_rows
+
+TABLES = {
+    'codes': ('polls/poll_codes_list.html', 'polls/codes_rows.html',
+              'codes_list'),
+    'results': ('polls/question_result.html', 'polls/result_codes_rows.html',
+                'codes'),
+}
+
+
+def table_rows(table, number):
+    codes = [format_code('%08d' % i) for i in range(number)]
+    if table == 'codes':
+        return codes
+    return [{'code': code, 'num_of_votes': i % 3,
+             'last_choice': 'Odpowiedź %d' % (i % 5)}
+            for i, code in enumerate(codes)]
+
+
+class Command(BaseCommand):
+    help = ('Measures render time of the codes list and per-code results '
+            'tables, rendered whole and streamed in chunks. '
+            'Set POLLS_CACHED_TEMPLATES=1 to use the cached loader.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        for table, (template, rows_template, rows_name) in TABLES.items():
+            rows = table_rows(table, options['rows'])
+            full = streamed = first = float('inf')
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                render_to_string(template, {rows_name: rows,
+                                            'codes': rows})
+                full = min(full, time.perf_counter() - start)
+
+                start = time.perf_counter()
+                chunks = render_rows(rows_template, rows_name, rows)
+                next(chunks)
+                first = min(first, time.perf_counter() - start)
+                for _ in chunks:
+                    pass
+                streamed = min(streamed, time.perf_counter() - start)
+
+            self.stdout.write('{}: {} rows, whole {:.3f}s, streamed {:.3f}s, '
+                              'first chunk {:.4f}s'.format(
+                                  table, len(rows), full, streamed, first))
@@ -0,0 +1,91 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ('Measures requests per second of a page served by the WSGI '
+            'and the ASGI entry point under the same concurrency.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--server', choices=['wsgi', 'asgi', 'both'],
+                            default='both')
+        parser.add_argument('--path', default='/polls/')
+        parser.add_argument('--host', default='localhost')
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=50)
+
+    def handle(self, *args, **options):
+        servers = ['wsgi', 'asgi'] if options['server'] == 'both' \
+            else [options['server']]
+        for server in servers:
+            run = getattr(self, 'run_' + server)
+            start = time.perf_counter()
+            statuses = run(options['host'], options['path'],
+                           options['requests'], options['concurrency'])
+            elapsed = time.perf_counter() - start
+
+            failed = len([status for status in statuses if status != 200])
+            self.stdout.write('{}: {} requests, concurrency {}, '
+                              '{:.1f} req/s, {} failed'.format(
+                                  server, len(statuses),
+                                  options['concurrency'],
+                                  len(statuses) / elapsed, failed))
+
+    def run_wsgi(self, host, path, requests, concurrency):
+        handler = WSGIHandler()
+
+        def request(_):
+            statuses = []
+            environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path,
+                       'SERVER_NAME': host, 'SERVER_PORT': '80',
+                       'wsgi.url_scheme': 'http',
+                       'wsgi.input': BytesIO()}
+            response = handler(environ, lambda status, headers:
+                               statuses.append(int(status.split()[0])))
+            b''.join(response)
+            response.close()
+            return statuses[0]
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(request, range(requests)))
+
+    def run_asgi(self, host, path, requests, concurrency):
+        from izp.asgi import application
+
+        scope = {'type': 'http', 'asgi': {'version': '3.0'},
+                 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+                 'path': path, 'query_string': b'',
+                 'headers': [(b'host', host.encode())],
+                 'server': (host, 80)}
+
+        async def request(semaphore):
+            statuses = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'',
+                        'more_body': False}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    statuses.append(message['status'])
+
+            async with semaphore:
+                await application(dict(scope), receive, send)
+            return statuses[0]
+
+        async def main():
+            semaphore = asyncio.Semaphore(concurrency)
+            return await asyncio.gather(
+                *[request(semaphore) for _ in range(requests)])
+
+        loop = asyncio.new_event_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+        try:
+            return loop.run_until_complete(main())
+        finally:
+            loop.close()
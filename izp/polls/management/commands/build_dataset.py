@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from polls.factories import build_poll
+
+
+class Command(BaseCommand):
+    help = ('Creates a poll with given numbers of codes, questions, '
+            'choices and votes for performance tests. The same seed '
+            'always gives the same poll. Built in a separate database, '
+            'it can be loaded into test databases by '
+            'polls.factories.load_dataset.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--codes', type=int, default=82)
+        parser.add_argument('--questions', type=int, default=1)
+        parser.add_argument('--choices', type=int, default=2)
+        parser.add_argument('--votes', type=int, default=0)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        poll = build_poll(options['codes'], options['questions'],
+                          options['choices'], options['votes'],
+                          options['seed'])
+        self.stdout.write('Poll {} built in {:.1f} s'.format(
+            poll.pk, time.perf_counter() - start))
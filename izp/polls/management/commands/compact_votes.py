@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from polls.archive import closed_questions, compact_question
+
+
+class Command(BaseCommand):
+    help = 'Moves superseded votes of closed questions to the archive.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('poll_ids', nargs='*', type=int,
+                            help='Polls to compact, all polls by default.')
+
+    def handle(self, *args, **options):
+        polls = options['poll_ids'] or None
+        total = 0
+        for question in closed_questions(polls).iterator():
+            moved = compact_question(question)
+            total += moved
+            if moved:
+                self.stdout.write('{}: {} votes archived'.format(
+                    question, moved))
+        self.stdout.write('Archived {} votes'.format(total))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.columnar import export_poll, snapshot_path
+from polls.models import Poll
+
+
+class Command(BaseCommand):
+    help = ('Writes columnar snapshots of given polls for analytics, '
+            'by default to POLLS_COLUMNS_DIR.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('poll_ids', nargs='+', type=int)
+        parser.add_argument('--output', default=None,
+                            help='Output file, only for a single poll.')
+
+    def handle(self, *args, **options):
+        if options['output'] and len(options['poll_ids']) > 1:
+            raise CommandError('--output requires a single poll')
+        for poll in Poll.objects.filter(pk__in=options['poll_ids']):
+            path = export_poll(poll, options['output']
+                               or snapshot_path(poll.pk))
+            self.stdout.write('{}: {}'.format(poll, path))
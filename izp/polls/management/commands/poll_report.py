@@ -0,0 +1,20 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from polls.results import polls_results
+
+
+class Command(BaseCommand):
+    help = ('Computes results, turnout and validity of every question '
+            'of given polls in parallel and prints them as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('poll_ids', nargs='+', type=int)
+        parser.add_argument('--processes', type=int, default=None,
+                            help='Number of worker processes, '
+                                 'one per CPU by default.')
+
+    def handle(self, *args, **options):
+        results = polls_results(options['poll_ids'], options['processes'])
+        self.stdout.write(json.dumps(results, indent=2, ensure_ascii=False))
@@ -0,0 +1,53 @@
+import time
+from urllib.error import URLError
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.models import RelayRejection
+from polls.relay import pull, push
+
+
+class Command(BaseCommand):
+    help = ('Copies given polls from the central server set in '
+            'POLLS_UPSTREAM_URL and sends local votes to it. '
+            'Without --pull or --push does both.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('poll_ids', nargs='*', type=int)
+        parser.add_argument('--pull', action='store_true')
+        parser.add_argument('--push', action='store_true')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Repeat every given number of seconds.')
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'POLLS_UPSTREAM_URL', None):
+            raise CommandError('Set POLLS_UPSTREAM_URL of the central server')
+        both = not options['pull'] and not options['push']
+
+        while True:
+            try:
+                if options['pull'] or both:
+                    for poll_id in options['poll_ids']:
+                        pull(poll_id)
+                        self.stdout.write('Pulled poll {}'.format(poll_id))
+                if options['push'] or both:
+                    for question_id, counts in sorted(push().items()):
+                        self.stdout.write('Question {}: {}'.format(
+                            question_id, ', '.join(
+                                '{} {}'.format(count, status)
+                                for status, count in sorted(counts.items()))))
+                    for rejection in RelayRejection.objects.order_by('pk'):
+                        self.stdout.write(
+                            'Rejected: {} of question {}: {}'.format(
+                                rejection.ballot_id, rejection.question_id,
+                                rejection.error))
+            except URLError as error:
+                if options['interval'] is None:
+                    raise CommandError('Upstream unavailable: {}'.format(
+                        error))
+                self.stderr.write('Upstream unavailable: {}'.format(error))
+
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.startup import heavy_imports, measure_startup
+
+
+class Command(BaseCommand):
+    help = ('Measures cold start time of the WSGI application '
+            'and lists its slowest imports. Fails if it takes longer '
+            'than POLLS_COLD_START_SECONDS or imports heavy optional '
+            'dependencies eagerly.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=15)
+
+    def handle(self, *args, **options):
+        report = measure_startup()
+        self.stdout.write('Cold start: {:.3f}s, {} modules'.format(
+            report['seconds'], len(report['modules'])))
+
+        slowest = sorted(report['import_times'], key=lambda t: -t[2])
+        for module, own, cumulative in slowest[:options['top']]:
+            self.stdout.write('{:>10} us {:>10} us  {}'.format(
+                own, cumulative, module))
+
+        heavy = heavy_imports(report['modules'])
+        if heavy:
+            raise CommandError('Eagerly imported: ' + ', '.join(heavy))
+        if report['seconds'] > settings.POLLS_COLD_START_SECONDS:
+            raise CommandError('Cold start exceeds {}s'.format(
+                settings.POLLS_COLD_START_SECONDS))
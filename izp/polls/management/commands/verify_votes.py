@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.audit import verify_question
+from polls.models import Question
+
+
+class Command(BaseCommand):
+    help = ('Verifies hash chains of votes of given questions, '
+            'or of all questions, from their last checkpoints.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('question_ids', nargs='*', type=int)
+        parser.add_argument('--full', action='store_true',
+                            help='Re-hash every vote, ignoring checkpoints.')
+        parser.add_argument('--no-checkpoint', action='store_true',
+                            help='Do not save checkpoints.')
+
+    def handle(self, *args, **options):
+        questions = Question.objects.order_by('pk')
+        if options['question_ids']:
+            questions = questions.filter(pk__in=options['question_ids'])
+
+        start = time.perf_counter()
+        checked = 0
+        broken = []
+        for question in questions.iterator():
+            result = verify_question(question, full=options['full'],
+                                     checkpoint=not options['no_checkpoint'])
+            checked += result['checked']
+            if not result['valid']:
+                broken.append(question.pk)
+                self.stdout.write('Question {}: broken at vote {}'.format(
+                    question.pk, result['broken_at'] or 'chain end'))
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write('Checked {} votes in {:.2f}s'.format(checked,
+                                                               elapsed))
+        if broken:
+            raise CommandError('Hash chain broken in questions: ' +
+                               ', '.join(str(pk) for pk in broken))
@@ -1,32 +1,50 @@
 from datetime import date
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, router, transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils import timezone
-from .codes import generate_codes
+from django.utils.functional import cached_property
+from .codes import format_code, generate_codes, normalize_code
+from .caching import bump
+from .chain import GENESIS, vote_hash
+from .comments import invalidate_thread
+from .routers import shard_for
+from .turnout import DEFAULT_QUORUM_PERCENT
 from django import forms
 
 
 class Poll(models.Model):
     poll_name = models.CharField('Glosowanie', max_length=50)
     date = models.DateField(default=date.today)
+    quorum_percent = models.PositiveSmallIntegerField(
+        'Kworum (% kodów)', default=DEFAULT_QUORUM_PERCENT)
+    quorum_minimum = models.PositiveIntegerField(
+        'Minimalna liczba głosujących', default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=['-date', '-id'],
+                                name='poll_date_id_idx')]
 
     def save(self, force_insert=False, force_update=False, using=None):
         super(Poll, self).save(force_insert=force_insert,
                                force_update=force_update,
                                using=using)
+        bump('poll', self.pk)
 
-        if self.id and self.accesscode_set.all().count() == 0:
-            for code in generate_codes(82, 8):
-                self.accesscode_set.create(code=code)
+        if self.id and not self.accesscode_set.exists():
+            AccessCode.objects.using(
+                shard_for(self.pk) or using or self._state.db).bulk_create(
+                AccessCode(poll=self, code=code,
+                           formatted_code=format_code(code))
+                for code in generate_codes(82, 8))
 
     def __str__(self):
         return self.poll_name
 
     def is_code_correct(self, code):
-        codes = self.accesscode_set.all()
-        for c in codes:
-            if code == c.code:
-                return True
-        return False
+        return self.accesscode_set.filter(code=normalize_code(code)).exists()
 
     def get_codes(self):
         codes = []
@@ -34,20 +52,102 @@ class Poll(models.Model):
             codes.append(code.code)
         return codes
 
+    def get_formatted_codes(self):
+        return list(self.accesscode_set.values_list('formatted_code',
+                                                    flat=True))
+
+
+class QuestionQuerySet(models.QuerySet):
+    def with_state(self):
+        """
+        Fetches questions together with their poll and flags
+        telling if question is an OpenQuestion, MultipleChoiceQuestion
+        or RankedQuestion.
+        """
+
+        return self.select_related('poll').annotate(
+            is_open=Exists(OpenQuestion.objects.filter(pk=OuterRef('pk'))),
+            is_multiple=Exists(MultipleChoiceQuestion.objects.filter(
+                pk=OuterRef('pk'))),
+            is_ranked=Exists(RankedQuestion.objects.filter(
+                pk=OuterRef('pk'))))
+
+    def active(self):
+        """
+        Filters questions which are currently active,
+        in the same way as Question.is_active does.
+        """
+
+        return self.filter(
+            Q(activation_time__isnull=False)
+            & (Q(deactivation_time__isnull=True)
+               | Q(deactivation_time__gt=timezone.now())))
+
 
 class Question(models.Model):
     """
     Base class representing question in the poll.
     """
 
+    AVAILABLE = 'available'
+    ACTIVE = 'active'
+    CLOSED = 'closed'
+
     poll = models.ForeignKey(Poll, on_delete=models.CASCADE)
     question_text = models.CharField('Pytanie', max_length=200)
     activation_time = models.DateTimeField(null=True, blank=True)
     deactivation_time = models.DateTimeField(null=True, blank=True)
+    voters = models.IntegerField('Liczba głosujących', default=0,
+                                 editable=False)
+    chain_length = models.IntegerField(default=0, editable=False)
+
+    objects = QuestionQuerySet.as_manager()
+
+    # Updated only with F() expressions by votes, never by saving the object
+    COUNTER_FIELDS = ('voters', 'chain_length')
+
+    class Meta:
+        indexes = [models.Index(fields=['poll', '-activation_time', '-id'],
+                                name='question_activation_idx')]
 
     def __str__(self):
         return self.question_text
 
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        if not self._state.adding and not force_insert \
+                and update_fields is None:
+            update_fields = [field.name
+                             for field in self._meta.concrete_fields
+                             if not field.primary_key
+                             and field.name not in self.COUNTER_FIELDS]
+        super(Question, self).save(force_insert=force_insert,
+                                   force_update=force_update,
+                                   using=using,
+                                   update_fields=update_fields)
+        self.__dict__.pop('state', None)
+        bump('question', self.pk)
+        bump('questions', self.poll_id)
+
+    def refresh_from_db(self, using=None, fields=None):
+        super(Question, self).refresh_from_db(using=using, fields=fields)
+        self.__dict__.pop('state', None)
+
+    @cached_property
+    def state(self):
+        """
+        State of the Question, computed once for a given instance
+        and recomputed only after the Question is saved.
+        """
+
+        if not self.activation_time and not self.deactivation_time:
+            return self.AVAILABLE
+        if self.activation_time and (
+                not self.deactivation_time
+                or self.deactivation_time > timezone.now()):
+            return self.ACTIVE
+        return self.CLOSED
+
     def is_available(self):
         """
         Method checking if Question is available
@@ -55,7 +155,7 @@ class Question(models.Model):
         which is true if it has never been activated before.
         """
 
-        return not self.activation_time and not self.deactivation_time
+        return self.state == self.AVAILABLE
 
     def is_active(self):
         """
@@ -64,9 +164,19 @@ class Question(models.Model):
         and has not been deactivated yet.
         """
 
-        return ((self.activation_time and not self.deactivation_time)
-                or (self.activation_time
-                    and self.deactivation_time > timezone.now()))
+        return self.state == self.ACTIVE
+
+    def was_active_at(self, date):
+        """
+        Method checking if Question was active at given time,
+        which is true if it had been activated by then
+        and was not deactivated before.
+        """
+
+        return self.activation_time is not None \
+            and self.activation_time <= date \
+            and (not self.deactivation_time
+                 or date <= self.deactivation_time)
 
     def activate(self, minutes=None):
         """
@@ -82,7 +192,7 @@ class Question(models.Model):
                 self.deactivation_time =\
                     (self.activation_time
                      + timezone.timedelta(minutes=minutes))
-            self.save()
+            self.save(update_fields=['activation_time', 'deactivation_time'])
 
     def deactivate(self):
         """
@@ -92,7 +202,7 @@ class Question(models.Model):
 
         if self.is_active():
             self.deactivation_time = timezone.now()
-            self.save()
+            self.save(update_fields=['deactivation_time'])
 
 
 class SimpleQuestion(Question):
@@ -100,10 +210,12 @@ class SimpleQuestion(Question):
     Question with predefined answers Tak and Nie.
     """
 
-    def save(self, force_insert=False, force_update=False, using=None):
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
         super(SimpleQuestion, self).save(force_insert=force_insert,
                                          force_update=force_update,
-                                         using=using)
+                                         using=using,
+                                         update_fields=update_fields)
         if self.choice_set.all().count() == 0:
             self.choice_set.create(choice_text='Tak')
             self.choice_set.create(choice_text='Nie')
@@ -117,6 +229,48 @@ class OpenQuestion(Question):
     ...
 
 
+class MultipleChoiceQuestion(Question):
+    """
+    Question in which voter may approve several choices.
+    """
+
+    max_choices = models.PositiveSmallIntegerField(
+        'Maksymalna liczba odpowiedzi', null=True, blank=True)
+
+
+class RankedQuestion(Question):
+    """
+    Question in which voter ranks choices,
+    counted with instant-runoff method.
+    """
+
+    ...
+
+
+def normalize_choice_text(text):
+    """
+    Folds case and whitespace of the answer,
+    so that answers differing only in them are treated as the same.
+    """
+
+    return ' '.join(text.split()).casefold()
+
+
+class ChoiceQuerySet(models.QuerySet):
+    def get_or_create_normalized(self, question, choice_text):
+        """
+        Returns choice of the question equal to choice_text
+        after normalization, creating it if it does not exist yet.
+        Safe under concurrency thanks to the unique constraint
+        on normalized text.
+        """
+
+        return self.get_or_create(
+            question=question,
+            normalized_text=normalize_choice_text(choice_text),
+            defaults={'choice_text': ' '.join(choice_text.split())})
+
+
 class Choice(models.Model):
     """
     Class representing answer to a question.
@@ -124,8 +278,41 @@ class Choice(models.Model):
 
     question = models.ForeignKey(Question, on_delete=models.CASCADE)
     choice_text = models.CharField('Odpowiedź', max_length=200)
+    # Null in rows added before normalization until backfill_polls fills
+    # it, nulls never collide, so the unique key can be added to them
+    normalized_text = models.CharField(max_length=200, null=True,
+                                       editable=False)
     votes = models.IntegerField('Liczba głosów', default=0)
 
+    objects = ChoiceQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('question', 'normalized_text')
+
+    def save(self, force_insert=False, force_update=False, using=None):
+        self.normalized_text = normalize_choice_text(self.choice_text)
+        super(Choice, self).save(force_insert=force_insert,
+                                 force_update=force_update,
+                                 using=using)
+
+    def validate_unique(self, exclude=None):
+        """
+        Checks also the unique key on normalized text, which forms
+        skip as the field is not editable.
+        """
+
+        super(Choice, self).validate_unique(exclude=exclude)
+        exclude = exclude or ()
+        if 'question' in exclude or 'choice_text' in exclude \
+                or self.question_id is None:
+            return
+        if Choice.objects.filter(
+                question_id=self.question_id,
+                normalized_text=normalize_choice_text(
+                    self.choice_text)).exclude(pk=self.pk).exists():
+            raise ValidationError(
+                {'choice_text': "Taka odpowiedź już istnieje"})
+
     def __str__(self):
         return self.choice_text
 
@@ -135,9 +322,26 @@ class AccessCode(models.Model):
     Class representing code used to gain access to the question.
     """
 
-    poll = models.ForeignKey(Poll, on_delete=models.CASCADE)
+    # Sharded rows may live in another database than their poll
+    poll = models.ForeignKey(Poll, on_delete=models.CASCADE,
+                             db_constraint=False)
     code = models.CharField('Kod', max_length=8)
+    formatted_code = models.CharField('Kod do wydruku', max_length=9,
+                                      editable=False)
     counter = models.IntegerField('Liczba użyć', default=0)
+    weight = models.PositiveIntegerField('Waga', default=1)
+
+    class Meta:
+        unique_together = ('poll', 'code')
+
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        self.code = normalize_code(self.code)
+        self.formatted_code = format_code(self.code)
+        super(AccessCode, self).save(force_insert=force_insert,
+                                     force_update=force_update,
+                                     using=using,
+                                     update_fields=update_fields)
 
     def __str__(self):
         return self.code
@@ -148,22 +352,201 @@ class Vote(models.Model):
     Class representing single vote.
     """
 
-    question = models.ForeignKey(Question, on_delete=models.CASCADE)
-    choice = models.ForeignKey(Choice, on_delete=models.CASCADE)
+    question = models.ForeignKey(Question, on_delete=models.CASCADE,
+                                 db_constraint=False)
+    choice = models.ForeignKey(Choice, on_delete=models.CASCADE,
+                               db_constraint=False)
     code = models.ForeignKey(AccessCode, on_delete=models.CASCADE)
     date = models.DateTimeField(default=timezone.now)
+    # Weight of the code when the vote was cast
+    weight = models.PositiveIntegerField(default=1, editable=False)
+    chain_hash = models.CharField(max_length=64, editable=False)
+
+    class Meta:
+        indexes = [models.Index(fields=['question', 'code'],
+                                name='vote_question_code_idx'),
+                   models.Index(fields=['code', 'date', 'id'],
+                                name='vote_code_date_idx')]
+
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        if not self._state.adding:
+            super(Vote, self).save(force_insert=force_insert,
+                                   force_update=force_update,
+                                   using=using,
+                                   update_fields=update_fields)
+            return
+
+        # Appends the vote to the hash chain of its question.
+        # Updating the question first locks its row until commit,
+        # so concurrent votes of the question are chained one by one.
+        # The last vote of a question is never archived,
+        # so the chain always ends in the Vote table.
+        using = using or router.db_for_write(Vote, instance=self)
+        with transaction.atomic(), transaction.atomic(using=using):
+            Question.objects.filter(pk=self.question_id).update(
+                chain_length=F('chain_length') + 1)
+            previous = Vote.objects.using(using).filter(
+                question_id=self.question_id).order_by('-pk').values_list(
+                'chain_hash', flat=True).first()
+            self.chain_hash = vote_hash(previous or GENESIS,
+                                        self.question_id, self.choice_id,
+                                        self.code_id, self.date)
+            super(Vote, self).save(force_insert=force_insert,
+                                   force_update=force_update,
+                                   using=using,
+                                   update_fields=update_fields)
+
+    def __str__(self):
+        return self.question.question_text + ' ' + \
+            self.choice.choice_text + ' ' + str(self.code)
+
+
+class ArchivedVote(models.Model):
+    """
+    Class representing vote superseded by a later vote of the same code,
+    moved out of the Vote table after the question was closed.
+    Keeps id of the original vote, so the full history of the question
+    can be rebuilt in the original order.
+    """
+
+    id = models.IntegerField(primary_key=True)
+    question = models.ForeignKey(Question, on_delete=models.CASCADE,
+                                 db_constraint=False)
+    choice = models.ForeignKey(Choice, on_delete=models.CASCADE,
+                               db_constraint=False)
+    code = models.ForeignKey(AccessCode, on_delete=models.CASCADE)
+    date = models.DateTimeField()
+    weight = models.PositiveIntegerField(default=1)
+    chain_hash = models.CharField(max_length=64)
+
+    class Meta:
+        indexes = [models.Index(fields=['code', 'date', 'id'],
+                                name='archivedvote_code_date_idx')]
 
     def __str__(self):
         return self.question.question_text + ' ' + \
             self.choice.choice_text + ' ' + str(self.code)
 
 
+class Ballot(models.Model):
+    """
+    Class representing ballot of a code in MultipleChoiceQuestion
+    or RankedQuestion. Chosen choices are stored as comma separated ids,
+    in order of preference for RankedQuestion.
+    """
+
+    question = models.ForeignKey(Question, on_delete=models.CASCADE,
+                                 db_constraint=False)
+    code = models.ForeignKey(AccessCode, on_delete=models.CASCADE)
+    ranking = models.CharField(max_length=200)
+    weight = models.PositiveIntegerField(default=1)
+    date = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ('question', 'code')
+
+    def __str__(self):
+        return str(self.question) + ' ' + self.ranking + ' ' + str(self.code)
+
+
+class BallotReceipt(models.Model):
+    """
+    Class representing id of a ballot generated by the voting client,
+    stored when the ballot is counted, so retried submissions
+    of the same ballot are counted only once.
+    """
+
+    ballot_id = models.CharField(max_length=64, primary_key=True)
+    question = models.ForeignKey(Question, on_delete=models.CASCADE,
+                                 db_constraint=False)
+    code = models.ForeignKey(AccessCode, on_delete=models.CASCADE)
+    date = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.ballot_id
+
+
+class ChainCheckpoint(models.Model):
+    """
+    Class representing verified prefix of the vote hash chain
+    of a question, up to and including the given vote,
+    from which later verifications continue.
+    """
+
+    question = models.ForeignKey(Question, on_delete=models.CASCADE)
+    vote_id = models.IntegerField()
+    chain_hash = models.CharField(max_length=64)
+    chain_length = models.IntegerField()
+    date = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['question', '-vote_id'],
+                                name='checkpoint_question_vote_idx')]
+
+    def __str__(self):
+        return str(self.question) + ' ' + str(self.vote_id)
+
+
+class RelayCursor(models.Model):
+    """
+    Class representing position in local votes of a relay,
+    up to which they were sent to the central server.
+    """
+
+    name = models.CharField(max_length=50, primary_key=True)
+    position = models.CharField(max_length=50)
+
+    def __str__(self):
+        return self.name + ' ' + self.position
+
+
+class RelayRejection(models.Model):
+    """
+    Class representing local ballot of a relay rejected
+    by the central server, kept for the operator of the relay
+    until a newer ballot of the code is accepted.
+    """
+
+    ballot_id = models.CharField(max_length=64, primary_key=True)
+    question_id = models.IntegerField()
+    code = models.CharField(max_length=32)
+    choices = models.CharField(max_length=1000)
+    error = models.CharField(max_length=200)
+    date = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.ballot_id + ' ' + self.error
+
+
+class CommentQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        question_ids = set(self.values_list('question_id', flat=True))
+        rows = super(CommentQuerySet, self).update(**kwargs)
+        for question_id in question_ids:
+            invalidate_thread(question_id, self.db)
+        return rows
+
+
 class Comment(models.Model):
     question = models.ForeignKey(Question, on_delete=models.CASCADE,
-                                 related_name='comments')
+                                 related_name='comments',
+                                 db_constraint=False)
     text = models.TextField(max_length=500)
     date = models.DateTimeField(default=timezone.now)
 
+    objects = CommentQuerySet.as_manager()
+
+    class Meta:
+        indexes = [models.Index(fields=['question', '-date', '-id'],
+                                name='comment_question_date_idx')]
+
+    def save(self, force_insert=False, force_update=False, using=None):
+        super(Comment, self).save(force_insert=force_insert,
+                                  force_update=force_update,
+                                  using=using)
+        invalidate_thread(self.question_id, self._state.db)
+
     def __str__(self):
         return self.text
 
@@ -178,3 +561,35 @@ class CommentForm(forms.ModelForm):
         self.fields['text'].widget.attrs['style'] = \
             'width:650px; height:80px; resize:none;'
         self.fields['text'].widget.attrs['maxlength'] = '500'
+
+
+@receiver(post_delete, sender=Poll)
+def delete_poll_shard_rows(sender, instance, **kwargs):
+    """
+    Deletes access codes of the poll kept in its shard,
+    together with their votes and ballots, which cascade deletion
+    in the default database does not reach.
+    """
+    shard = shard_for(instance.pk)
+    if shard:
+        AccessCode.objects.using(shard).filter(poll_id=instance.pk).delete()
+
+
+# Sent for every comment deleted by a queryset as well
+@receiver(post_delete, sender=Comment)
+def outdate_comment_thread(sender, instance, using, **kwargs):
+    invalidate_thread(instance.question_id, using)
+
+
+@receiver(post_delete, sender=Question)
+def outdate_poll_questions(sender, instance, **kwargs):
+    bump('questions', instance.poll_id)
+
+
+@receiver(post_delete, sender=Question)
+def delete_question_shard_rows(sender, instance, **kwargs):
+    shard = shard_for(instance.poll_id)
+    if shard:
+        for model in (Ballot, BallotReceipt, ArchivedVote, Vote, Comment):
+            model.objects.using(shard).filter(
+                question_id=instance.pk).delete()
@@ -0,0 +1,166 @@
+"""
+Keyset (seek) pagination module.
+Pages are addressed by a cursor holding the ordering key
+of the last row shown, so fetching any page costs one indexed
+range scan of page size, no matter how many rows precede it.
+Rows are ordered descending by (field, id), in the order
+of the (field, id) index, so the database reads the page straight
+from the index instead of sorting the remaining rows.
+Admin changelists of big tables use EstimatedCountPaginator,
+which takes the number of rows of an unfiltered table from
+statistics of the database instead of counting them.
+"""
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+# Tables estimated to have fewer rows are counted exactly
+ESTIMATE_MIN_ROWS = 10000
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class KeysetPage:
+    """
+    Single page of rows with the cursor pointing at the next one.
+    """
+
+    def __init__(self, object_list, next_cursor, cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.cursor = cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def is_first(self):
+        return self.cursor is None
+
+
+class KeysetPaginator:
+    """
+    Paginates queryset descending by given field and primary key.
+    Rows with empty field value go last, where SQLite and MySQL
+    keep them in descending order. Databases sorting NULLs first
+    read them as a separate range of the index after the others.
+    """
+
+    separator = '~'
+
+    def __init__(self, queryset, field_name, per_page):
+        self.queryset = queryset
+        self.field_name = field_name
+        self.field = queryset.model._meta.get_field(field_name)
+        self.per_page = per_page
+
+    def encode_cursor(self, obj):
+        value = getattr(obj, self.field_name)
+        value = '' if value is None else value.isoformat()
+        return value + self.separator + str(obj.pk)
+
+    def decode_cursor(self, cursor):
+        value, sep, pk = cursor.rpartition(self.separator)
+        if not sep:
+            raise InvalidCursor(cursor)
+        try:
+            pk = int(pk)
+            value = self.field.to_python(value) if value else None
+        except (ValueError, ValidationError):
+            raise InvalidCursor(cursor)
+        return value, pk
+
+    def ordered(self):
+        return self.queryset.order_by('-' + self.field_name, '-pk')
+
+    def _segmented(self):
+        """
+        Returns True if rows with empty field value have to be read
+        as a separate segment, because the database sorts NULLs
+        first in descending order.
+        """
+        return self.field.null and connections[
+            self.queryset.db].features.nulls_order_largest
+
+    def page(self, cursor=None):
+        value = pk = None
+        if cursor:
+            value, pk = self.decode_cursor(cursor)
+        segmented = self._segmented()
+        empty = Q(**{self.field_name + '__isnull': True})
+
+        rows = []
+        if not cursor or value is not None:
+            queryset = self.ordered()
+            if segmented:
+                queryset = queryset.exclude(empty)
+            if cursor:
+                after = Q(**{self.field_name + '__lt': value}) \
+                    | Q(**{self.field_name: value, 'pk__lt': pk})
+                if self.field.null and not segmented:
+                    after |= empty
+                queryset = queryset.filter(after)
+            rows = list(queryset[:self.per_page + 1])
+        elif not segmented:
+            rows = list(self.ordered().filter(empty & Q(pk__lt=pk))[
+                :self.per_page + 1])
+        if segmented and len(rows) <= self.per_page:
+            queryset = self.queryset.filter(empty).order_by('-pk')
+            if cursor and value is None:
+                queryset = queryset.filter(pk__lt=pk)
+            rows += list(queryset[:self.per_page + 1 - len(rows)])
+
+        next_cursor = None
+        if len(rows) > self.per_page:
+            rows = rows[:self.per_page]
+            next_cursor = self.encode_cursor(rows[-1])
+        return KeysetPage(rows, next_cursor, cursor or None)
+
+
+def estimated_count(model, using='default'):
+    """
+    Returns approximate number of rows of the model table,
+    or None if the database does not provide one.
+    On SQLite the largest rowid is used, which is never lower
+    than the number of rows.
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                           [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute('SELECT table_rows FROM information_schema.tables '
+                           'WHERE table_schema = DATABASE() '
+                           'AND table_name = %s', [table])
+        elif connection.vendor == 'sqlite':
+            cursor.execute('SELECT MAX(rowid) FROM '
+                           + connection.ops.quote_name(table))
+        else:
+            return None
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator of querysets which counts only filtered querysets
+    and small tables exactly.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_count(queryset.model, queryset.db)
+            if estimate is not None and estimate >= ESTIMATE_MIN_ROWS:
+                return estimate
+        return super(EstimatedCountPaginator, self).count
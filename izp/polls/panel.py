@@ -0,0 +1,86 @@
+"""
+Control panel module.
+The panel of a poll shows the state of every question with live tally
+and turnout of the active one, and is refreshed every second.
+It is built from cached parts only: questions of the poll, its quorum
+and number of codes are cached until the poll or any of its questions
+is saved, and counters kept by votes in Question.voters and Choice.votes
+are read from the database at most once per COUNTERS_SECONDS,
+however many admins watch the panel.
+States are found from cached activation times on every request,
+so questions activated for some minutes close without invalidation.
+"""
+
+from .caching import get_or_compute, versioned_key
+from .models import Choice, Poll, Question
+from .turnout import Turnout
+
+COUNTERS_SECONDS = 1
+POLL_SECONDS = 60
+
+
+def panel_poll(poll_id):
+    """
+    Returns quorum, number of codes and questions of the poll
+    with their activation times, or None if the poll does not exist.
+    """
+    def compute():
+        poll = Poll.objects.filter(pk=poll_id).first()
+        if poll is None:
+            return None
+        questions = poll.question_set.with_state().order_by('pk').values_list(
+            'pk', 'question_text', 'activation_time', 'deactivation_time',
+            'is_multiple', 'is_ranked')
+        return {'quorum_percent': poll.quorum_percent,
+                'quorum_minimum': poll.quorum_minimum,
+                'all_codes': poll.accesscode_set.count(),
+                'questions': [question[:4] + (any(question[4:]),)
+                              for question in questions]}
+
+    key = versioned_key('panel', ('poll', poll_id), ('questions', poll_id))
+    return get_or_compute(key, compute, POLL_SECONDS)
+
+
+def question_counters(question_id, ballots=False):
+    """
+    Returns number of voters of the question and, unless its votes
+    are ballots tallied only in results, votes of each choice.
+    """
+    def compute():
+        counters = {'voters': Question.objects.filter(
+            pk=question_id).values_list('voters', flat=True).first() or 0,
+            'choices': None}
+        if not ballots:
+            counters['choices'] = list(Choice.objects.filter(
+                question_id=question_id).order_by('-votes', 'pk').values(
+                'id', 'choice_text', 'votes'))
+        return counters
+
+    key = versioned_key('counters', ('question', question_id))
+    return get_or_compute(key, compute, COUNTERS_SECONDS)
+
+
+def poll_panel(poll_id):
+    """
+    Returns state of the control panel of the poll as a dictionary
+    of states of its questions and tally and turnout of the active one,
+    or None if the poll does not exist.
+    """
+    poll = panel_poll(poll_id)
+    if poll is None:
+        return None
+
+    questions, active = [], None
+    for pk, text, activation, deactivation, ballots in poll['questions']:
+        state = Question(pk=pk, activation_time=activation,
+                         deactivation_time=deactivation).state
+        questions.append({'id': pk, 'state': state})
+        if state == Question.ACTIVE and active is None:
+            counters = question_counters(pk, ballots)
+            turnout = Turnout(counters['voters'], poll['all_codes'],
+                              poll['quorum_percent'], poll['quorum_minimum'])
+            active = {'id': pk, 'question_text': text,
+                      'deactivation_time': deactivation,
+                      'choices': counters['choices'],
+                      'turnout': turnout.as_dict()}
+    return {'poll': poll_id, 'questions': questions, 'active': active}
@@ -0,0 +1,162 @@
+"""
+View profiling module.
+Views decorated with profiled can be sampled in production.
+The decorator is applied only when POLLS_PROFILING setting is on,
+otherwise views are left untouched and cost nothing.
+A superuser sets the fraction of requests to profile,
+and each profiled request is sampled by a background thread
+reading the stack of the request thread.
+Samples are saved as collapsed stacks, the input format of flamegraph
+tools, in POLLS_PROFILE_DIR, which keeps at most POLLS_PROFILE_MAX_FILES
+newest profiles.
+"""
+
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+
+RATE_KEY = 'polls:profiling:rate'
+PROFILE_NAME = re.compile(r'\d+\.\d+-\w+\.txt\Z')
+
+
+def profile_dir():
+    return settings.POLLS_PROFILE_DIR
+
+
+def get_rate():
+    """
+    Returns fraction of requests of profiled views which are sampled.
+    """
+    return cache.get(RATE_KEY, 0)
+
+
+def set_rate(rate):
+    """
+    Sets fraction of sampled requests for POLLS_PROFILE_SECONDS,
+    after which profiling switches itself off.
+    """
+    if rate:
+        cache.set(RATE_KEY, rate, settings.POLLS_PROFILE_SECONDS)
+    else:
+        cache.delete(RATE_KEY)
+
+
+class StackSampler:
+    """
+    Counts stacks of a thread, sampled every interval seconds.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{} ({}:{})'.format(
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno))
+            frame = frame.f_back
+        if stack:
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        """
+        Returns samples as lines of semicolon separated stack and count.
+        """
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in self.stacks.most_common())
+
+
+def save_profile(view_name, collapsed):
+    """
+    Writes profile to the profile directory, removing the oldest
+    profiles above the limit. Returns name of the profile file.
+    """
+    directory = profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    name = '{:.6f}-{}.txt'.format(time.time(), view_name)
+    with open(os.path.join(directory, name), 'w') as profile:
+        profile.write(collapsed)
+
+    for old in list_profiles()[settings.POLLS_PROFILE_MAX_FILES:]:
+        try:
+            os.remove(os.path.join(directory, old))
+        except FileNotFoundError:
+            pass
+    return name
+
+
+def list_profiles():
+    """
+    Returns names of stored profiles, newest first.
+    """
+    try:
+        names = os.listdir(profile_dir())
+    except FileNotFoundError:
+        return []
+    return sorted((name for name in names if PROFILE_NAME.match(name)),
+                  reverse=True)
+
+
+def read_profile(name):
+    """
+    Returns content of stored profile or None if there is no such profile.
+    """
+    if not PROFILE_NAME.match(name):
+        return None
+    try:
+        with open(os.path.join(profile_dir(), name)) as profile:
+            return profile.read()
+    except FileNotFoundError:
+        return None
+
+
+def profiled(view):
+    """
+    Samples stacks of a fraction of the view requests,
+    if POLLS_PROFILING setting is on.
+    """
+    if not getattr(settings, 'POLLS_PROFILING', False):
+        return view
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        rate = get_rate()
+        if not rate or random.random() >= rate:
+            return view(request, *args, **kwargs)
+
+        sampler = StackSampler(threading.get_ident(),
+                               settings.POLLS_PROFILE_INTERVAL)
+        sampler.start()
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            sampler.stop()
+            save_profile(view.__name__, sampler.collapsed())
+
+    return wrapper
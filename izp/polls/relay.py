@@ -0,0 +1,217 @@
+"""
+Relay module.
+A relay is an instance of this application in a room with one shared
+uplink, configured with POLLS_UPSTREAM_URL of the central server.
+It pulls a snapshot of polls with their questions, choices and access
+codes into its local database, keeping primary keys of the central
+server, so voters on the LAN vote against the local copy.
+Local votes are then pushed upstream in batches to the ballot API,
+only the final vote of every code in each question since the last push,
+with ids derived from local rows, so a failed push can be repeated,
+and with the time they were cast, so votes cast before a question
+was closed centrally are counted even if pushed after it.
+Ballots rejected upstream, e.g. cast after the question was closed
+centrally, would be rejected again, so they are not resent but kept
+in RelayRejection for the operator until a newer ballot of the code
+is accepted.
+"""
+
+import json
+import socket
+from urllib.request import Request, urlopen
+
+from django.conf import settings
+from django.db import models
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .ballots import decode, encode
+from .caching import bump
+from .codes import format_code
+from .routers import poll_atomic
+from .models import AccessCode, Ballot, Choice, MultipleChoiceQuestion, \
+    OpenQuestion, Poll, Question, RankedQuestion, RelayCursor, \
+    RelayRejection, SimpleQuestion, Vote, normalize_choice_text
+
+QUESTION_TYPES = (('simple', SimpleQuestion), ('open', OpenQuestion),
+                  ('multiple', MultipleChoiceQuestion),
+                  ('ranked', RankedQuestion))
+BATCH_SIZE = 200
+TIMEOUT_SECONDS = 10
+
+
+def snapshot(poll):
+    """
+    Returns data of the poll needed by relays, serializable to JSON.
+    """
+    types = {}
+    for name, model in QUESTION_TYPES:
+        for pk in model.objects.filter(poll=poll).values_list('pk',
+                                                              flat=True):
+            types[pk] = name
+    max_choices = dict(MultipleChoiceQuestion.objects.filter(
+        poll=poll).values_list('pk', 'max_choices'))
+
+    return {
+        'poll': {'id': poll.pk, 'poll_name': poll.poll_name,
+                 'date': poll.date.isoformat(),
+                 'quorum_percent': poll.quorum_percent,
+                 'quorum_minimum': poll.quorum_minimum},
+        'questions': [
+            {'id': question.pk, 'type': types.get(question.pk, 'question'),
+             'question_text': question.question_text,
+             'activation_time': question.activation_time
+             and question.activation_time.isoformat(),
+             'deactivation_time': question.deactivation_time
+             and question.deactivation_time.isoformat(),
+             'max_choices': max_choices.get(question.pk)}
+            for question in poll.question_set.order_by('pk')],
+        'choices': list(Choice.objects.filter(
+            question__poll=poll).order_by('pk').values(
+            'id', 'question_id', 'choice_text')),
+        'codes': list(poll.accesscode_set.order_by('pk').values(
+            'id', 'code', 'weight')),
+    }
+
+
+def _upsert(model, pk, **fields):
+    """
+    Updates fields of the row or inserts it with given primary key,
+    without custom save methods, which would add default choices
+    or generate access codes.
+    """
+    if not model.objects.filter(pk=pk).update(**fields):
+        models.Model.save(model(pk=pk, **fields), force_insert=True)
+
+
+def load_snapshot(data):
+    """
+    Creates or updates local copy of the poll from its snapshot.
+    Counters of local votes are kept.
+    """
+    poll = data['poll']
+    models_by_type = dict(QUESTION_TYPES)
+    with poll_atomic(poll['id']):
+        _upsert(Poll, poll['id'], poll_name=poll['poll_name'],
+                date=parse_date(poll['date']),
+                quorum_percent=poll['quorum_percent'],
+                quorum_minimum=poll['quorum_minimum'])
+        for question in data['questions']:
+            fields = {'poll_id': poll['id'],
+                      'question_text': question['question_text'],
+                      'activation_time': question['activation_time']
+                      and parse_datetime(question['activation_time']),
+                      'deactivation_time': question['deactivation_time']
+                      and parse_datetime(question['deactivation_time'])}
+            if question['type'] == 'multiple':
+                fields['max_choices'] = question['max_choices']
+            _upsert(models_by_type.get(question['type'], Question),
+                    question['id'], **fields)
+            bump('question', question['id'])
+        for choice in data['choices']:
+            _upsert(Choice, choice['id'], question_id=choice['question_id'],
+                    choice_text=choice['choice_text'],
+                    normalized_text=normalize_choice_text(
+                        choice['choice_text']))
+        for code in data['codes']:
+            _upsert(AccessCode, code['id'], poll_id=poll['id'],
+                    code=code['code'],
+                    formatted_code=format_code(code['code']),
+                    weight=code['weight'])
+    bump('poll', poll['id'])
+
+
+def relay_id():
+    return (getattr(settings, 'POLLS_RELAY_ID', None)
+            or socket.gethostname())[:32]
+
+
+def _cursor(name):
+    cursor = RelayCursor.objects.filter(pk=name).first()
+    return cursor.position if cursor else ''
+
+
+def pending_ballots():
+    """
+    Returns ballots to push upstream and cursor positions after them.
+    Of several local votes of a code in a question only the last one
+    is sent. Both cursors are ids of rows, which grow in the order
+    the rows were written, as a replaced ballot gets a new row.
+    """
+    relay = relay_id()
+    last_vote = int(_cursor('votes') or 0)
+    last_ballot = int(_cursor('ballot_ids') or 0)
+
+    finals = {}
+    votes = Vote.objects.filter(pk__gt=last_vote).order_by('pk').values_list(
+        'pk', 'question_id', 'code__code', 'choice_id', 'date')
+    for pk, question_id, code, choice_id, date in votes.iterator():
+        finals[(question_id, code)] = {
+            'id': '{}:v:{}'.format(relay, pk), 'question': question_id,
+            'code': code, 'choices': [choice_id], 'date': date.isoformat()}
+        last_vote = pk
+
+    ballots = Ballot.objects.filter(pk__gt=last_ballot).order_by(
+        'pk').values_list('pk', 'question_id', 'code__code', 'ranking',
+                          'date')
+    for pk, question_id, code, ranking, date in ballots.iterator():
+        finals[(question_id, code)] = {
+            'id': '{}:b:{}'.format(relay, pk), 'question': question_id,
+            'code': code, 'choices': list(decode(ranking)),
+            'date': date.isoformat()}
+        last_ballot = pk
+
+    entries = sorted(finals.values(), key=lambda entry: entry['question'])
+    return entries, {'votes': str(last_vote),
+                     'ballot_ids': str(last_ballot)}
+
+
+def _request(path, data=None):
+    url = settings.POLLS_UPSTREAM_URL.rstrip('/') + '/' + path
+    headers = {'Content-Type': 'application/json'}
+    token = getattr(settings, 'POLLS_RELAY_TOKEN', None)
+    if token:
+        headers['Authorization'] = 'Token ' + token
+    body = json.dumps(data).encode('utf-8') if data is not None else None
+    with urlopen(Request(url, body, headers),
+                 timeout=TIMEOUT_SECONDS) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def pull(poll_id):
+    """
+    Copies the poll from the central server to the local database.
+    """
+    load_snapshot(_request('api/polls/{}/snapshot/'.format(poll_id)))
+
+
+def push():
+    """
+    Sends pending local ballots upstream in batches.
+    Rejected ballots are stored for the operator,
+    so cursors move past every sent ballot.
+    Returns per-question dictionary of counts of ballot statuses.
+    """
+    entries, positions = pending_ballots()
+    summary = {}
+    for start in range(0, len(entries), BATCH_SIZE):
+        batch = entries[start:start + BATCH_SIZE]
+        results = _request('api/ballots/', {'ballots': batch})['results']
+        for entry, result in zip(batch, results):
+            counts = summary.setdefault(entry['question'], {})
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+            if result['status'] == 'rejected':
+                RelayRejection.objects.update_or_create(
+                    ballot_id=entry['id'], defaults={
+                        'question_id': entry['question'],
+                        'code': entry['code'],
+                        'choices': encode(entry['choices']),
+                        'error': result.get('error', '')[:200]})
+            else:
+                RelayRejection.objects.filter(
+                    question_id=entry['question'],
+                    code=entry['code']).delete()
+
+    for name, position in positions.items():
+        RelayCursor.objects.update_or_create(
+            name=name, defaults={'position': position})
+    return summary
@@ -0,0 +1,99 @@
+"""
+Question results module.
+Computes results, turnout and validity of questions
+from the last vote of every code with its stored weight, streaming
+vote rows, or from ballots counted as the results view does,
+and can spread many questions across a pool of processes.
+"""
+
+from multiprocessing import Pool
+
+from django.db import connections
+
+from .ballots import approval_tally, ballot_groups, instant_runoff
+from .models import Ballot, Choice, Question, Vote
+from .routers import shard_for
+from .turnout import poll_turnout
+
+
+def _vote_tally(question, choices):
+    """
+    Returns summed weight of the last votes of codes for each choice
+    and number of codes which voted.
+    """
+    last_votes = {}
+    votes = Vote.objects.using(shard_for(question.poll_id)).filter(
+        question_id=question.pk).order_by('pk').values_list(
+        'code_id', 'choice_id', 'weight')
+    for code_id, choice_id, weight in votes.iterator():
+        last_votes[code_id] = (choice_id, weight)
+
+    tally = dict.fromkeys(choices, 0)
+    for choice_id, weight in last_votes.values():
+        tally[choice_id] += weight
+    return tally, len(last_votes)
+
+
+def _ballot_tally(question, choices):
+    """
+    Returns tally of ballots of MultipleChoiceQuestion or the last round
+    of RankedQuestion, counted as in the results view,
+    and number of codes which voted.
+    """
+    groups = ballot_groups(question)
+    if question.is_ranked:
+        rounds, _ = instant_runoff(groups, choices)
+        tally = dict.fromkeys(choices, 0)
+        tally.update(rounds[-1])
+    else:
+        tally = approval_tally(groups, choices)
+    return tally, Ballot.objects.using(shard_for(question.poll_id)).filter(
+        question_id=question.pk).count()
+
+
+def question_results(question_id):
+    """
+    Returns results of a single question as a dictionary.
+    """
+    question = Question.objects.with_state().get(pk=question_id)
+    choices = dict(Choice.objects.filter(
+        question_id=question_id).order_by('pk').values_list(
+        'pk', 'choice_text'))
+    if question.is_multiple or question.is_ranked:
+        tally, used_codes = _ballot_tally(question, choices)
+    else:
+        tally, used_codes = _vote_tally(question, choices)
+
+    turnout = poll_turnout(question.poll, used_codes)
+    return {'poll': question.poll_id,
+            'question': question.pk,
+            'question_text': question.question_text,
+            'choices': [{'choice_text': choices[choice_id], 'votes': count}
+                        for choice_id, count in sorted(
+                            tally.items(), key=lambda item: -item[1])],
+            'used_codes': turnout.used_codes,
+            'all_codes': turnout.all_codes,
+            'turnout': turnout.percentage,
+            'valid': turnout.is_reached()}
+
+
+def polls_results(poll_ids, processes=None):
+    """
+    Returns results of every question of given polls,
+    ordered by poll and question.
+    Questions are partitioned across given number of processes,
+    by default one per CPU.
+    """
+    question_ids = list(Question.objects.filter(
+        poll_id__in=poll_ids).order_by('poll', 'pk').values_list(
+        'pk', flat=True))
+
+    if processes == 1:
+        results = [question_results(pk) for pk in question_ids]
+    else:
+        connections.close_all()
+        with Pool(processes) as pool:
+            results = pool.map(question_results, question_ids,
+                               chunksize=max(1, len(question_ids) // 64))
+
+    return results
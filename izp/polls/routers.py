@@ -0,0 +1,196 @@
+"""
+Read replica routing module.
+Views decorated with read_from_replica read polls data
+from the database alias named in POLLS_READ_REPLICA setting,
+while every other view and all writes use the primary database.
+A client which has just voted is pinned to the primary database
+for POLLS_REPLICA_STICKY_SECONDS, so it always sees its own vote.
+
+With POLLS_SHARDS set, votes, access codes, ballots and comments
+of each poll are kept in the shard database chosen by the poll id,
+while polls, questions and choices stay in the default database.
+Rows are routed by the object they belong to, or inside views
+decorated with route_poll and for_poll blocks by the poll in use.
+"""
+
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from django.apps import apps
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+STICKY_COOKIE = 'polls_primary'
+
+_state = threading.local()
+
+
+def _replica():
+    return getattr(_state, 'replica', None)
+
+
+def read_from_replica(view):
+    """
+    Routes reads of polls models made by the view to the replica.
+    """
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        replica = getattr(settings, 'POLLS_READ_REPLICA', None)
+        if not replica or STICKY_COOKIE in request.COOKIES:
+            return view(request, *args, **kwargs)
+
+        previous = _replica()
+        _state.replica = replica
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            _state.replica = previous
+
+    return wrapper
+
+
+def stick_to_primary(response):
+    """
+    Makes following requests of the client read from the primary database.
+    """
+    response.set_cookie(
+        STICKY_COOKIE, '1',
+        max_age=getattr(settings, 'POLLS_REPLICA_STICKY_SECONDS', 10),
+        httponly=True)
+    return response
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == 'polls':
+            return _replica()
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+
+SHARDED_MODELS = ('accesscode', 'vote', 'archivedvote', 'ballot',
+                  'ballotreceipt', 'comment')
+
+
+def shard_for(poll_id):
+    """
+    Returns alias of the database holding rows of the poll
+    listed in SHARDED_MODELS, or None if sharding is off.
+    Polls can be pinned to a shard in POLLS_SHARD_MAP,
+    the others are spread by their id.
+    """
+    shards = getattr(settings, 'POLLS_SHARDS', None)
+    if not shards:
+        return None
+    poll_id = int(poll_id)
+    return getattr(settings, 'POLLS_SHARD_MAP', {}).get(poll_id) \
+        or shards[poll_id % len(shards)]
+
+
+def shards_of(poll_ids):
+    """
+    Groups poll ids by aliases of their shards,
+    or under None if sharding is off.
+    """
+    shards = {}
+    for poll_id in poll_ids:
+        shards.setdefault(shard_for(poll_id), set()).add(poll_id)
+    return shards
+
+
+def poll_of_question(question_id):
+    return apps.get_model('polls', 'Question').objects.filter(
+        pk=question_id).values_list('poll_id', flat=True).first()
+
+
+@contextmanager
+def for_poll(poll_id):
+    """
+    Routes queries of sharded models without other hints
+    to the shard of the poll.
+    """
+    previous = getattr(_state, 'shard', None)
+    _state.shard = shard_for(poll_id)
+    try:
+        yield
+    finally:
+        _state.shard = previous
+
+
+def route_poll(view):
+    """
+    Runs the view in for_poll block of the poll given by its poll_id
+    or question_id argument.
+    """
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not getattr(settings, 'POLLS_SHARDS', None):
+            return view(request, *args, **kwargs)
+        poll_id = kwargs.get('poll_id')
+        if poll_id is None and 'question_id' in kwargs:
+            poll_id = poll_of_question(kwargs['question_id'])
+        if poll_id is None:
+            return view(request, *args, **kwargs)
+        with for_poll(poll_id):
+            return view(request, *args, **kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def poll_atomic(poll_id):
+    """
+    Routes queries to the shard of the poll, like for_poll, within
+    transactions of the default database and of the shard.
+    Both transactions are committed one after another, not atomically.
+    """
+    shard = shard_for(poll_id)
+    with for_poll(poll_id), transaction.atomic():
+        if shard is None:
+            yield
+        else:
+            with transaction.atomic(using=shard):
+                yield
+
+
+def _poll_id(instance):
+    if instance._meta.model_name == 'poll':
+        return instance.pk
+    if getattr(instance, 'poll_id', None) is not None:
+        return instance.poll_id
+    if getattr(_state, 'shard', None) is None \
+            and getattr(instance, 'question_id', None) is not None:
+        return poll_of_question(instance.question_id)
+    return None
+
+
+class ShardRouter:
+    def _shard(self, model, instance=None, **hints):
+        if model._meta.app_label != 'polls' \
+                or not getattr(settings, 'POLLS_SHARDS', None):
+            return None
+        if model._meta.model_name not in SHARDED_MODELS:
+            # Django would follow relations of rows in a shard there
+            if instance is not None \
+                    and instance._meta.model_name in SHARDED_MODELS:
+                return _replica() or DEFAULT_DB_ALIAS
+            return None
+        if instance is not None:
+            if instance._meta.model_name in SHARDED_MODELS \
+                    and instance._state.db:
+                return instance._state.db
+            poll_id = _poll_id(instance)
+            if poll_id is not None:
+                return shard_for(poll_id)
+        return getattr(_state, 'shard', None)
+
+    db_for_read = _shard
+    db_for_write = _shard
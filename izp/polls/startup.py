@@ -0,0 +1,70 @@
+"""
+Startup time module.
+Measures cold start of the WSGI application in a fresh interpreter,
+which loads settings, installed apps and the URLconf with all views,
+and reports modules imported on the way.
+On Python 3.7 and newer imports are timed with -X importtime.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+
+# Optional dependencies which must be imported only on first use
+HEAVY_MODULES = ('easy_pdf.rendering', 'xhtml2pdf', 'reportlab', 'html5lib')
+
+STARTUP_CODE = '''
+import json, sys, time
+start = time.perf_counter()
+from izp.wsgi import application
+from django.urls import get_resolver
+get_resolver().url_patterns
+print(json.dumps({'seconds': time.perf_counter() - start,
+                  'modules': sorted(sys.modules)}))
+'''
+
+
+def parse_import_times(output):
+    """
+    Returns list of (module, self microseconds, cumulative microseconds)
+    from -X importtime output.
+    """
+    times = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        times.append((parts[2].strip(), int(parts[0]), int(parts[1])))
+    return times
+
+
+def measure_startup():
+    """
+    Starts the application in a new interpreter and returns dictionary
+    with startup time in seconds, imported modules and import times.
+    """
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE='izp.settings')
+    command = [sys.executable]
+    if sys.version_info >= (3, 7):
+        command += ['-X', 'importtime']
+    process = subprocess.run(command + ['-c', STARTUP_CODE], env=env,
+                             cwd=settings.BASE_DIR, check=True,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    report = json.loads(process.stdout)
+    report['import_times'] = parse_import_times(process.stderr)
+    return report
+
+
+def heavy_imports(modules):
+    """
+    Returns modules which belong to one of HEAVY_MODULES.
+    """
+    return [module for module in modules
+            if any(module == heavy or module.startswith(heavy + '.')
+                   for heavy in HEAVY_MODULES)]
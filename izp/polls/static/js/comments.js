@@ -0,0 +1,43 @@
+(function () {
+    var container = document.getElementById('comments');
+    var since = parseInt(container.getAttribute('data-since'), 10) || 0;
+    var url = container.getAttribute('data-url');
+
+    function render(comment) {
+        var div = document.createElement('div');
+        var date = document.createElement('div');
+        var strong = document.createElement('strong');
+        var text = document.createElement('p');
+        div.className = 'comment';
+        date.className = 'date';
+        strong.textContent = comment.date;
+        text.textContent = comment.text;
+        text.style.whiteSpace = 'pre-line';
+        date.appendChild(strong);
+        div.appendChild(document.createElement('br'));
+        div.appendChild(date);
+        div.appendChild(text);
+        return div;
+    }
+
+    function poll() {
+        var request = new XMLHttpRequest();
+        request.open('GET', url + '?since=' + since);
+        request.onload = function () {
+            if (request.status !== 200) {
+                return;
+            }
+            var comments = JSON.parse(request.responseText).comments;
+            comments.forEach(function (comment) {
+                if (since === 0) {
+                    container.innerHTML = '';
+                }
+                container.insertBefore(render(comment), container.firstChild);
+                since = comment.id;
+            });
+        };
+        request.send();
+    }
+
+    setInterval(poll, 5000);
+})();
@@ -0,0 +1,46 @@
+(function () {
+    var table = document.getElementById('panel');
+    var url = table.getAttribute('data-url');
+
+    function row(id) {
+        return table.querySelector('tr[data-question="' + id + '"]');
+    }
+
+    function update(panel) {
+        var changed = panel.questions.some(function (question) {
+            var tr = row(question.id);
+            return tr && tr.getAttribute('data-state') !== question.state;
+        });
+        if (changed) {
+            window.location.reload();
+            return;
+        }
+        var active = panel.active;
+        if (!active || !row(active.id)) {
+            return;
+        }
+        var turnout = active.turnout;
+        row(active.id).querySelector('.turnout').textContent =
+            'Użyto ' + turnout.used_codes + ' z ' + turnout.all_codes +
+            ' kodów, kworum: ' + turnout.required;
+        if (active.choices) {
+            row(active.id).querySelector('.tally').textContent =
+                active.choices.map(function (choice) {
+                    return choice.choice_text + ': ' + choice.votes;
+                }).join(', ');
+        }
+    }
+
+    function poll() {
+        var request = new XMLHttpRequest();
+        request.open('GET', url);
+        request.onload = function () {
+            if (request.status === 200) {
+                update(JSON.parse(request.responseText));
+            }
+        };
+        request.send();
+    }
+
+    setInterval(poll, 1000);
+})();
@@ -0,0 +1,55 @@
+"""
+Streaming rendering module.
+Pages with big tables, such as the codes list or per-code results,
+are sent as a stream instead of one large string.
+The page template is rendered once with ROWS_MARKER in place of
+the table rows, then rows are rendered in chunks with a small
+row template and sent between both parts of the page.
+"""
+
+from itertools import islice
+
+from django.http import StreamingHttpResponse
+from django.template.loader import get_template, render_to_string
+from django.utils.safestring import mark_safe
+
+ROWS_MARKER = '<!-- polls:rows -->'
+ROWS_PER_CHUNK = 500
+
+
+def chunks(rows, size):
+    rows = iter(rows)
+    chunk = list(islice(rows, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(rows, size))
+
+
+def render_rows(rows_template_name, rows_name, rows, context=None,
+                chunk_size=ROWS_PER_CHUNK):
+    """
+    Yields rows rendered with the row template, chunk by chunk.
+    """
+    template = get_template(rows_template_name)
+    context = dict(context or {})
+    for chunk in chunks(rows, chunk_size):
+        context[rows_name] = chunk
+        yield template.render(context)
+
+
+def stream_table(request, template_name, context, rows_template_name,
+                 rows_name, rows):
+    """
+    Returns streaming response of the page with given rows.
+    """
+    page = render_to_string(template_name,
+                            dict(context, rows_marker=mark_safe(ROWS_MARKER)),
+                            request)
+    head, tail = page.split(ROWS_MARKER, 1)
+
+    def content():
+        yield head
+        yield from render_rows(rows_template_name, rows_name, rows)
+        yield tail
+
+    return StreamingHttpResponse(content())
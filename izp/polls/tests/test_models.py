@@ -1,10 +1,21 @@
 """
 Tests for models
 """
-from django.test import TestCase
+from io import StringIO
+from threading import Barrier, Thread
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
-from polls.models import Question, SimpleQuestion, OpenQuestion, Poll
+from polls.archive import compact_question
+from polls.audit import verify_question
+from polls.ballots import cast_vote
+from polls.codes import format_code
+from polls.models import Question, SimpleQuestion, OpenQuestion, Poll, \
+    Choice, AccessCode, ArchivedVote, Vote
 
 
 class ChoiceUniquenessTests(TestCase):
@@ -77,6 +88,196 @@ class ChoiceUniquenessTests(TestCase):
         self.assertIs(question.choice_set.filter(votes__exact=0).count(), 2)
         self.assertIs(question.choice_set.all().count(), 4)
 
+    def test_vote_same_answer_different_case_and_spaces(self):
+        """
+        Answers differing only in case and whitespace are the same answer.
+        """
+        question = OpenQuestion.objects.get(question_text="OpenQuestion")
+        url = reverse('polls:vote', args=(question.id,))
+        codes = question.poll.get_codes()
+
+        for code, answer in zip(codes, ['Nowa  odp', ' nowa ODP ']):
+            s = self.client.session
+            s['poll' + str(question.poll.id)] = code
+            s.save()
+            self.client.post(url, {'new_choice': answer})
+
+        choice = question.choice_set.get(normalized_text='nowa odp')
+        self.assertEqual(choice.choice_text, 'Nowa odp')
+        self.assertEqual(choice.votes, 2)
+        self.assertEqual(question.choice_set.all().count(), 3)
+
+
+class ChoiceFormUniquenessTests(TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pswd')
+        self.client.login(username='admin', password='pswd')
+        self.question = SimpleQuestion.objects.create(
+            poll=Poll.objects.create(), question_text="Tak czy nie?")
+
+    def post_choices(self, *texts):
+        data = {'poll': self.question.poll_id,
+                'question_text': self.question.question_text,
+                'choice_set-TOTAL_FORMS': 2 + len(texts),
+                'choice_set-INITIAL_FORMS': 2,
+                'choice_set-MIN_NUM_FORMS': 0,
+                'choice_set-MAX_NUM_FORMS': 1000}
+        for index, choice in enumerate(self.question.choice_set.all()):
+            data['choice_set-{}-id'.format(index)] = choice.pk
+            data['choice_set-{}-question'.format(index)] = self.question.pk
+            data['choice_set-{}-choice_text'.format(index)] = \
+                choice.choice_text
+        for index, text in enumerate(texts, 2):
+            data['choice_set-{}-question'.format(index)] = self.question.pk
+            data['choice_set-{}-choice_text'.format(index)] = text
+        return self.client.post(reverse('admin:polls_question_change',
+                                        args=(self.question.pk,)), data)
+
+    def test_inline_rejects_existing_answer(self):
+        response = self.post_choices(' tak ')
+        self.assertContains(response, "Taka odpowiedź już istnieje")
+        self.assertEqual(self.question.choice_set.count(), 2)
+
+    def test_inline_rejects_repeated_answer(self):
+        response = self.post_choices('Może', ' może')
+        self.assertContains(response, "Taka odpowiedź już istnieje")
+        self.assertEqual(self.question.choice_set.count(), 2)
+        response = self.post_choices('Może')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.question.choice_set.count(), 3)
+
+    def test_choice_admin_rejects_existing_answer(self):
+        response = self.client.post(reverse('admin:polls_choice_add'),
+                                    {'question': self.question.pk,
+                                     'choice_text': 'NIE'})
+        self.assertContains(response, "Taka odpowiedź już istnieje")
+
+
+class BackfillChoicesTests(TestCase):
+    def test_backfill(self):
+        question = OpenQuestion.objects.create(poll=Poll.objects.create())
+        for text in ('Odp', 'Odp2', 'Inna'):
+            question.choice_set.create(choice_text=text)
+        # Rows from before normalization, one of them a duplicate
+        Choice.objects.update(normalized_text=None)
+        Choice.objects.filter(choice_text='Odp2').update(choice_text=' odp')
+        output = StringIO()
+        call_command('backfill_polls', stdout=output)
+        self.assertIn('Normalized 2 choices', output.getvalue())
+        self.assertIn('" odp" of question', output.getvalue())
+        self.assertEqual(dict(question.choice_set.values_list(
+            'choice_text', 'normalized_text')),
+            {'Odp': 'odp', ' odp': None, 'Inna': 'inna'})
+        call_command('backfill_polls', stdout=output)
+        self.assertIn('Normalized 0 choices', output.getvalue())
+
+
+class BackfillVotesTests(TestCase):
+    def setUp(self):
+        self.poll = Poll.objects.create()
+        self.question = SimpleQuestion.objects.create(poll=self.poll)
+        self.question.activate()
+        self.yes, self.no = self.question.choice_set.all()
+        self.codes = list(self.poll.accesscode_set.order_by('pk')[:2])
+        for code, choice in zip(self.codes + self.codes[:1],
+                                (self.yes, self.no, self.no)):
+            cast_vote(self.question, code, choice)
+        self.question.deactivate()
+        compact_question(self.question)
+
+    def backfill(self):
+        output = StringIO()
+        call_command('backfill_polls', stdout=output)
+        return output.getvalue()
+
+    def test_chains(self):
+        # Votes from before hashing, and one cast after the upgrade
+        # started a chain of its own
+        Vote.objects.exclude(pk=Vote.objects.latest('pk').pk).update(
+            chain_hash='')
+        ArchivedVote.objects.update(chain_hash='')
+        Question.objects.update(chain_length=1)
+        self.assertFalse(verify_question(self.question, full=True)['valid'])
+
+        self.assertIn('Chained votes of 1 questions', self.backfill())
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.chain_length, 3)
+        self.assertEqual(verify_question(self.question, full=True),
+                         {'question': self.question.pk, 'checked': 3,
+                          'valid': True, 'broken_at': None})
+        self.assertIn('Chained votes of 0 questions', self.backfill())
+
+    def test_voters(self):
+        Question.objects.update(voters=0)
+        self.assertIn('Counted voters of 1 questions', self.backfill())
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.voters, 2)
+        self.assertIn('Counted voters of 0 questions', self.backfill())
+
+    def test_formatted_codes(self):
+        AccessCode.objects.filter(pk=self.codes[0].pk).update(
+            formatted_code='')
+        self.assertIn('Formatted 1 access codes', self.backfill())
+        self.assertEqual(AccessCode.objects.get(
+            pk=self.codes[0].pk).formatted_code,
+            format_code(self.codes[0].code))
+        self.assertIn('Formatted 0 access codes', self.backfill())
+
+
+class ConcurrentChoiceCreationTests(TransactionTestCase):
+    def test_simultaneous_proposals(self):
+        """
+        The same answer proposed simultaneously creates only one choice.
+        """
+        poll = Poll.objects.create()
+        question = OpenQuestion.objects.create(
+            poll=poll, question_text="OpenQuestion")
+        threads_number = 8
+        barrier = Barrier(threads_number)
+        errors = []
+
+        def propose(text):
+            try:
+                barrier.wait()
+                Choice.objects.get_or_create_normalized(question, text)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        answers = ['Odp', ' odp ', 'ODP', 'oDp']
+        threads = [Thread(target=propose, args=(answers[i % len(answers)],))
+                   for i in range(threads_number)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(question.choice_set.count(), 1)
+
+
+class VoteLockingTests(TestCase):
+    def test_code_locked_before_previous_vote_is_read(self):
+        """
+        A vote updates its code row, locking it until commit,
+        before it looks for the previous vote of the code,
+        so simultaneous first votes of one code count one voter.
+        """
+        poll = Poll.objects.create()
+        question = SimpleQuestion.objects.create(poll=poll)
+        question.activate()
+        code = poll.accesscode_set.first()
+        with CaptureQueriesContext(connection) as queries:
+            cast_vote(question, code, question.choice_set.first())
+        statements = [query['sql'] for query in queries]
+        lock = next(i for i, sql in enumerate(statements)
+                    if sql.startswith('UPDATE "polls_accesscode"'))
+        lookup = next(i for i, sql in enumerate(statements)
+                      if sql.startswith('SELECT')
+                      and 'FROM "polls_vote"' in sql)
+        self.assertLess(lock, lookup)
+
 
 class QuestionTests(TestCase):
     """
@@ -113,6 +314,25 @@ class QuestionTests(TestCase):
         question.deactivate()
         self.assertFalse(question.is_active())
 
+    def test_state(self):
+        question = Question.objects.get(question_text="test-question")
+        self.assertEqual(question.state, Question.AVAILABLE)
+        question.activate()
+        self.assertEqual(question.state, Question.ACTIVE)
+        question.deactivate()
+        self.assertEqual(question.state, Question.CLOSED)
+
+    def test_with_state(self):
+        question = Question.objects.get(question_text="test-question")
+        open_question = OpenQuestion.objects.create(
+            poll=question.poll, question_text="OpenQuestion")
+        open_question.activate()
+        questions = {q.pk: q for q in Question.objects.with_state()}
+        self.assertFalse(questions[question.pk].is_open)
+        self.assertTrue(questions[open_question.pk].is_open)
+        self.assertEqual(list(Question.objects.active()),
+                         [open_question.question_ptr])
+
     def test_try_to_deativate_inactive_question(self):
         question = Question.objects.get(question_text="test-question")
         question.deactivate()
@@ -174,6 +394,20 @@ class PollTests(TestCase):
         for code in codes:
             self.assertTrue(poll.is_code_correct(code))
 
+    def test_is_code_correct_normalizes_input(self):
+        poll = Poll.objects.create()
+        code = poll.get_codes()[0]
+        self.assertTrue(poll.is_code_correct(format_code(code).lower()))
+        self.assertFalse(poll.is_code_correct(code[:-1]))
+
+    def test_formatted_codes(self):
+        poll = Poll.objects.create()
+        self.assertEqual(poll.get_formatted_codes(),
+                         [format_code(code) for code in poll.get_codes()])
+        code = poll.accesscode_set.create(code='ab12-cd34')
+        self.assertEqual((code.code, code.formatted_code),
+                         ('AB12CD34', 'AB12-CD34'))
+
     def test_adding_question(self):
         poll = Poll.objects.create()
         question = Question.objects.create(
@@ -193,3 +427,15 @@ class PollTests(TestCase):
             poll=poll, question_text="test-question")
         question_names = map(str, poll.question_set.all())
         self.assertIn(str(question), question_names)
+
+
+class PollDatabaseTests(TestCase):
+    multi_db = True
+    databases = {'default', 'replica'}
+
+    def test_codes_saved_to_database_of_poll(self):
+        poll = Poll(poll_name="Replika")
+        poll.save(using='replica')
+        self.assertEqual(
+            AccessCode.objects.using('replica').filter(poll=poll).count(), 82)
+        self.assertFalse(AccessCode.objects.filter(poll_id=poll.pk).exists())
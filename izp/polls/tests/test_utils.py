@@ -1,8 +1,44 @@
 """
 Tests for various utilities
 """
-from django.test import TestCase
-from polls.codes import generate_codes
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+from threading import Thread
+import random
+from time import sleep, time
+from unittest import mock, skipIf
+import sys
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.utils import timezone
+from django.test import LiveServerTestCase, TestCase, override_settings
+from django.urls import reverse
+from io import StringIO
+from polls import caching
+from polls.archive import compact_question, vote_history
+from polls.analytics import SECOND, bin_seconds, timing, vote_times
+from polls.audit import anomalies, code_history, verify_question
+from array import array
+from polls.chain import GENESIS, vote_hash, verify_rows
+from polls.ballots import approval_tally, cast_ballot, cast_vote, \
+    instant_runoff
+from polls.columnar import MISSING, PollColumns, export_poll, \
+    histogram, write_columns
+from polls.codes import format_code, generate_codes, normalize_code
+from polls.factories import build_poll, load_dataset
+from polls.models import AccessCode, ArchivedVote, Ballot, ChainCheckpoint, \
+    MultipleChoiceQuestion, Poll, Question, RankedQuestion, SimpleQuestion, \
+    Vote
+from polls import profiling
+from polls.results import polls_results, question_results
+from polls.startup import heavy_imports, measure_startup, \
+    parse_import_times
+from polls.turnout import Turnout
 from polls.views import reformat_code, format_codes_list
 
 
@@ -62,6 +98,21 @@ class ReformatCodeTests(TestCase):
         self.assertEqual("", formated_code2)
 
 
+class NormalizeCodeTests(TestCase):
+    def test_case_and_whitespace(self):
+        self.assertEqual(normalize_code(" iz02-fw4z "), "IZ02FW4Z")
+        self.assertEqual(normalize_code("IZ02 FW4Z"), "IZ02FW4Z")
+        self.assertEqual(normalize_code("iz02fw4z"), "IZ02FW4Z")
+
+    def test_misplaced_separators(self):
+        self.assertEqual(normalize_code("IZ02--FW4Z"), "")
+        self.assertEqual(normalize_code("-IZ02FW4Z"), "")
+
+    def test_format_code(self):
+        self.assertEqual(format_code("IZ02FW4Z"), "IZ02-FW4Z")
+        self.assertEqual(format_code(""), "")
+
+
 class FormatCodeListTests(TestCase):
     def test_format_codes_list(self):
         codes_list = ["IZ02FW4Z", "IZPW", "IZP", "IZ0FW4GEI"]
@@ -70,3 +121,927 @@ class FormatCodeListTests(TestCase):
         self.assertEqual("IZPW", formated_codes_list[1])
         self.assertEqual("IZP", formated_codes_list[2])
         self.assertEqual("IZ0F-W4GE-I", formated_codes_list[3])
+
+
+class CompactVotesTests(TestCase):
+    def setUp(self):
+        self.poll = Poll.objects.create()
+        self.question = SimpleQuestion.objects.create(
+            poll=self.poll, question_text="Tak czy nie?")
+        self.question.activate()
+        yes, no = self.question.choice_set.all()
+        codes = self.poll.accesscode_set.all()
+        for choice in [yes, no, yes]:
+            Vote.objects.create(question=self.question, choice=choice,
+                                code=codes[0])
+        Vote.objects.create(question=self.question, choice=no,
+                            code=codes[1])
+        self.history = list(vote_history(self.question))
+
+    def test_active_question_not_compacted(self):
+        with self.assertRaises(ValueError):
+            compact_question(self.question)
+
+    def test_only_last_votes_kept(self):
+        self.question.deactivate()
+        self.assertEqual(compact_question(self.question), 2)
+        self.assertEqual(Vote.objects.count(), 2)
+        self.assertEqual(ArchivedVote.objects.count(), 2)
+        self.assertEqual(compact_question(self.question), 0)
+
+    def test_history_reconstructed(self):
+        self.question.deactivate()
+        compact_question(self.question)
+        self.assertEqual(list(vote_history(self.question)), self.history)
+
+    def test_command(self):
+        self.question.deactivate()
+        out = StringIO()
+        call_command('compact_votes', str(self.poll.id), stdout=out)
+        self.assertIn('Archived 2 votes', out.getvalue())
+        self.assertEqual(Vote.objects.count(), 2)
+
+
+class BenchmarkViewsTests(TestCase):
+    def test_benchmark(self):
+        out = StringIO()
+        call_command('benchmark_views', host='testserver', requests=4,
+                     concurrency=2, stdout=out)
+        self.assertIn('wsgi: 4 requests, concurrency 2', out.getvalue())
+        self.assertIn('asgi: 4 requests, concurrency 2', out.getvalue())
+        self.assertEqual(out.getvalue().count(', 0 failed'), 2)
+
+
+class BenchmarkTemplatesTests(TestCase):
+    def test_command(self):
+        out = StringIO()
+        call_command('benchmark_templates', rows=1000, repeat=1, stdout=out)
+        self.assertIn('codes: 1000 rows', out.getvalue())
+        self.assertIn('results: 1000 rows', out.getvalue())
+
+
+class PollReportTests(TestCase):
+    def setUp(self):
+        self.poll = Poll.objects.create()
+        codes = self.poll.accesscode_set.all()
+        for i in range(3):
+            question = SimpleQuestion.objects.create(
+                poll=self.poll, question_text=str(i))
+            yes, no = question.choice_set.all()
+            for code in codes[:41 - i]:
+                Vote.objects.create(question=question, choice=no, code=code)
+                Vote.objects.create(question=question, choice=yes, code=code)
+
+    def test_results(self):
+        results = polls_results([self.poll.id], processes=1)
+        self.assertEqual([r['question_text'] for r in results],
+                         ['0', '1', '2'])
+        self.assertEqual(results[0]['choices'][0],
+                         {'choice_text': 'Tak', 'votes': 41})
+        self.assertEqual(results[0]['choices'][1]['votes'], 0)
+        self.assertEqual(results[1]['used_codes'], 40)
+        self.assertEqual(results[1]['all_codes'], 82)
+        self.assertEqual([r['valid'] for r in results], [True, False, False])
+
+    def test_command(self):
+        out = StringIO()
+        call_command('poll_report', str(self.poll.id), processes=1,
+                     stdout=out)
+        self.assertIn('"used_codes": 39', out.getvalue())
+
+    def assertSameAsView(self, question):
+        question.deactivate()
+        response = self.client.get(reverse('polls:question_result',
+                                           args=(question.id,)))
+        results = question_results(question.pk)
+        self.assertEqual(
+            {row['choice_text']: row['votes'] for row in results['choices']},
+            {choice.choice_text: choice.votes
+             for choice in response.context['choices']})
+        self.assertEqual(results['used_codes'],
+                         response.context['turnout'].used_codes)
+        return results
+
+    def test_weighted_votes_as_in_view(self):
+        codes = list(self.poll.accesscode_set.order_by('pk')[:3])
+        AccessCode.objects.filter(pk=codes[0].pk).update(weight=10)
+        codes[0].refresh_from_db()
+        question = SimpleQuestion.objects.create(poll=self.poll)
+        question.activate()
+        yes, no = question.choice_set.all()
+        for code, choice in zip(codes, (yes, no, no)):
+            cast_vote(question, code, choice)
+        results = self.assertSameAsView(question)
+        self.assertEqual(results['choices'][0],
+                         {'choice_text': 'Tak', 'votes': 10})
+
+    def test_ballots_as_in_view(self):
+        codes = list(self.poll.accesscode_set.order_by('pk')[:3])
+        AccessCode.objects.filter(pk=codes[0].pk).update(weight=10)
+        codes[0].refresh_from_db()
+        multiple = MultipleChoiceQuestion.objects.create(poll=self.poll)
+        ranked = RankedQuestion.objects.create(poll=self.poll)
+        for question in (multiple, ranked):
+            a, b, c = [question.choice_set.create(choice_text=text)
+                       for text in 'abc']
+            question.activate()
+            for code, ranking in zip(codes, ([a.id, b.id], [b.id, c.id],
+                                             [c.id, b.id])):
+                cast_ballot(question, code, ranking)
+            results = self.assertSameAsView(question)
+            self.assertEqual(results['used_codes'], 3)
+            self.assertEqual(results['choices'][0]['votes'],
+                             12 if question is multiple else 10)
+
+
+class TurnoutTests(TestCase):
+    def test_required_percent(self):
+        self.assertEqual(Turnout(0, 82).required, 41)
+        self.assertEqual(Turnout(0, 83).required, 42)
+        self.assertEqual(Turnout(0, 82, 10).required, 9)
+
+    def test_required_minimum(self):
+        self.assertEqual(Turnout(0, 82, 10, 20).required, 20)
+        self.assertEqual(Turnout(0, 82, 50, 20).required, 41)
+
+    def test_is_reached(self):
+        self.assertTrue(Turnout(41, 82).is_reached())
+        self.assertFalse(Turnout(40, 82).is_reached())
+        self.assertFalse(Turnout(0, 0, 0).is_reached())
+
+
+class CachingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_versioned_key(self):
+        key = caching.versioned_key('result', ('question', 1))
+        self.assertEqual(key, caching.versioned_key('result',
+                                                    ('question', 1)))
+        caching.bump('question', 1)
+        self.assertNotEqual(key, caching.versioned_key('result',
+                                                       ('question', 1)))
+
+    def test_get_or_compute(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return 'value'
+
+        for _ in range(3):
+            self.assertEqual(
+                caching.get_or_compute('key', compute, 60), 'value')
+        self.assertEqual(len(calls), 1)
+        stats = caching.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 2)
+
+    def test_single_flight(self):
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            sleep(0.2)
+            return 'value'
+
+        def get():
+            results.append(caching.get_or_compute('key', compute, 60))
+
+        threads = [Thread(target=get) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 10)
+        self.assertEqual(caching.stats()['waits'], 9)
+
+    def test_waiter_keeps_lock_of_another_client(self):
+        cache.add('key:lock', 'other', 60)
+        with mock.patch.object(caching, 'WAIT_SECONDS', 0):
+            self.assertEqual(
+                caching.get_or_compute('key', lambda: 'value', 60), 'value')
+        self.assertEqual(cache.get('key:lock'), 'other')
+        cache.delete('key')
+        cache.delete('key:lock')
+        caching.get_or_compute('key', lambda: 'value', 60)
+        self.assertIsNone(cache.get('key:lock'))
+
+    def test_early_recompute(self):
+        cache.set('key', ('old', 1.0, time()), 60)
+        self.assertEqual(caching.get_or_compute('key', lambda: 'new', 60),
+                         'new')
+        self.assertEqual(caching.stats()['early_recomputes'], 1)
+
+
+class BallotsTests(TestCase):
+    def test_replaced_ballot_gets_new_id(self):
+        poll = Poll.objects.create()
+        question = RankedQuestion.objects.create(poll=poll)
+        a, b = [question.choice_set.create(choice_text=text)
+                for text in ('Odp1', 'Odp2')]
+        question.activate()
+        code = poll.accesscode_set.first()
+        self.assertTrue(cast_ballot(question, code, [a.id, b.id]))
+        first = question.ballot_set.get().pk
+        self.assertFalse(cast_ballot(question, code, [b.id]))
+        ballot = question.ballot_set.get()
+        self.assertGreater(ballot.pk, first)
+        self.assertEqual(ballot.ranking, str(b.id))
+        question.refresh_from_db()
+        self.assertEqual(question.voters, 1)
+
+    def test_approval_tally(self):
+        groups = [((1, 2), 3), ((2,), 1), ((3, 9), 2)]
+        self.assertEqual(approval_tally(groups, [1, 2, 3]),
+                         {1: 3, 2: 4, 3: 2})
+
+    def test_instant_runoff(self):
+        groups = [((1, 2, 3), 4), ((2, 1), 3), ((3, 2), 2)]
+        rounds, winner = instant_runoff(groups, [1, 2, 3])
+        self.assertEqual(rounds, [{1: 4, 2: 3, 3: 2}, {1: 4, 2: 5}])
+        self.assertEqual(winner, 2)
+
+    def test_instant_runoff_exhausted_ballots(self):
+        groups = [((1,), 3), ((2,), 2), ((3,), 2), ((3, 2), 1)]
+        rounds, winner = instant_runoff(groups, [1, 2, 3])
+        self.assertEqual(rounds[1:], [{1: 3, 3: 3}, {1: 3}])
+        self.assertEqual(winner, 1)
+        self.assertEqual(instant_runoff([], [1, 2]), ([{1: 0, 2: 0}], None))
+
+    def test_instant_runoff_speed(self):
+        rng = random.Random(0)
+        choice_ids = list(range(1, 9))
+        groups = []
+        for _ in range(100000):
+            ranking = rng.sample(choice_ids, rng.randint(1, 8))
+            groups.append((tuple(ranking), rng.randint(1, 3)))
+        start = time()
+        rounds, winner = instant_runoff(groups, choice_ids)
+        self.assertLess(time() - start, 1)
+        self.assertIn(winner, choice_ids)
+        self.assertEqual(sum(rounds[0].values()),
+                         sum(weight for _, weight in groups))
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def view(self, request):
+        sleep(0.05)
+        return 'response'
+
+    def test_disabled(self):
+        with override_settings(POLLS_PROFILING=False):
+            view = self.view
+            self.assertIs(profiling.profiled(view), view)
+
+    def test_sampled_request(self):
+        with override_settings(POLLS_PROFILING=True,
+                               POLLS_PROFILE_DIR=self.directory):
+            view = profiling.profiled(self.view)
+            self.assertEqual(view(None), 'response')
+            self.assertEqual(profiling.list_profiles(), [])
+
+            profiling.set_rate(1)
+            self.assertEqual(view(None), 'response')
+            names = profiling.list_profiles()
+            self.assertEqual(len(names), 1)
+            self.assertTrue(names[0].endswith('-view.txt'))
+            stack, count = profiling.read_profile(
+                names[0]).splitlines()[0].rsplit(' ', 1)
+            self.assertIn('view (test_utils.py:', stack)
+            self.assertGreater(int(count), 0)
+
+    def test_bounded_directory(self):
+        with override_settings(POLLS_PROFILE_DIR=self.directory,
+                               POLLS_PROFILE_MAX_FILES=3):
+            names = [profiling.save_profile('view', 'a;b 1\n')
+                     for _ in range(5)]
+            self.assertEqual(profiling.list_profiles(), names[:1:-1])
+            self.assertIsNone(profiling.read_profile('../settings.py'))
+
+
+class StartupTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(StartupTests, cls).setUpClass()
+        cls.report = measure_startup()
+
+    def test_heavy_modules_imported_lazily(self):
+        self.assertIn('polls.views', self.report['modules'])
+        self.assertEqual(heavy_imports(self.report['modules']), [])
+
+    def test_cold_start_time(self):
+        self.assertLess(self.report['seconds'],
+                        settings.POLLS_COLD_START_SECONDS)
+
+    @skipIf(sys.version_info < (3, 7), "-X importtime requires Python 3.7")
+    def test_import_times_reported(self):
+        modules = [module for module, _, _ in self.report['import_times']]
+        self.assertIn('polls.views', modules)
+
+    def test_parse_import_times(self):
+        output = ("import time: self [us] | cumulative | imported package\n"
+                  "import time:       120 |        120 |   polls.codes\n"
+                  "import time:        80 |        400 | polls.models\n")
+        self.assertEqual(parse_import_times(output),
+                         [('polls.codes', 120, 120),
+                          ('polls.models', 80, 400)])
+        self.assertEqual(heavy_imports(['reportlab.lib', 'reportlabx',
+                                        'easy_pdf']), ['reportlab.lib'])
+
+
+@override_settings(POLLS_RELAY_TOKEN='secret')
+class RelayTests(LiveServerTestCase):
+    """
+    Runs a relay as a second instance of the application,
+    with its own SQLite database, against the live test server.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.database = os.path.join(self.directory, 'relay.sqlite3')
+        self.poll = Poll.objects.create(poll_name='Sala 1')
+        self.question = SimpleQuestion.objects.create(
+            poll=self.poll, question_text='Tak czy nie?')
+        self.question.activate()
+        self.yes, self.no = self.question.choice_set.all()
+        self.ranked = RankedQuestion.objects.create(
+            poll=self.poll, question_text='Kolejność?')
+        self.a, self.b = [self.ranked.choice_set.create(choice_text=text)
+                          for text in ('Odp1', 'Odp2')]
+        self.ranked.activate()
+        self.codes = self.poll.get_codes()
+        self.relay('migrate', '-v', '0')
+
+    def relay(self, *args):
+        env = dict(os.environ, POLLS_DATABASE=self.database,
+                   POLLS_UPSTREAM_URL=self.live_server_url + '/polls/',
+                   POLLS_RELAY_TOKEN='secret', POLLS_RELAY_ID='sala1',
+                   PYTHONIOENCODING='utf-8')
+        return subprocess.run(
+            [sys.executable, 'manage.py'] + list(args), env=env,
+            cwd=settings.BASE_DIR, check=True, stdout=subprocess.PIPE,
+            encoding='utf-8').stdout
+
+    def relay_query(self, sql):
+        with sqlite3.connect(self.database) as connection:
+            return connection.execute(sql).fetchall()
+
+    def relay_vote(self, question, code, choices):
+        self.relay('shell', '-c', (
+            'from polls.ballots import cast_ballot, cast_vote\n'
+            'from polls.models import AccessCode, Choice, Question\n'
+            'q = Question.objects.with_state().get(pk={})\n'
+            'c = AccessCode.objects.get(code="{}")\n'
+            'if q.is_ranked: cast_ballot(q, c, {})\n'
+            'else: cast_vote(q, c, Choice(pk={}))\n').format(
+            question.pk, code, choices, choices[0]))
+
+    def test_pull_and_push(self):
+        self.relay('relay_sync', str(self.poll.id), '--pull')
+        self.assertEqual(self.relay_query(
+            'SELECT count(*) FROM polls_accesscode'), [(82, )])
+        self.assertEqual(self.relay_query(
+            'SELECT question_ptr_id FROM polls_rankedquestion'),
+            [(self.ranked.id, )])
+
+        self.relay_vote(self.question, self.codes[0], [self.yes.id])
+        self.relay_vote(self.question, self.codes[0], [self.no.id])
+        self.relay_vote(self.question, self.codes[1], [self.yes.id])
+        self.relay_vote(self.ranked, self.codes[0], [self.b.id, self.a.id])
+
+        output = self.relay('relay_sync', '--push')
+        self.assertIn('Question {}: 2 accepted'.format(self.question.id),
+                      output)
+        self.assertEqual(Vote.objects.count(), 2)
+        self.yes.refresh_from_db()
+        self.no.refresh_from_db()
+        self.assertEqual((self.yes.votes, self.no.votes), (1, 1))
+        self.assertEqual(Ballot.objects.get().ranking,
+                         '{},{}'.format(self.b.id, self.a.id))
+
+        self.assertEqual(self.relay('relay_sync', '--push'), '')
+        self.relay_query('DELETE FROM polls_relaycursor')
+        output = self.relay('relay_sync', '--push')
+        self.assertIn('Question {}: 2 duplicate'.format(self.question.id),
+                      output)
+        self.assertEqual(Vote.objects.count(), 2)
+
+    def test_vote_cast_before_close_counted(self):
+        self.relay('relay_sync', str(self.poll.id), '--pull')
+        self.relay_vote(self.question, self.codes[0], [self.yes.id])
+        self.relay_vote(self.ranked, self.codes[0], [self.b.id, self.a.id])
+        self.question.deactivate()
+        self.ranked.deactivate()
+
+        output = self.relay('relay_sync', '--push')
+        self.assertIn('Question {}: 1 accepted'.format(self.question.id),
+                      output)
+        self.assertIn('Question {}: 1 accepted'.format(self.ranked.id),
+                      output)
+        self.assertEqual(Vote.objects.get().choice, self.yes)
+        self.assertEqual(Ballot.objects.get().question_id, self.ranked.id)
+
+    def test_push_keeps_ballots_rejected_upstream(self):
+        self.relay('relay_sync', str(self.poll.id), '--pull')
+        self.question.deactivate()
+        self.relay_vote(self.question, self.codes[0], [self.yes.id])
+
+        output = self.relay('relay_sync', '--push')
+        self.assertIn('Question {}: 1 rejected'.format(self.question.id),
+                      output)
+        self.assertIn('Rejected: sala1:v:', output)
+        self.assertEqual(Vote.objects.count(), 0)
+        self.assertEqual(self.relay_query(
+            'SELECT question_id, code, choices FROM polls_relayrejection'),
+            [(self.question.id, self.codes[0], str(self.yes.id))])
+
+        output = self.relay('relay_sync', '--push')
+        self.assertNotIn('Question', output)
+        self.assertIn('Rejected: sala1:v:', output)
+
+    def test_newer_ballot_replaces_rejected_one(self):
+        self.relay('relay_sync', str(self.poll.id), '--pull')
+        self.relay_vote(self.ranked, self.codes[0], [self.a.id, self.a.id])
+        output = self.relay('relay_sync', '--push')
+        self.assertIn('Question {}: 1 rejected'.format(self.ranked.id),
+                      output)
+
+        self.relay_vote(self.ranked, self.codes[0], [self.b.id, self.a.id])
+        self.relay_vote(self.ranked, self.codes[1], [self.a.id])
+        output = self.relay('relay_sync', '--push')
+        self.assertIn('Question {}: 2 accepted'.format(self.ranked.id),
+                      output)
+        self.assertNotIn('Rejected', output)
+        self.assertEqual(Ballot.objects.get(
+            code__code=self.codes[0]).ranking,
+            '{},{}'.format(self.b.id, self.a.id))
+        self.assertEqual(self.relay_query(
+            'SELECT count(*) FROM polls_relayrejection'), [(0, )])
+
+    def test_snapshot_requires_token(self):
+        response = self.client.get('/polls/api/polls/{}/snapshot/'.format(
+            self.poll.id))
+        self.assertEqual(response.status_code, 403)
+
+
+class AuditTests(TestCase):
+    def setUp(self):
+        self.poll = Poll.objects.create()
+        self.question = SimpleQuestion.objects.create(poll=self.poll)
+        self.question.activate()
+        self.yes, self.no = self.question.choice_set.all()
+        self.code, self.other = self.poll.accesscode_set.all()[:2]
+        start = timezone.now() - timezone.timedelta(hours=1)
+        for i in range(12):
+            Vote.objects.create(question=self.question, code=self.code,
+                                choice=(self.yes, self.no)[i % 2],
+                                date=start + timezone.timedelta(seconds=i))
+        for minutes in (0, 10):
+            Vote.objects.create(question=self.question, code=self.other,
+                                choice=self.yes,
+                                date=start + timezone.timedelta(
+                                    minutes=minutes))
+
+    def test_history_across_archive(self):
+        expected = list(Vote.objects.filter(code=self.code).order_by(
+            '-pk').values_list('pk', flat=True))
+        self.question.deactivate()
+        compact_question(self.question)
+        self.assertEqual(ArchivedVote.objects.filter(code=self.code).count(),
+                         11)
+        votes = []
+        cursor = None
+        while True:
+            with self.assertNumQueries(2):
+                page = code_history(self.code, cursor, per_page=5)
+            votes += [vote.pk for vote in page]
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        self.assertEqual(votes, expected)
+
+    def test_anomalies(self):
+        report = anomalies(self.poll)
+        self.assertEqual(report, [{'code': self.code.formatted_code,
+                                   'votes': 12, 'fast_votes': 11,
+                                   'max_burst': 12}])
+
+
+class HashChainTests(TestCase):
+    def setUp(self):
+        self.poll = Poll.objects.create()
+        self.question = SimpleQuestion.objects.create(poll=self.poll)
+        self.question.activate()
+        self.yes, self.no = self.question.choice_set.all()
+        codes = self.poll.accesscode_set.all()
+        self.votes = [Vote.objects.create(question=self.question,
+                                          code=codes[i % 3],
+                                          choice=(self.yes, self.no)[i % 2])
+                      for i in range(6)]
+
+    def test_chain(self):
+        previous = GENESIS
+        for vote in Vote.objects.order_by('pk'):
+            previous = vote_hash(previous, vote.question_id, vote.choice_id,
+                                 vote.code_id, vote.date)
+            self.assertEqual(vote.chain_hash, previous)
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.chain_length, 6)
+
+    def test_question_save_keeps_counters(self):
+        question = SimpleQuestion.objects.get(pk=self.question.pk)
+        Vote.objects.create(question=self.question, code=self.votes[0].code,
+                            choice=self.yes)
+        question.question_text = 'Zmienione'
+        question.save()
+        question.refresh_from_db()
+        self.assertEqual(question.chain_length, 7)
+
+    def test_verify_with_checkpoints(self):
+        result = verify_question(self.question)
+        self.assertEqual((result['checked'], result['valid']), (6, True))
+        self.assertEqual(ChainCheckpoint.objects.get().vote_id,
+                         self.votes[-1].pk)
+
+        Vote.objects.create(question=self.question, code=self.votes[0].code,
+                            choice=self.yes)
+        result = verify_question(self.question)
+        self.assertEqual((result['checked'], result['valid']), (1, True))
+
+        Vote.objects.filter(pk=self.votes[2].pk).update(choice=self.no)
+        self.assertTrue(verify_question(self.question)['valid'])
+        result = verify_question(self.question, full=True)
+        self.assertEqual((result['valid'], result['broken_at']),
+                         (False, self.votes[2].pk))
+
+    def test_verify_after_compaction(self):
+        self.question.deactivate()
+        compact_question(self.question)
+        self.assertTrue(ArchivedVote.objects.exists())
+        self.assertTrue(verify_question(self.question)['valid'])
+
+    def test_deleted_vote(self):
+        self.votes[-1].delete()
+        result = verify_question(self.question)
+        self.assertFalse(result['valid'])
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('verify_votes', str(self.question.pk), stdout=out)
+        self.assertIn('broken at vote chain end', out.getvalue())
+
+    def test_verify_speed(self):
+        date = timezone.now()
+        rows = []
+        previous = GENESIS
+        for i in range(100000):
+            previous = vote_hash(previous, 1, i % 3, i, date)
+            rows.append((i, 1, i % 3, i, date, previous))
+        start = time()
+        self.assertEqual(verify_rows(rows)[1:], (100000, 99999, None))
+        self.assertLess(time() - start, 1)
+
+
+class ColumnarTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'poll.cols')
+        self.poll = Poll.objects.create(poll_name='Archiwalne')
+        self.question = SimpleQuestion.objects.create(poll=self.poll)
+        self.question.activate()
+        self.idle = SimpleQuestion.objects.create(poll=self.poll)
+        self.yes, self.no = self.question.choice_set.all()
+        self.codes = self.poll.accesscode_set.all()[:3]
+        AccessCode.objects.filter(pk=self.codes[1].pk).update(weight=3)
+        for i, choice in enumerate((self.yes, self.no, self.no, self.yes)):
+            code = self.codes[i % 3]
+            Vote.objects.create(question=self.question, code=code,
+                                choice=choice, weight=code.weight)
+
+    def test_export(self):
+        self.question.deactivate()
+        compact_question(self.question)
+        export_poll(self.poll, self.path)
+        with PollColumns(self.path) as columns:
+            self.assertEqual(columns.poll['poll_name'], 'Archiwalne')
+            self.assertEqual(columns.question_ids(),
+                             [self.question.pk, self.idle.pk])
+            self.assertEqual(columns.tally(self.question.pk),
+                             {self.yes.pk: 1, self.no.pk: 4})
+            self.assertEqual(list(columns.columns['votes']['id']),
+                             sorted(columns.columns['votes']['id']))
+            self.assertEqual((columns.turnout(self.question.pk),
+                              columns.revotes(self.question.pk)), (3, 1))
+            self.assertEqual(sum(columns.columns['votes']['archived']), 1)
+            self.assertEqual(columns.tally(self.idle.pk), {})
+            self.assertEqual(len(columns.response_times(self.idle.pk)), 0)
+            self.assertEqual(columns.columns['questions']['activation'][1],
+                             MISSING)
+            self.assertEqual(len(columns.response_times(self.question.pk)),
+                             4)
+            self.assertEqual(sum(columns.votes_per_day().values()), 4)
+
+    def test_ballots(self):
+        multiple = MultipleChoiceQuestion.objects.create(poll=self.poll)
+        ranked = RankedQuestion.objects.create(poll=self.poll)
+        codes = list(self.poll.accesscode_set.order_by('pk')[:4])
+        for question in (multiple, ranked):
+            a, b, c = [question.choice_set.create(choice_text=text)
+                       for text in 'abc']
+            question.activate()
+            for code, ranking in zip(codes, ([a.id, b.id], [b.id, c.id],
+                                             [c.id, b.id], [c.id])):
+                cast_ballot(question, code, ranking)
+            cast_ballot(question, codes[0], [a.id])
+        export_poll(self.poll, self.path)
+        with PollColumns(self.path) as columns:
+            for question in (multiple, ranked):
+                choices = dict(question.choice_set.values_list(
+                    'choice_text', 'pk'))
+                self.assertEqual(
+                    columns.tally(question.pk),
+                    {choices[row['choice_text']]: row['votes']
+                     for row in question_results(question.pk)['choices']
+                     if row['votes']})
+                self.assertEqual((columns.turnout(question.pk),
+                                  columns.revotes(question.pk)), (4, 0))
+                self.assertEqual(
+                    len(columns.response_times(question.pk)), 4)
+            a, b, c = multiple.choice_set.order_by('pk')
+            self.assertEqual(columns.tally(multiple.pk),
+                             {a.pk: 1, b.pk: 4, c.pk: 5})
+            self.assertEqual(sum(columns.votes_per_day().values()), 12)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('export_columns', str(self.poll.pk), '--output',
+                     self.path, stdout=out)
+        self.assertIn(self.path, out.getvalue())
+        with open(self.path, 'rb') as snapshot:
+            self.assertEqual(snapshot.read(8), b'POLLCOL3')
+
+    def test_histogram(self):
+        self.assertEqual(histogram([0, 1, 1, 5, 9, 10], [0, 5, 10]), [3, 3])
+
+    def test_speed(self):
+        votes = 500000
+        columns = {
+            'questions': {'id': array('q', [1]),
+                          'kind': array('q', [0]),
+                          'activation': array('q', [0]),
+                          'deactivation': array('q', [MISSING]),
+                          'votes_start': array('q', [0]),
+                          'votes_end': array('q', [votes]),
+                          'ballots_start': array('q', [0]),
+                          'ballots_end': array('q', [0])},
+            'choices': {'id': array('q', [10, 11]),
+                        'question': array('q', [0, 0])},
+            'codes': {'id': array('q', range(1000)),
+                      'weight': array('q', [1] * 1000)},
+            'votes': {'id': array('q', range(votes)),
+                      'question': array('q', [0]) * votes,
+                      'choice': array('q', [0, 1]) * (votes // 2),
+                      'code': array('q', range(1000)) * (votes // 1000),
+                      'date': array('q', range(votes)),
+                      'weight': array('q', [1]) * votes,
+                      'archived': array('q', [0]) * votes},
+            'ballots': {name: array('q') for name in (
+                'id', 'question', 'code', 'date', 'weight',
+                'rankings_start', 'rankings_end')},
+            'rankings': {'choice': array('q')}}
+        write_columns(self.path, {'poll': {}}, columns)
+        with PollColumns(self.path) as snapshot:
+            start = time()
+            self.assertEqual(snapshot.tally(1), {10: 500, 11: 500})
+            self.assertEqual(snapshot.revotes(1), votes - 1000)
+            self.assertLess(time() - start, 0.5)
+
+
+class AnalyticsTests(TestCase):
+    def test_vote_times(self):
+        poll = Poll.objects.create()
+        question = SimpleQuestion.objects.create(poll=poll)
+        question.activate()
+        choice = question.choice_set.first()
+        codes = poll.accesscode_set.all()[:2]
+        for seconds, code in ((3, codes[0]), (1, codes[1]), (7, codes[0])):
+            Vote.objects.create(question=question, code=code, choice=choice,
+                                date=question.activation_time
+                                + timezone.timedelta(seconds=seconds))
+        question.deactivate()
+        compact_question(question)
+        self.assertEqual(vote_times(question), (
+            array('q', [codes[1].pk, codes[0].pk, codes[0].pk]),
+            array('q', [SECOND, 3 * SECOND, 7 * SECOND])))
+
+    def test_timing(self):
+        codes = array('q', [1, 2, 1, 3])
+        times = array('q', [s * SECOND for s in (0, 1, 2, 45)])
+        report = timing(codes, times, 10)
+        self.assertEqual((report['votes'], report['voters'],
+                          report['revotes'], report['bin_seconds']),
+                         (4, 3, 1, 2))
+        self.assertEqual(len(report['bins']), 23)
+        self.assertEqual(report['bins'][0], {'start': 0, 'end': 2, 'votes': 2,
+                                             'voters': 2,
+                                             'turnout_percent': 20.0})
+        self.assertEqual(report['bins'][-1]['voters'], 3)
+        self.assertEqual(report['votes_per_code'], [(1, 2), (2, 1)])
+        self.assertEqual(timing(array('q'), array('q'), 10)['bins'], [])
+
+    def test_bin_seconds(self):
+        self.assertEqual(bin_seconds(29 * SECOND), 1)
+        self.assertEqual(bin_seconds(3600 * SECOND), 120)
+        self.assertEqual(bin_seconds(200 * 3600 * SECOND), 7 * 3600)
+
+    def test_speed(self):
+        votes = 300000
+        codes = array('q', range(1000)) * (votes // 1000)
+        times = array('q', range(0, votes * 1000, 1000))
+        start = time()
+        report = timing(codes, times, 1000)
+        self.assertEqual(report['revotes'], votes - 1000)
+        self.assertLess(time() - start, 0.5)
+
+
+class ShardingTests(TestCase):
+    """
+    Runs the application with votes of polls spread over
+    two SQLite shards next to its default database.
+    """
+
+    script = """
+import json
+from django.contrib.auth.models import User
+from django.test import Client
+from django.test.utils import setup_test_environment
+from polls.audit import verify_question
+from polls.models import Poll, SimpleQuestion, Vote
+from polls.routers import shard_for
+setup_test_environment()
+User.objects.create_superuser('admin', 'admin@example.com', 'pswd')
+client = Client()
+report = []
+for name in ('Wydzial A', 'Wydzial B'):
+    poll = Poll.objects.create(poll_name=name)
+    question = SimpleQuestion.objects.create(poll=poll, question_text='?')
+    client.post('/polls/%d/%d/comment/' % (poll.id, question.id),
+                {'text': 'Uwaga'})
+    question.activate()
+    yes, no = question.choice_set.all()
+    for code, choice in zip(poll.get_codes(), (yes, no, yes, yes)):
+        client.post('/polls/%d/login/' % poll.id, {'code': code})
+        client.post('/polls/%d/%d/vote/' % (poll.id, question.id),
+                    {'choice': choice.id})
+    question.deactivate()
+    result = client.get('/polls/%d/%d/question_result/' % (poll.id,
+                                                          question.id))
+    client.login(username='admin', password='pswd')
+    audit = client.get('/polls/%d/audit/%s/' % (poll.id,
+                                                poll.get_codes()[0]))
+    admin_votes = client.get('/admin/polls/vote/?poll=%d' % poll.id)
+    vote = admin_votes.context['cl'].result_list[0]
+    admin_vote = client.get(
+        '/admin/polls/vote/%d/change/?_changelist_filters=poll%%3D%d'
+        % (vote.pk, poll.id))
+    admin_codes = client.get('/admin/polls/accesscode/?poll=%d' % poll.id)
+    client.logout()
+    valid = verify_question(question)['valid']
+    # A vote appended in the shard without counting it in the chain
+    forged = Vote.objects.using(shard_for(poll.id)).last()
+    forged.pk, forged.chain_hash = None, '0' * 64
+    Vote.objects.using(shard_for(poll.id)).bulk_create([forged])
+    report.append({
+        'poll': poll.id, 'question': question.id,
+        'yes': [row['last_choice']
+                for row in result.context['codes']].count('Tak'),
+        'audit': len(audit.context['votes'].object_list),
+        'admin': [admin_votes.context['cl'].result_count,
+                  str(vote.question), admin_vote.status_code,
+                  admin_codes.context['cl'].result_count],
+        'valid': valid, 'forged': verify_question(question)['valid']})
+print(json.dumps(report))
+"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        for database in ('default', 'shard0', 'shard1'):
+            self.manage('migrate', '-v', '0', '--database', database)
+
+    def manage(self, *args):
+        env = dict(os.environ, POLLS_SHARDS='shard0,shard1',
+                   POLLS_DATABASE=os.path.join(self.directory,
+                                               'default.sqlite3'))
+        return subprocess.run(
+            [sys.executable, 'manage.py'] + list(args), env=env,
+            cwd=settings.BASE_DIR, check=True, stdout=subprocess.PIPE,
+            universal_newlines=True).stdout
+
+    def count(self, database, sql):
+        path = os.path.join(self.directory, database + '.sqlite3')
+        with sqlite3.connect(path) as connection:
+            return connection.execute(sql).fetchone()[0]
+
+    def test_polls_in_shards(self):
+        report = json.loads(self.manage('shell', '-c', self.script))
+        for row in report:
+            self.assertEqual((row['yes'], row['audit'], row['valid'],
+                              row['forged']), (3, 1, True, False))
+            self.assertEqual(row['admin'], [4, '?', 200, 82])
+            shard = 'shard{}'.format(row['poll'] % 2)
+            other = 'shard{}'.format(1 - row['poll'] % 2)
+            for table, rows in (('vote', 5), ('comment', 1)):
+                sql = 'SELECT count(*) FROM polls_{} ' \
+                      'WHERE question_id = {}'.format(table, row['question'])
+                self.assertEqual(self.count(shard, sql), rows)
+                self.assertEqual(self.count(other, sql), 0)
+            sql = 'SELECT count(*) FROM polls_accesscode ' \
+                  'WHERE poll_id = {}'.format(row['poll'])
+            self.assertEqual(self.count(shard, sql), 82)
+        for table in ('vote', 'accesscode', 'comment'):
+            self.assertEqual(self.count(
+                'default', 'SELECT count(*) FROM polls_' + table), 0)
+
+        self.manage('shell', '-c', 'from polls.models import Poll\n'
+                                   'Poll.objects.get(pk={}).delete()'.format(
+                                       report[0]['poll']))
+        shard = 'shard{}'.format(report[0]['poll'] % 2)
+        for table in ('vote', 'accesscode', 'comment'):
+            self.assertEqual(self.count(
+                shard, 'SELECT count(*) FROM polls_' + table), 0)
+
+
+class DatasetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def signature(self, poll):
+        codes = list(poll.accesscode_set.order_by('pk').values_list(
+            'code', 'counter'))
+        votes = [(vote.question.question_text, vote.choice.choice_text,
+                  vote.code.code, vote.date - vote.question.activation_time)
+                 for vote in Vote.objects.filter(
+                     question__poll=poll).select_related(
+                     'question', 'choice', 'code').order_by('pk')]
+        return codes, votes
+
+    def test_build_poll(self):
+        poll = build_poll(codes=20, questions=3, choices=3, votes=200,
+                          seed=7)
+        self.assertEqual(poll.accesscode_set.count(), 20)
+        self.assertEqual(Vote.objects.filter(
+            question__poll=poll).count(), 200)
+        self.assertEqual(sum(poll.accesscode_set.values_list(
+            'counter', flat=True)), 200)
+        for question in poll.question_set.all():
+            self.assertFalse(question.is_active())
+            self.assertEqual(question.chain_length, question.vote_set.count())
+            self.assertEqual(question.voters, question.vote_set.values(
+                'code').distinct().count())
+            results = question_results(question.pk)
+            self.assertEqual(
+                sorted(choice['votes'] for choice in results['choices']),
+                sorted(question.choice_set.values_list('votes', flat=True)))
+            self.assertTrue(verify_question(question)['valid'])
+
+    def test_same_seed_same_poll(self):
+        first = build_poll(codes=10, questions=2, votes=30, seed=1)
+        second = build_poll(codes=10, questions=2, votes=30, seed=1)
+        other = build_poll(codes=10, questions=2, votes=30, seed=2)
+        self.assertEqual(self.signature(first), self.signature(second))
+        self.assertNotEqual(self.signature(first), self.signature(other))
+
+    def test_load_dataset(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'dataset.sqlite3')
+        env = dict(os.environ, POLLS_DATABASE=path)
+        for args in (['migrate', '-v', '0'],
+                     ['build_dataset', '--codes', '50', '--questions', '2',
+                      '--choices', '4', '--votes', '300', '--seed', '3']):
+            subprocess.run([sys.executable, 'manage.py'] + args, env=env,
+                           cwd=settings.BASE_DIR, check=True,
+                           stdout=subprocess.DEVNULL)
+
+        load_dataset(path)
+        loaded = Poll.objects.get()
+        built = build_poll(codes=50, questions=2, choices=4, votes=300,
+                           seed=3)
+        self.assertEqual(self.signature(loaded), self.signature(built))
+        for question in loaded.question_set.all():
+            self.assertTrue(verify_question(question)['valid'])
+
+        with sqlite3.connect(path) as connection:
+            connection.execute('ALTER TABLE polls_vote ADD COLUMN extra')
+        with self.assertRaises(ValueError):
+            load_dataset(path)
@@ -2,13 +2,25 @@
 Tests for views
 """
 import datetime
-from django.test import TestCase
+import json
+import time
+from unittest import mock
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from django.urls import reverse
+from polls.codes import format_code
 from polls.models import Question, SimpleQuestion, OpenQuestion, Poll, \
-    CommentForm, Comment
+    CommentForm, Comment, MultipleChoiceQuestion, RankedQuestion, AccessCode, \
+    Choice, Vote
 from django.contrib.auth.models import User
-from polls.views import is_vote_successful
+from polls.views import is_vote_successful, POLLS_PER_PAGE, \
+    QUESTIONS_PER_PAGE
+from polls.comments import COMMENTS_PER_PAGE, invalidate_thread
+from polls.routers import STICKY_COOKIE
+from polls.results import question_results
 
 
 def basic_check_of_question(cls, response, quest, error=""):
@@ -72,6 +84,105 @@ class PollDetailViewTests(TestCase):
         )
 
 
+class PaginationViewTests(TestCase):
+    """
+    Tests for keyset pagination of polls and questions lists
+    """
+
+    def collect_pages(self, url, context_name):
+        rows = []
+        response = self.client.get(url)
+        while True:
+            rows.extend(response.context[context_name])
+            page = response.context['page']
+            if not page.has_next():
+                return rows
+            response = self.client.get(url, {'after': page.next_cursor})
+
+    def test_polls_pages(self):
+        for i in range(POLLS_PER_PAGE * 2 + 1):
+            Poll.objects.create(poll_name="Poll " + str(i),
+                                date=datetime.date(2017, 1, 1 + i % 3))
+        polls = self.collect_pages(reverse('polls:poll_index'), 'polls_list')
+        self.assertEqual(len(polls), POLLS_PER_PAGE * 2 + 1)
+        self.assertEqual(len(set(polls)), len(polls))
+        self.assertEqual(
+            polls,
+            list(Poll.objects.all().order_by('-date', '-id')))
+
+    def test_questions_pages(self):
+        poll = Poll.objects.create()
+        for i in range(QUESTIONS_PER_PAGE + 5):
+            question = Question.objects.create(
+                poll=poll, question_text="Question " + str(i))
+            if i % 2:
+                question.activate()
+        url = reverse('polls:poll_detail', args=(poll.id,))
+        questions = self.collect_pages(url, 'questions_list')
+        self.assertEqual(len(questions), QUESTIONS_PER_PAGE + 5)
+        self.assertEqual(len(set(questions)), len(questions))
+        activated = [q.activation_time is not None for q in questions]
+        self.assertEqual(activated, sorted(activated, reverse=True))
+
+    def test_questions_pages_with_nulls_first(self):
+        # Databases sorting NULLs first read inactive questions separately
+        with mock.patch.object(connection.features, 'nulls_order_largest',
+                               True):
+            self.test_questions_pages()
+
+    def test_page_size(self):
+        poll = Poll.objects.create()
+        for i in range(QUESTIONS_PER_PAGE + 1):
+            Question.objects.create(poll=poll, question_text="Question")
+        response = self.client.get(reverse('polls:poll_detail',
+                                           args=(poll.id,)))
+        self.assertEqual(len(response.context['questions_list']),
+                         QUESTIONS_PER_PAGE)
+        self.assertContains(response, "Następna strona")
+
+    def page_plans(self, url, table):
+        """
+        Returns query plans of all pages of the view reading the table.
+        """
+        plans = []
+        cursor = None
+        while True:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(
+                    url, {'after': cursor} if cursor else {})
+            with connection.cursor() as db:
+                for query in queries:
+                    if 'FROM "{}"'.format(table) in query['sql'] \
+                            and 'ORDER BY' in query['sql']:
+                        db.execute('EXPLAIN QUERY PLAN ' + query['sql'])
+                        plans.append(' '.join(
+                            row[-1] for row in db.fetchall()))
+            cursor = response.context['page'].next_cursor
+            if cursor is None:
+                return plans
+
+    def test_pages_read_index_order(self):
+        poll = Poll.objects.create()
+        for i in range(POLLS_PER_PAGE + 1):
+            Poll.objects.create(date=datetime.date(2017, 1, 1 + i % 3))
+        # Pages of active questions, of both and of inactive ones
+        for i in range(QUESTIONS_PER_PAGE * 2 + 5):
+            question = Question.objects.create(poll=poll)
+            if i % 3:
+                question.activate()
+        plans = self.page_plans(reverse('polls:poll_index'), 'polls_poll') \
+            + self.page_plans(reverse('polls:poll_detail', args=(poll.id,)),
+                              'polls_question')
+        self.assertEqual(len(plans), 5)
+        for plan in plans:
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('polls:poll_index'),
+                                   {'after': 'abc'})
+        self.assertEqual(response.status_code, 404)
+
+
 class QuestionDetailViewTests(TestCase):
     """
     Tests for Question detail view
@@ -203,8 +314,8 @@ class CodesViewsTests(TestCase):
         url = reverse('polls:codes', args=(self.poll.id,))
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
-        self.assertTrue(
-            len(response.context['codes_list']) == len(self.poll.get_codes()))
+        self.assertTrue(response.streaming)
+        self.assertContains(response, '<td>', count=len(self.poll.get_codes()))
         self.client.logout()
 
     def test_codes_pdf_view_as_superuser(self):
@@ -216,6 +327,27 @@ class CodesViewsTests(TestCase):
             len(response.context['codes_list']) == len(self.poll.get_codes()))
         self.client.logout()
 
+    def test_codes_view_uses_stored_format(self):
+        AccessCode.objects.bulk_create(
+            AccessCode(poll=self.poll, code='%08d' % i,
+                       formatted_code=format_code('%08d' % i))
+            for i in range(50000))
+        self.client.login(username="user1", password="pswd")
+        url = reverse('polls:codes', args=(self.poll.id,))
+        with mock.patch('polls.views.format_code',
+                        side_effect=AssertionError):
+            response = self.client.get(url)
+            content = b''.join(response.streaming_content).decode()
+        self.assertEqual(content.count('<td>'), 50082)
+        self.assertIn('0004-9999', content)
+
+    def test_login_with_typed_code(self):
+        code = self.poll.get_codes()[0]
+        self.client.post(reverse('polls:login', args=(self.poll.id,)),
+                         {'code': ' ' + format_code(code).lower()})
+        self.assertEqual(self.client.session['poll' + str(self.poll.id)],
+                         code)
+
     def test_codes_html_view_as_user(self):
         url = reverse('polls:codes', args=(self.poll.id,))
         response = self.client.get(url, follow=True)
@@ -297,6 +429,8 @@ class ShowCommentFormTest(TestCase):
 
 
 class ShowCommentsTest(TestCase):
+    def setUp(self):
+        cache.clear()
 
     def test_show_no_comments(self):
         poll = Poll.objects.create()
@@ -375,3 +509,756 @@ class ShowCommentsTest(TestCase):
             '<Comment: comment_b>',
             '<Comment: comment_a>'
         ], ordered=True)
+
+
+class CommentsCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        poll = Poll.objects.create()
+        self.question = Question.objects.create(poll=poll,
+                                                question_text="Question")
+        self.url = reverse('polls:question_detail', args=(self.question.id,))
+        self.since_url = reverse('polls:question_comments',
+                                 args=(self.question.id,))
+
+    def test_comments_cached(self):
+        Comment.objects.create(question=self.question, text="comment_a")
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        for query in queries.captured_queries:
+            self.assertNotIn('polls_comment', query['sql'])
+        self.assertQuerysetEqual(response.context['comments'],
+                                 ['<Comment: comment_a>'])
+
+    def test_cache_invalidated_on_insert(self):
+        Comment.objects.create(question=self.question, text="comment_a")
+        self.client.get(self.url)
+        self.client.post(reverse('polls:add_comment_to_question',
+                                 args=(self.question.id,)),
+                         {'text': 'comment_b'})
+        response = self.client.get(self.url)
+        self.assertQuerysetEqual(response.context['comments'], [
+            '<Comment: comment_b>',
+            '<Comment: comment_a>'
+        ], ordered=True)
+
+    def test_comments_pages(self):
+        for i in range(COMMENTS_PER_PAGE + 1):
+            Comment.objects.create(question=self.question, text=str(i))
+        response = self.client.get(self.url)
+        page = response.context['page']
+        self.assertEqual(len(response.context['comments']),
+                         COMMENTS_PER_PAGE)
+        response = self.client.get(self.url, {'after': page.next_cursor})
+        self.assertQuerysetEqual(response.context['comments'],
+                                 ['<Comment: 0>'])
+
+    def test_comments_since(self):
+        first = Comment.objects.create(question=self.question, text="a")
+        Comment.objects.create(question=self.question, text="b")
+        response = self.client.get(self.since_url, {'since': first.id})
+        comments = response.json()['comments']
+        self.assertEqual([comment['text'] for comment in comments], ['b'])
+
+    def test_no_comments_since_without_queries(self):
+        last = Comment.objects.create(question=self.question, text="a")
+        with self.assertNumQueries(0):
+            response = self.client.get(self.since_url, {'since': last.id})
+        self.assertEqual(response.json()['comments'], [])
+
+    def test_older_post_finishing_last_hides_no_comment(self):
+        first = Comment.objects.create(question=self.question, text="a")
+        # The newer comment is committed before the older post
+        # stores the id of the newest comment
+        with mock.patch('polls.models.invalidate_thread'):
+            Comment.objects.create(question=self.question, text="b")
+        invalidate_thread(self.question.id)
+        response = self.client.get(self.since_url, {'since': first.id})
+        self.assertEqual([comment['text']
+                          for comment in response.json()['comments']], ['b'])
+
+    def test_queryset_changes_invalidate_thread(self):
+        Comment.objects.create(question=self.question, text="a")
+        self.client.get(self.url)
+        Comment.objects.filter(question=self.question).update(text="b")
+        response = self.client.get(self.url)
+        self.assertQuerysetEqual(response.context['comments'],
+                                 ['<Comment: b>'])
+        Comment.objects.filter(question=self.question).delete()
+        response = self.client.get(self.url)
+        self.assertQuerysetEqual(response.context['comments'], [])
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Number of queries of each view must not depend
+    on the number of questions, choices, codes or votes.
+    """
+
+    def setUp(self):
+        cache.clear()
+        User.objects.create_superuser('admin', 'admin@example.com', 'pswd')
+        self.poll = Poll.objects.create()
+        for i in range(10):
+            SimpleQuestion.objects.create(poll=self.poll,
+                                          question_text=str(i))
+        self.question = OpenQuestion.objects.create(poll=self.poll,
+                                                    question_text="Open")
+        self.choice = self.question.choice_set.create(choice_text="Odp1")
+        self.question.activate()
+        for i in range(10):
+            Comment.objects.create(question=self.question, text=str(i))
+        self.code = self.poll.get_codes()[0]
+        s = self.client.session
+        s['poll' + str(self.poll.id)] = self.code
+        s.save()
+
+    def assertQueryBudget(self, budget, method, url, data=None):
+        with CaptureQueriesContext(connection) as context:
+            response = method(url, data or {})
+        queries = [q['sql'] for q in context.captured_queries
+                   if 'SAVEPOINT' not in q['sql']]
+        self.assertLessEqual(len(queries), budget, '\n'.join(queries))
+        return response
+
+    def test_poll_index(self):
+        self.assertQueryBudget(1, self.client.get,
+                               reverse('polls:poll_index'))
+
+    def test_poll_detail(self):
+        self.assertQueryBudget(3, self.client.get,
+                               reverse('polls:poll_detail',
+                                       args=(self.poll.id,)))
+
+    def test_question_detail(self):
+        self.assertQueryBudget(4, self.client.get,
+                               reverse('polls:question_detail',
+                                       args=(self.question.id,)))
+
+    def test_vote(self):
+        url = reverse('polls:vote', args=(self.question.id,))
+        self.client.post(url, {'choice': self.choice.id})
+        # Two of them append the vote to the hash chain of the question
+        self.assertQueryBudget(12, self.client.post, url,
+                               {'new_choice': 'Odp2'})
+
+    def test_question_result(self):
+        self.question.deactivate()
+        self.assertQueryBudget(3, self.client.get,
+                               reverse('polls:question_result',
+                                       args=(self.question.id,)))
+
+    def test_activate_question(self):
+        self.question.deactivate()
+        self.client.login(username='admin', password='pswd')
+        question = self.poll.question_set.filter(
+            activation_time__isnull=True).first()
+        self.assertQueryBudget(6, self.client.post,
+                               reverse('polls:activate_question',
+                                       args=(question.id,)))
+
+
+class TurnoutTests(TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pswd')
+        self.poll = Poll.objects.create(quorum_percent=1, quorum_minimum=2)
+        self.question = SimpleQuestion.objects.create(
+            poll=self.poll, question_text="Tak czy nie?")
+        self.question.activate()
+        self.url = reverse('polls:vote', args=(self.question.id,))
+
+    def vote(self, code, choice):
+        s = self.client.session
+        s['poll' + str(self.poll.id)] = code
+        s.save()
+        self.client.post(self.url, {'choice': choice.id})
+
+    def test_voters_counted_once_per_code(self):
+        yes, no = self.question.choice_set.all()
+        codes = self.poll.get_codes()
+        self.vote(codes[0], yes)
+        self.vote(codes[0], no)
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.voters, 1)
+        self.vote(codes[1], no)
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.voters, 2)
+
+    def test_live_turnout(self):
+        yes, _ = self.question.choice_set.all()
+        self.vote(self.poll.get_codes()[0], yes)
+        self.client.login(username='admin', password='pswd')
+        response = self.client.get(reverse('polls:question_turnout',
+                                           args=(self.question.id,)))
+        self.assertEqual(response.json(), {'used_codes': 1, 'all_codes': 82,
+                                           'required': 2, 'reached': False,
+                                           'active': True})
+        response = self.client.get(reverse('polls:poll_detail',
+                                           args=(self.poll.id,)))
+        self.assertContains(response, "Użyto 1 z 82 kodów")
+
+    def test_result_uses_quorum(self):
+        yes, _ = self.question.choice_set.all()
+        for code in self.poll.get_codes()[:2]:
+            self.vote(code, yes)
+        self.question.deactivate()
+        response = self.client.get(reverse('polls:question_result',
+                                           args=(self.question.id,)))
+        self.assertTrue(response.context['successful'])
+        self.assertContains(response, "kworum: 2")
+
+
+class BallotVoteTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.poll = Poll.objects.create(quorum_percent=1, quorum_minimum=1)
+        self.codes = self.poll.get_codes()
+
+    def create(self, model, **kwargs):
+        question = model.objects.create(poll=self.poll,
+                                        question_text="Pytanie", **kwargs)
+        choices = [question.choice_set.create(choice_text=text)
+                   for text in ('Odp1', 'Odp2', 'Odp3')]
+        question.activate()
+        return question, choices
+
+    def vote(self, question, code, data):
+        s = self.client.session
+        s['poll' + str(self.poll.id)] = code
+        s.save()
+        return self.client.post(reverse('polls:vote', args=(question.id,)),
+                                data)
+
+    def result(self, question):
+        question.deactivate()
+        return self.client.get(reverse('polls:question_result',
+                                       args=(question.id,)))
+
+    def test_weighted_vote(self):
+        question = SimpleQuestion.objects.create(poll=self.poll)
+        yes, no = question.choice_set.all()
+        question.activate()
+        AccessCode.objects.filter(code=self.codes[0]).update(weight=3)
+        self.vote(question, self.codes[0], {'choice': yes.id})
+        yes.refresh_from_db()
+        self.assertEqual(yes.votes, 3)
+        self.vote(question, self.codes[0], {'choice': no.id})
+        yes.refresh_from_db()
+        no.refresh_from_db()
+        self.assertEqual((yes.votes, no.votes), (0, 3))
+
+    def test_weight_changed_after_vote(self):
+        question = SimpleQuestion.objects.create(poll=self.poll)
+        yes, no = question.choice_set.all()
+        question.activate()
+        AccessCode.objects.filter(code=self.codes[0]).update(weight=3)
+        self.vote(question, self.codes[0], {'choice': yes.id})
+        AccessCode.objects.filter(code=self.codes[0]).update(weight=5)
+        self.vote(question, self.codes[0], {'choice': no.id})
+        yes.refresh_from_db()
+        no.refresh_from_db()
+        self.assertEqual((yes.votes, no.votes), (0, 5))
+        self.assertEqual(question_results(question.pk)['choices'],
+                         [{'choice_text': 'Nie', 'votes': 5},
+                          {'choice_text': 'Tak', 'votes': 0}])
+
+    def test_multiple_choice(self):
+        question, (a, b, c) = self.create(MultipleChoiceQuestion,
+                                          max_choices=2)
+        response = self.client.get(reverse('polls:question_detail',
+                                           args=(question.id,)))
+        self.assertContains(response, 'type="checkbox"', count=3)
+        response = self.vote(question, self.codes[0],
+                             {'choices': [a.id, b.id, c.id]})
+        self.assertContains(response, "Można wybrać najwyżej 2 odpowiedzi")
+        self.vote(question, self.codes[0], {'choices': [a.id, b.id]})
+        self.vote(question, self.codes[1], {'choices': [b.id]})
+        response = self.result(question)
+        self.assertEqual([(choice.choice_text, choice.votes)
+                          for choice in response.context['choices']],
+                         [('Odp2', 2), ('Odp1', 1), ('Odp3', 0)])
+        self.assertContains(response, "Odp1, Odp2")
+        self.assertEqual(response.context['turnout'].used_codes, 2)
+
+    def test_ranked(self):
+        question, (a, b, c) = self.create(RankedQuestion)
+        response = self.vote(question, self.codes[0],
+                             {'rank_%d' % a.id: 1, 'rank_%d' % b.id: 1})
+        self.assertContains(response, "różnymi liczbami")
+        ballots = [{a.id: 1, b.id: 2}, {a.id: 1}, {b.id: 1, c.id: 2},
+                   {c.id: 1, b.id: 2}, {c.id: 2, b.id: 1}]
+        for code, ranks in zip(self.codes, ballots):
+            self.vote(question, code, {'rank_%d' % choice_id: rank
+                                       for choice_id, rank in ranks.items()})
+        question.refresh_from_db()
+        self.assertEqual(question.voters, 5)
+        response = self.result(question)
+        self.assertEqual([(choice.choice_text, choice.votes)
+                          for choice in response.context['choices']],
+                         [('Odp2', 3), ('Odp1', 2), ('Odp3', 0)])
+        self.assertEqual(response.context['rounds'],
+                         [['Odp1', 2, 2], ['Odp2', 2, 3], ['Odp3', 1, '-']])
+        self.assertContains(response, "Runda 2")
+
+
+class BallotApiTests(TestCase):
+    def setUp(self):
+        self.poll = Poll.objects.create()
+        self.question = SimpleQuestion.objects.create(
+            poll=self.poll, question_text="Tak czy nie?")
+        self.question.activate()
+        self.yes, self.no = self.question.choice_set.all()
+        self.codes = self.poll.get_codes()
+        self.url = reverse('polls:submit_ballots')
+
+    def submit(self, ballots):
+        return self.client.post(self.url, json.dumps({'ballots': ballots}),
+                                content_type='application/json')
+
+    def test_batch_is_idempotent(self):
+        ballots = [
+            {'id': 'a', 'question': self.question.id,
+             'code': self.codes[0].lower(), 'choices': [self.yes.id]},
+            {'id': 'a', 'question': self.question.id,
+             'code': self.codes[0], 'choices': [self.yes.id]},
+            {'id': 'b', 'question': self.question.id,
+             'code': self.codes[1], 'choices': [self.no.id]},
+            {'id': 'c', 'question': self.question.id,
+             'code': 'XXXX', 'choices': [self.no.id]},
+            {'id': 'd', 'question': self.question.id,
+             'code': self.codes[2], 'choices': [self.yes.id, self.no.id]},
+        ]
+        response = self.submit(ballots)
+        self.assertEqual([result['status']
+                          for result in response.json()['results']],
+                         ['accepted', 'duplicate', 'accepted', 'rejected',
+                          'rejected'])
+        response = self.submit(ballots)
+        self.assertEqual([result['status']
+                          for result in response.json()['results']],
+                         ['duplicate', 'duplicate', 'duplicate', 'rejected',
+                          'rejected'])
+
+        self.yes.refresh_from_db()
+        self.no.refresh_from_db()
+        self.question.refresh_from_db()
+        self.assertEqual((self.yes.votes, self.no.votes), (1, 1))
+        self.assertEqual(self.question.voters, 2)
+        self.assertEqual(Vote.objects.count(), 2)
+        self.assertEqual(AccessCode.objects.get(code=self.codes[0]).counter,
+                         1)
+
+    def test_resubmission_with_other_answer_is_reported(self):
+        question = OpenQuestion.objects.create(poll=self.poll)
+        question.activate()
+        s = self.client.session
+        s['poll' + str(self.poll.id)] = self.codes[0]
+        s.save()
+        response = self.client.get(reverse('polls:question_detail',
+                                           args=(question.id,)))
+        self.assertIn('no-store', response['Cache-Control'])
+        url = reverse('polls:vote', args=(question.id,))
+        ballot_id = response.context['ballot_id']
+        self.client.post(url, {'new_choice': 'Odp1',
+                               'ballot_id': ballot_id})
+        response = self.client.post(url, {'new_choice': 'Odp2',
+                                          'ballot_id': ballot_id})
+        self.assertContains(response, "Ten głos został już policzony")
+        self.assertEqual(list(question.choice_set.values_list(
+            'choice_text', 'votes')), [('Odp1', 1)])
+
+        response = self.client.post(url, {'new_choice': 'Odp2',
+                                          'ballot_id':
+                                          response.context['ballot_id']})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(dict(question.choice_set.values_list(
+            'choice_text', 'votes')), {'Odp1': 0, 'Odp2': 1})
+
+    def test_ballot_counted_if_cast_while_active(self):
+        before = timezone.now()
+        self.question.deactivate()
+        after = timezone.now() + timezone.timedelta(seconds=1)
+        ballots = [{'id': str(i), 'question': self.question.id,
+                    'code': code, 'choices': [self.yes.id], 'date': date}
+                   for i, (code, date) in enumerate(zip(self.codes, (
+                       before.isoformat(), after.isoformat(),
+                       '2024-05-06T10:15:00', None)))]
+        response = self.submit(ballots)
+        self.assertEqual([(result['status'], result.get('error'))
+                          for result in response.json()['results']],
+                         [('accepted', None),
+                          ('rejected', "Głosowanie nie jest aktywne"),
+                          ('rejected', "Niewłaściwy czas oddania głosu"),
+                          ('rejected', "Głosowanie nie jest aktywne")])
+        self.assertEqual(Vote.objects.get().code.code, self.codes[0])
+
+    def test_ballot_cast_in_future_counted_as_now(self):
+        date = timezone.now() + timezone.timedelta(days=1)
+        response = self.submit([{'id': 'f', 'question': self.question.id,
+                                 'code': self.codes[0],
+                                 'choices': [self.yes.id],
+                                 'date': date.isoformat()}])
+        self.assertEqual(response.json()['results'][0]['status'],
+                         'accepted')
+        self.question.deactivate()
+        response = self.submit([{'id': 'g', 'question': self.question.id,
+                                 'code': self.codes[1],
+                                 'choices': [self.yes.id],
+                                 'date': date.isoformat()}])
+        self.assertEqual(response.json()['results'][0]['status'],
+                         'rejected')
+
+    def test_ranked_ballot(self):
+        question = RankedQuestion.objects.create(poll=self.poll)
+        a, b = [question.choice_set.create(choice_text=text)
+                for text in ('Odp1', 'Odp2')]
+        question.activate()
+        response = self.submit([{'id': 'r', 'question': question.id,
+                                 'code': self.codes[0],
+                                 'choices': [b.id, a.id]}])
+        self.assertEqual(response.json()['results'][0]['status'],
+                         'accepted')
+        self.assertEqual(question.ballot_set.get().ranking,
+                         '{},{}'.format(b.id, a.id))
+
+    def test_bad_request(self):
+        response = self.client.post(self.url, 'ballots',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.submit([{'id': 'a' * 65}])
+        self.assertEqual(response.json()['results'][0]['status'],
+                         'rejected')
+        self.assertEqual(self.client.get(self.url).status_code, 405)
+
+    def test_form_resubmission_counted_once(self):
+        s = self.client.session
+        s['poll' + str(self.poll.id)] = self.codes[0]
+        s.save()
+        response = self.client.get(reverse('polls:question_detail',
+                                           args=(self.question.id,)))
+        ballot_id = response.context['ballot_id']
+        for _ in range(3):
+            self.client.post(reverse('polls:vote', args=(self.question.id,)),
+                             {'choice': self.yes.id, 'ballot_id': ballot_id})
+        self.yes.refresh_from_db()
+        self.assertEqual(self.yes.votes, 1)
+        self.assertEqual(AccessCode.objects.get(code=self.codes[0]).counter,
+                         1)
+
+
+class AuditViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        User.objects.create_superuser('admin', 'admin@example.com', 'pswd')
+        self.poll = Poll.objects.create()
+        question = SimpleQuestion.objects.create(
+            poll=self.poll, question_text="Tak czy nie?")
+        question.activate()
+        self.code = self.poll.accesscode_set.first()
+        start = timezone.now()
+        for i in range(60):
+            Vote.objects.create(question=question, code=self.code,
+                                choice=question.choice_set.first(),
+                                date=start + datetime.timedelta(seconds=i))
+
+    def test_superuser_only(self):
+        response = self.client.get(reverse('polls:poll_audit',
+                                           args=(self.poll.id,)))
+        self.assertEqual(response.status_code, 302)
+
+    def test_anomalies(self):
+        self.client.login(username='admin', password='pswd')
+        response = self.client.get(reverse('polls:poll_audit',
+                                           args=(self.poll.id,)),
+                                   {'code': self.code.formatted_code})
+        self.assertRedirects(response, reverse(
+            'polls:code_audit', args=(self.poll.id,
+                                      self.code.formatted_code)))
+        response = self.client.get(reverse('polls:poll_audit',
+                                           args=(self.poll.id,)))
+        self.assertContains(response, self.code.formatted_code)
+        response = self.client.get(reverse('polls:poll_anomalies',
+                                           args=(self.poll.id,)))
+        self.assertEqual(response.json()['anomalies'][0]['max_burst'], 60)
+
+    def test_code_history(self):
+        self.client.login(username='admin', password='pswd')
+        url = reverse('polls:code_audit_json',
+                      args=(self.poll.id, self.code.formatted_code.lower()))
+        data = self.client.get(url).json()
+        self.assertEqual(data['code'], self.code.formatted_code)
+        self.assertEqual(len(data['votes']), 50)
+        data = self.client.get(url, {'after': data['next']}).json()
+        self.assertEqual(len(data['votes']), 10)
+        self.assertIsNone(data['next'])
+
+        response = self.client.get(reverse('polls:code_audit',
+                                           args=(self.poll.id,
+                                                 self.code.code)))
+        self.assertContains(response, '<td>Tak</td>', count=50)
+        self.assertContains(response, 'Następna strona')
+        response = self.client.get(reverse('polls:code_audit',
+                                           args=(self.poll.id, 'XXXX')))
+        self.assertEqual(response.status_code, 404)
+
+
+class ProfilesViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        User.objects.create_superuser('admin', 'admin@example.com', 'pswd')
+        self.url = reverse('polls:profiles')
+
+    def test_superuser_only(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
+
+    @override_settings(POLLS_PROFILING=True)
+    def test_set_rate(self):
+        self.client.login(username='admin', password='pswd')
+        response = self.client.post(self.url, {'rate': '2'})
+        self.assertContains(response, "liczbą od 0 do 1")
+        self.client.post(self.url, {'rate': '0.25'})
+        response = self.client.get(self.url)
+        self.assertEqual(response.context['rate'], 0.25)
+        self.client.post(self.url, {'rate': '0'})
+        response = self.client.get(self.url)
+        self.assertEqual(response.context['rate'], 0)
+
+    def test_download(self):
+        self.client.login(username='admin', password='pswd')
+        with mock.patch('polls.views.read_profile', return_value='a;b 2\n'):
+            response = self.client.get(
+                reverse('polls:profile_download', args=('1.0-vote.txt',)),
+                {'download': ''})
+        self.assertEqual(response.content, b'a;b 2\n')
+        self.assertIn('attachment', response['Content-Disposition'])
+        response = self.client.get(
+            reverse('polls:profile_download', args=('missing.txt',)))
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(POLLS_READ_REPLICA='replica')
+class ReplicaRoutingTests(TestCase):
+    """
+    Primary and replica are separate test databases,
+    which lets the tests see where each view reads from.
+    """
+
+    multi_db = True
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        self.poll = Poll.objects.create(poll_name="Primary")
+        Poll.objects.using('replica').create(poll_name="Replica")
+
+    def test_listing_reads_replica(self):
+        response = self.client.get(reverse('polls:poll_index'))
+        self.assertContains(response, "Replica")
+        self.assertNotContains(response, "Primary")
+
+    def test_login_reads_primary(self):
+        response = self.client.post(reverse('polls:login',
+                                            args=(self.poll.id,)),
+                                    {'code': self.poll.get_codes()[0]})
+        self.assertEqual(response.status_code, 302)
+
+    def test_vote_sticks_to_primary(self):
+        question = SimpleQuestion.objects.create(poll=self.poll,
+                                                 question_text="Question")
+        question.activate()
+        s = self.client.session
+        s['poll' + str(self.poll.id)] = self.poll.get_codes()[0]
+        s.save()
+        response = self.client.post(
+            reverse('polls:vote', args=(question.id,)),
+            {'choice': question.choice_set.first().id}, follow=True)
+        self.assertIn(STICKY_COOKIE, self.client.cookies)
+        self.assertContains(response, "Question")
+        response = self.client.get(reverse('polls:poll_index'))
+        self.assertContains(response, "Primary")
+
+
+class AnalyticsViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        User.objects.create_superuser('admin', 'admin@example.com', 'pswd')
+        poll = Poll.objects.create()
+        self.question = SimpleQuestion.objects.create(
+            poll=poll, question_text="Tak czy nie?")
+        self.question.activate()
+        codes = poll.accesscode_set.all()[:3]
+        for i in range(5):
+            Vote.objects.create(question=self.question, code=codes[i % 3],
+                                choice=self.question.choice_set.first())
+
+    def test_superuser_only(self):
+        response = self.client.get(reverse('polls:question_analytics',
+                                           args=(self.question.id,)))
+        self.assertEqual(response.status_code, 302)
+
+    def test_analytics(self):
+        self.client.login(username='admin', password='pswd')
+        response = self.client.get(reverse('polls:question_analytics',
+                                           args=(self.question.id,)))
+        self.assertEqual(response.context['timing']['revotes'], 2)
+        self.assertContains(response, 'głosujących: 3')
+
+
+class ControlPanelTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        User.objects.create_superuser('admin', 'admin@example.com', 'pswd')
+        self.poll = Poll.objects.create(quorum_percent=1, quorum_minimum=2)
+        self.closed = SimpleQuestion.objects.create(poll=self.poll)
+        self.closed.activate()
+        self.closed.deactivate()
+        self.question = SimpleQuestion.objects.create(poll=self.poll)
+        self.available = MultipleChoiceQuestion.objects.create(
+            poll=self.poll, max_choices=2)
+        self.question.activate()
+        self.yes, self.no = self.question.choice_set.all()
+        self.url = reverse('polls:poll_panel', args=(self.poll.id,))
+
+    def vote(self, code, choice):
+        s = self.client.session
+        s['poll' + str(self.poll.id)] = code
+        s.save()
+        self.client.post(reverse('polls:vote', args=(self.question.id,)),
+                         {'choice': choice.id})
+
+    def test_superuser_only(self):
+        self.assertEqual(self.client.get(self.url).status_code, 302)
+
+    def test_panel(self):
+        codes = self.poll.get_codes()
+        self.vote(codes[0], self.no)
+        self.vote(codes[1], self.yes)
+        self.vote(codes[0], self.yes)
+        self.client.login(username='admin', password='pswd')
+        panel = self.client.get(self.url).json()
+        self.assertEqual(panel['questions'], [
+            {'id': self.closed.id, 'state': 'closed'},
+            {'id': self.question.id, 'state': 'active'},
+            {'id': self.available.id, 'state': 'available'}])
+        self.assertEqual(panel['active']['turnout'],
+                         {'used_codes': 2, 'all_codes': 82, 'required': 2,
+                          'reached': True})
+        self.assertEqual([(choice['choice_text'], choice['votes'])
+                          for choice in panel['active']['choices']],
+                         [('Tak', 2), ('Nie', 0)])
+
+    def test_cached_counters(self):
+        self.client.login(username='admin', password='pswd')
+        now = time.time()
+        with mock.patch('time.time', return_value=now):
+            self.client.get(self.url)
+            self.vote(self.poll.get_codes()[0], self.yes)
+            with CaptureQueriesContext(connection) as context:
+                panel = self.client.get(self.url).json()
+        # Only the session and the user are read
+        self.assertFalse([q['sql'] for q in context.captured_queries
+                          if 'polls_' in q['sql']])
+        self.assertEqual(panel['active']['turnout']['used_codes'], 0)
+
+        with mock.patch('time.time', return_value=now + 2):
+            panel = self.client.get(self.url).json()
+        self.assertEqual(panel['active']['turnout']['used_codes'], 1)
+
+    def test_state_changes_outdate_panel(self):
+        self.client.login(username='admin', password='pswd')
+        self.client.get(self.url)
+        self.question.deactivate()
+        self.available.activate()
+        panel = self.client.get(self.url).json()
+        self.assertEqual([row['state'] for row in panel['questions']],
+                         ['closed', 'closed', 'active'])
+        self.assertEqual(panel['active']['id'], self.available.id)
+        self.assertIsNone(panel['active']['choices'])
+        self.available.delete()
+        panel = self.client.get(self.url).json()
+        self.assertEqual(len(panel['questions']), 2)
+        self.assertIsNone(panel['active'])
+
+    def test_missing_poll(self):
+        self.client.login(username='admin', password='pswd')
+        response = self.client.get(reverse('polls:poll_panel',
+                                           args=(self.poll.id + 1,)))
+        self.assertEqual(response.status_code, 404)
+
+
+class AdminScaleTests(TestCase):
+    rows = 10000
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pswd')
+        cls.poll = Poll.objects.create()
+        cls.question = OpenQuestion.objects.create(poll=cls.poll,
+                                                   question_text='Kto?')
+        Question.objects.bulk_create(
+            Question(poll=cls.poll, question_text=str(i)) for i in range(50))
+        AccessCode.objects.bulk_create(
+            AccessCode(poll=cls.poll, code='C%07d' % i,
+                       formatted_code=format_code('C%07d' % i))
+            for i in range(cls.rows))
+        Choice.objects.bulk_create(
+            Choice(question=cls.question, choice_text=str(i),
+                   normalized_text=str(i))
+            for i in range(cls.rows))
+        choice = Choice.objects.filter(question=cls.question).first()
+        code = AccessCode.objects.filter(poll=cls.poll).first()
+        Vote.objects.bulk_create(
+            Vote(question=cls.question, choice=choice, code=code)
+            for i in range(cls.rows))
+
+    def setUp(self):
+        self.client.login(username='admin', password='pswd')
+
+    def assertQueryBudget(self, budget, url, data=None):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, data or {})
+        self.assertEqual(response.status_code, 200)
+        queries = [q['sql'] for q in context.captured_queries
+                   if 'SAVEPOINT' not in q['sql']]
+        self.assertLessEqual(len(queries), budget, '\n'.join(queries))
+        return queries
+
+    def test_vote_changelist(self):
+        queries = self.assertQueryBudget(
+            4, reverse('admin:polls_vote_changelist'))
+        self.assertFalse([sql for sql in queries if 'COUNT(' in sql])
+
+    def test_code_changelist(self):
+        self.assertQueryBudget(4, reverse('admin:polls_accesscode_changelist'))
+        self.assertQueryBudget(4, reverse('admin:polls_accesscode_changelist'),
+                               {'q': 'c000-0042'})
+
+    def test_choice_changelist(self):
+        self.assertQueryBudget(4, reverse('admin:polls_choice_changelist'))
+
+    def test_poll_change(self):
+        url = reverse('admin:polls_poll_change', args=(self.poll.id,))
+        self.assertQueryBudget(14, url)
+        response = self.client.get(url, {'question_set-page': 3})
+        formset = response.context['inline_admin_formsets'][1].formset
+        self.assertEqual((formset.page_number, formset.num_pages), (3, 3))
+        self.assertContains(response, '?question_set-page=2')
+        # Links of one inline keep pages of the others
+        other = response.context['inline_admin_formsets'][0].formset
+        response = self.client.get(url, {other.page_param: 2,
+                                         'question_set-page': 3})
+        self.assertContains(response, '?{}=2&amp;question_set-page=2'.format(
+            other.page_param))
+
+    def test_question_change(self):
+        self.assertQueryBudget(7, reverse('admin:polls_openquestion_change',
+                                          args=(self.question.id,)))
+
+    def test_read_only(self):
+        vote = Vote.objects.first()
+        url = reverse('admin:polls_vote_change', args=(vote.id,))
+        self.assertQueryBudget(7, url)
+        self.assertEqual(self.client.post(url, {}).status_code, 403)
+        self.assertEqual(self.client.get(
+            reverse('admin:polls_vote_add')).status_code, 403)
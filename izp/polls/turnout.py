@@ -0,0 +1,62 @@
+"""
+Turnout module.
+Number of codes which voted on a question is kept incrementally
+in Question.voters, so the state of the quorum can be read
+at any time without scanning votes.
+Quorum is the larger of a percentage of all poll codes
+and an absolute minimum number of voters, both set per poll.
+"""
+
+DEFAULT_QUORUM_PERCENT = 50
+
+
+class Turnout:
+    def __init__(self, used_codes, all_codes,
+                 quorum_percent=DEFAULT_QUORUM_PERCENT, quorum_minimum=0):
+        self.used_codes = used_codes
+        self.all_codes = all_codes
+        self.quorum_percent = quorum_percent
+        self.quorum_minimum = quorum_minimum
+
+    @property
+    def required(self):
+        """
+        Number of codes which must be used for the voting to be valid.
+        """
+        return max(-(-self.all_codes * self.quorum_percent // 100),
+                   self.quorum_minimum)
+
+    @property
+    def percentage(self):
+        if self.all_codes == 0:
+            return 0
+        return self.used_codes / self.all_codes * 100
+
+    def is_reached(self):
+        return self.all_codes > 0 and self.used_codes >= self.required
+
+    def as_dict(self):
+        return {'used_codes': self.used_codes,
+                'all_codes': self.all_codes,
+                'required': self.required,
+                'reached': self.is_reached()}
+
+
+def is_turnout_valid(used_codes, all_codes,
+                     quorum_percent=DEFAULT_QUORUM_PERCENT, quorum_minimum=0):
+    return Turnout(used_codes, all_codes,
+                   quorum_percent, quorum_minimum).is_reached()
+
+
+def poll_turnout(poll, used_codes, all_codes=None):
+    """
+    Returns turnout of given number of used codes under the poll quorum.
+    """
+    if all_codes is None:
+        all_codes = poll.accesscode_set.count()
+    return Turnout(used_codes, all_codes,
+                   poll.quorum_percent, poll.quorum_minimum)
+
+
+def question_turnout(question, all_codes=None):
+    return poll_turnout(question.poll, question.voters, all_codes)
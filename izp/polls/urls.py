@@ -5,6 +5,13 @@ from . import views
 app_name = 'polls'
 urlpatterns = [
     url(r'^$', views.poll_index, name='poll_index'),
+    url(r'^cache_stats/$', views.cache_stats, name='cache_stats'),
+    url(r'^api/ballots/$', views.submit_ballots, name='submit_ballots'),
+    url(r'^api/polls/(?P<poll_id>[0-9]+)/snapshot/$', views.poll_snapshot,
+        name='poll_snapshot'),
+    url(r'^profiles/$', views.profiles, name='profiles'),
+    url(r'^profiles/(?P<name>[\w.-]+)$', views.profile_download,
+        name='profile_download'),
     url(r'^(?P<poll_id>[0-9]+)/$', views.poll_detail, name='poll_detail'),
     url(r'^[0-9]+/(?P<question_id>[0-9]+)/$',
         views.question_detail, name='question_detail'),
@@ -14,12 +21,27 @@ urlpatterns = [
     url(r'^(?P<poll_id>[0-9]+)/codes/$', views.codes, name='codes'),
     url(r'^(?P<poll_id>[0-9]+)/codes_pdf/$',
         views.codes_pdf, name='codes_pdf'),
+    url(r'^(?P<poll_id>[0-9]+)/audit/$', views.poll_audit, name='poll_audit'),
+    url(r'^(?P<poll_id>[0-9]+)/audit/anomalies/$', views.poll_anomalies,
+        name='poll_anomalies'),
+    url(r'^(?P<poll_id>[0-9]+)/audit/(?P<code>[0-9A-Za-z-]+)/$',
+        views.code_audit, name='code_audit'),
+    url(r'^(?P<poll_id>[0-9]+)/audit/(?P<code>[0-9A-Za-z-]+)/api/$',
+        views.code_audit_json, name='code_audit_json'),
+    url(r'^(?P<poll_id>[0-9]+)/panel/$', views.poll_panel_state,
+        name='poll_panel'),
     url(r'^(?P<poll_id>[0-9]+)/logout/$', views.logout, name='logout'),
     url(r'^(?P<poll_id>[0-9]+)/login/$', views.login, name='login'),
     url(r'^[0-9]+/(?P<question_id>[0-9]+)/activate/$',
         views.activate_question, name='activate_question'),
     url(r'^[0-9]+/(?P<question_id>[0-9]+)/deactivate/$',
         views.deactivate_question, name='deactivate_question'),
+    url(r'^[0-9]+/(?P<question_id>[0-9]+)/analytics/$',
+        views.question_analytics, name='question_analytics'),
     url(r'^[0-9]+/(?P<question_id>[0-9]+)/comment/$',
         views.add_comment_to_question, name='add_comment_to_question'),
+    url(r'^[0-9]+/(?P<question_id>[0-9]+)/turnout/$',
+        views.question_turnout_state, name='question_turnout'),
+    url(r'^[0-9]+/(?P<question_id>[0-9]+)/comments/$',
+        views.question_comments, name='question_comments'),
 ]
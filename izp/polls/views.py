@@ -1,43 +1,107 @@
 from django.shortcuts import get_object_or_404, render
-from django.http import HttpResponseRedirect
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseRedirect, \
+    JsonResponse
 from django.urls import reverse
+from django.db.models import OuterRef, Subquery
 from django.contrib.auth.decorators import user_passes_test
-from easy_pdf.rendering import render_to_pdf_response
-from django.utils import timezone
+from django.views.decorators.cache import never_cache
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from django.utils import formats, timezone
+from django.utils.crypto import constant_time_compare
+import json
 import textwrap
-
-from .models import AccessCode, Choice, Question, Vote, OpenQuestion, Poll, \
-    Comment, CommentForm
-
-
+from uuid import uuid4
+
+from .models import AccessCode, Ballot, Choice, Question, Vote, Poll, \
+    CommentForm
+from .ballots import MAX_BALLOT_ID_LENGTH, approval_tally, ballot_groups, \
+    cast_ballot, cast_vote, check_selection, count_once, decode, \
+    instant_runoff, submit_batch
+from .codes import format_code, normalize_code
+from .analytics import question_timing
+from .audit import anomalies, code_history
+from .streaming import stream_table
+from .relay import snapshot
+from .pagination import InvalidCursor, KeysetPaginator
+from .comments import comments_page, comments_since, has_comments_since
+from .panel import poll_panel
+from .turnout import is_turnout_valid, poll_turnout, question_turnout
+from .routers import read_from_replica, route_poll, stick_to_primary
+from .profiling import get_rate, list_profiles, profiled, read_profile, \
+    set_rate
+from . import caching
+from .caching import get_or_compute, versioned_key
+
+POLLS_PER_PAGE = 20
+QUESTIONS_PER_PAGE = 20
+RESULTS_CACHE_SECONDS = 60
+DUPLICATE_BALLOT = "Ten głos został już policzony"
+AUDIT_CACHE_SECONDS = 30
+MAX_BALLOTS_PER_REQUEST = 500
+
+
+def get_page(request, queryset, field_name, per_page):
+    paginator = KeysetPaginator(queryset, field_name, per_page)
+    try:
+        return paginator.page(request.GET.get('after'))
+    except InvalidCursor:
+        raise Http404("Niewłaściwa strona")
+
+
+def questions_page(request, poll):
+    return get_page(request, Question.objects.filter(poll__exact=poll),
+                    'activation_time', QUESTIONS_PER_PAGE)
+
+
+@read_from_replica
 def poll_index(request):
+    page = get_page(request, Poll.objects.all(), 'date', POLLS_PER_PAGE)
     return render(request, 'polls/poll_index.html',
-                  {'polls_list': Poll.objects.all().order_by('-date')})
+                  {'polls_list': page.object_list, 'page': page})
 
 
+@read_from_replica
 def poll_detail(request, poll_id):
     poll = get_object_or_404(Poll, pk=poll_id)
     is_session = 'poll' + str(poll_id) in request.session
+    page = questions_page(request, poll)
+
+    if request.user.is_superuser:
+        all_codes = poll.accesscode_set.count()
+        for question in page.object_list:
+            if question.is_active():
+                question.turnout = poll_turnout(poll, question.voters,
+                                                all_codes)
 
     return render(request, 'polls/poll_detail.html',
                   {'poll': poll,
-                   'questions_list': Question.objects.filter(
-                       poll__exact=poll).order_by('-activation_time'),
+                   'questions_list': page.object_list,
+                   'page': page,
                    'is_session': is_session})
 
 
+# Every rendering gets a new ballot id, a page shown again from the cache
+# after going back would send the id of an already counted vote
+@never_cache
 def question_detail(request, question_id):
-    question = get_object_or_404(Question, pk=question_id)
+    question = get_object_or_404(Question.objects.with_state(),
+                                 pk=question_id)
 
-    is_open = OpenQuestion.objects.filter(pk=question.pk).exists()
-    is_session = 'poll' + str(question.poll.id) in request.session
-    comments = Comment.objects.filter(
-        question__exact=question).order_by('-date')
+    is_open = question.is_open
+    is_session = 'poll' + str(question.poll_id) in request.session
+    try:
+        page = comments_page(question, request.GET.get('after'))
+    except InvalidCursor:
+        raise Http404("Niewłaściwa strona")
 
     context = {'question': question,
                'is_open': is_open,
                'is_session': is_session,
-               'comments': comments}
+               'ballot_id': uuid4().hex,
+               'comments': page.object_list,
+               'page': page}
 
     if question.activation_time is None \
             or question.activation_time > timezone.now():
@@ -56,63 +120,235 @@ def question_detail(request, question_id):
     return render(request, 'polls/question_detail.html', context)
 
 
-def format_codes_list(codes_list):
-    codes = []
-    for code in codes_list:
-        codes.append(format_code(code))
-    return codes
+def question_comments(request, question_id):
+    try:
+        since = int(request.GET.get('since', 0))
+    except ValueError:
+        since = 0
+
+    comments = []
+    if has_comments_since(question_id, since):
+        question = get_object_or_404(Question, pk=question_id)
+        comments = comments_since(question, since)
 
+    return JsonResponse({'comments': [
+        {'id': comment.id,
+         'text': comment.text,
+         'date': formats.date_format(timezone.localtime(comment.date),
+                                     'DATETIME_FORMAT')}
+        for comment in comments]})
 
-def format_code(code):
-    return '-'.join([code[i:i + 4] for i in range(0, len(code), 4)])
+
+def format_codes_list(codes_list):
+    return [format_code(code) for code in codes_list]
 
 
+@read_from_replica
+@profiled
+@route_poll
 def question_result(request, question_id):
-    question = get_object_or_404(Question, pk=question_id)
+    question = get_object_or_404(Question.objects.with_state(),
+                                 pk=question_id)
     if question.is_active():
         return render(request, 'polls/question_result.html',
                       {'error': 'Głosowanie jeszcze się nie zakończyło'})
 
-    choices = Choice.objects.filter(
-        question__exact=question).order_by('-votes')
+    key = versioned_key('result', ('poll', question.poll_id),
+                        ('question', question.pk))
+    context = get_or_compute(key, lambda: question_result_context(question),
+                             RESULTS_CACHE_SECONDS)
+    return stream_table(request, 'polls/question_result.html', context,
+                        'polls/result_codes_rows.html', 'codes',
+                        context['codes'])
+
+
+def question_result_context(question):
+    if question.is_multiple or question.is_ranked:
+        return ballot_result_context(question)
+
+    choices = list(Choice.objects.filter(
+        question__exact=question).order_by('-votes'))
+    texts = {choice.pk: choice.choice_text for choice in choices}
+    last_votes = Vote.objects.filter(
+        question__exact=question, code=OuterRef('pk')).order_by('-pk')
+    codes = []
+    for code in AccessCode.objects.filter(
+            poll_id=question.poll_id).annotate(
+            last_choice=Subquery(last_votes.values('choice_id')[:1])):
+        codes.append({'code': code.formatted_code,
+                      'num_of_votes': code.counter,
+                      'last_choice': texts.get(code.last_choice, '-')})
+    turnout = question_turnout(question, len(codes))
+    return {'question': question, 'choices': choices, 'codes': codes,
+            'turnout': turnout,
+            'successful': turnout.is_reached()}
+
+
+def ballot_result_context(question):
+    choices = list(question.choice_set.all())
+    texts = {choice.pk: choice.choice_text for choice in choices}
+    groups = ballot_groups(question)
+
+    rounds = []
+    if question.is_ranked:
+        rounds, winner = instant_runoff(groups, texts)
+        tally = rounds[-1]
+        rounds = [[texts[choice.pk]]
+                  + [r.get(choice.pk, '-') for r in rounds]
+                  for choice in choices]
+    else:
+        tally = approval_tally(groups, texts)
+    for choice in choices:
+        choice.votes = tally.get(choice.pk, 0)
+    choices.sort(key=lambda choice: -choice.votes)
+
+    ballots = Ballot.objects.filter(question=question, code=OuterRef('pk'))
     codes = []
-    for code in question.poll.accesscode_set.all():
-        last_choice = Vote.objects.filter(
-            question__exact=question, code__exact=code).last()
-        if last_choice:
-            last_choice = last_choice.choice.choice_text
-        else:
-            last_choice = '-'
-        codes.append({'code': format_code(code.code),
+    for code in AccessCode.objects.filter(
+            poll_id=question.poll_id).annotate(
+            ranking=Subquery(ballots.values('ranking')[:1])):
+        last_choice = '-'
+        if code.ranking:
+            last_choice = ', '.join(texts[choice_id]
+                                    for choice_id in decode(code.ranking)
+                                    if choice_id in texts)
+        codes.append({'code': code.formatted_code,
                       'num_of_votes': code.counter,
                       'last_choice': last_choice})
-    return render(request, 'polls/question_result.html',
-                  {'question': question, 'choices': choices, 'codes': codes,
-                   'successful': is_vote_successful(codes)})
+    turnout = question_turnout(question, len(codes))
+    return {'question': question, 'choices': choices, 'codes': codes,
+            'rounds': rounds,
+            'rounds_numbers': range(1, len(rounds[0])) if rounds else [],
+            'turnout': turnout,
+            'successful': turnout.is_reached()}
+
+
+@user_passes_test(lambda u: u.is_superuser)
+def cache_stats(request):
+    return JsonResponse(caching.stats())
+
+
+@user_passes_test(lambda u: u.is_superuser)
+def profiles(request):
+    context = {'enabled': getattr(settings, 'POLLS_PROFILING', False)}
+    if request.method == 'POST':
+        try:
+            rate = float(request.POST.get('rate', ''))
+        except ValueError:
+            rate = -1
+        if 0 <= rate <= 1:
+            set_rate(rate)
+            return HttpResponseRedirect(reverse('polls:profiles'))
+        context['error'] = "Częstość profilowania musi być liczbą od 0 do 1"
+
+    context['rate'] = get_rate()
+    context['profiles'] = list_profiles()
+    return render(request, 'polls/profiles.html', context)
+
+
+@user_passes_test(lambda u: u.is_superuser)
+def profile_download(request, name):
+    content = read_profile(name)
+    if content is None:
+        raise Http404
+    response = HttpResponse(content, content_type='text/plain; charset=utf-8')
+    if 'download' in request.GET:
+        response['Content-Disposition'] = 'attachment; filename=' + name
+    return response
+
+
+def audited_code(poll_id, code):
+    return get_object_or_404(AccessCode, poll_id=poll_id,
+                             code=normalize_code(code))
+
+
+def audit_page(request, code):
+    try:
+        return code_history(code, request.GET.get('after'))
+    except InvalidCursor:
+        raise Http404("Niewłaściwa strona")
+
+
+@user_passes_test(lambda u: u.is_superuser)
+@route_poll
+def poll_audit(request, poll_id):
+    poll = get_object_or_404(Poll, pk=poll_id)
+    code = request.GET.get('code')
+    if code:
+        return HttpResponseRedirect(reverse('polls:code_audit',
+                                            args=(poll.id, code)))
+    report = get_or_compute(versioned_key('anomalies', ('poll', poll.id)),
+                            lambda: anomalies(poll), AUDIT_CACHE_SECONDS)
+    return render(request, 'polls/audit.html',
+                  {'poll': poll, 'anomalies': report})
+
+
+@user_passes_test(lambda u: u.is_superuser)
+@route_poll
+def poll_anomalies(request, poll_id):
+    poll = get_object_or_404(Poll, pk=poll_id)
+    return JsonResponse({'anomalies': anomalies(poll)})
+
+
+@user_passes_test(lambda u: u.is_superuser)
+@route_poll
+def code_audit(request, poll_id, code):
+    code = audited_code(poll_id, code)
+    return render(request, 'polls/audit.html',
+                  {'poll': code.poll, 'code': code,
+                   'votes': audit_page(request, code)})
+
+
+@user_passes_test(lambda u: u.is_superuser)
+@route_poll
+def code_audit_json(request, poll_id, code):
+    code = audited_code(poll_id, code)
+    page = audit_page(request, code)
+    return JsonResponse({
+        'code': code.formatted_code,
+        'votes': [{'id': vote.pk, 'date': vote.date.isoformat(),
+                   'question': vote.question.question_text,
+                   'choice': vote.choice.choice_text}
+                  for vote in page],
+        'next': page.next_cursor})
+
+
+@user_passes_test(lambda u: u.is_superuser)
+@route_poll
+def question_analytics(request, question_id):
+    question = get_object_or_404(Question.objects.select_related('poll'),
+                                 pk=question_id)
+    timing = get_or_compute(
+        versioned_key('timing', ('question', question.id)),
+        lambda: question_timing(question), AUDIT_CACHE_SECONDS)
+    return render(request, 'polls/analytics.html',
+                  {'question': question, 'timing': timing})
+
+
+@user_passes_test(lambda u: u.is_superuser)
+def poll_panel_state(request, poll_id):
+    state = poll_panel(int(poll_id))
+    if state is None:
+        raise Http404("Ankieta nie istnieje")
+    return JsonResponse(state)
+
+
+@user_passes_test(lambda u: u.is_superuser)
+def question_turnout_state(request, question_id):
+    question = get_object_or_404(Question.objects.select_related('poll'),
+                                 pk=question_id)
+    state = question_turnout(question).as_dict()
+    state['active'] = question.is_active()
+    return JsonResponse(state)
 
 
 def is_vote_successful(codes):
-    if len(codes) == 0:
-        return False
-    return (len(list(filter(
-            lambda code: code.get('last_choice') != '-', codes)))
-            / len(codes) * 100 >= 50)
+    used_codes = [code for code in codes if code.get('last_choice') != '-']
+    return is_turnout_valid(len(used_codes), len(codes))
 
 
 def reformat_code(code):
-    if len(code) <= 4 or "-" not in code:
-        return code
-
-    newCode = ""
-    for l, c in enumerate(code):
-        if (l + 1) % 5 == 0:
-            if l + 1 == len(code) or code[l] != "-":
-                return ''
-        elif code[l] == "-":
-            return ''
-        else:
-            newCode += c
-    return newCode
+    return normalize_code(code)
 
 
 def logout(request, poll_id):
@@ -130,10 +366,11 @@ def login(request, poll_id):
     code = reformat_code(request.POST['code'])
 
     if code == '' or not poll.is_code_correct(code):
+        page = questions_page(request, poll)
         return render(request, 'polls/poll_detail.html',
                       {'poll': poll,
-                       'questions_list': Question.objects.filter(
-                           poll__exact=poll).order_by('-activation_time'),
+                       'questions_list': page.object_list,
+                       'page': page,
                        'is_session': False,
                        'error': "Niewłaściwy kod uwierzytelniający"
                        })
@@ -145,27 +382,34 @@ def login(request, poll_id):
                                             args=(poll_id,)))
 
 
+@profiled
+@route_poll
 def vote(request, question_id):
-    question = get_object_or_404(Question, pk=question_id)
-    is_open = OpenQuestion.objects.filter(pk=question.pk).exists()
-    is_session = 'poll' + str(question.poll.id) in request.session
+    question = get_object_or_404(Question.objects.with_state(),
+                                 pk=question_id)
+    is_open = question.is_open
+    is_session = 'poll' + str(question.poll_id) in request.session
 
     context = {'question': question,
                'is_open': is_open,
-               'is_session': is_session}
+               'is_session': is_session,
+               'ballot_id': uuid4().hex}
 
     if not question.is_active():
         context['error'] = "Głosowanie nie jest aktywne"
         return render(request, 'polls/question_detail.html', context)
 
     if is_session:
-        code = request.session['poll' + str(question.poll.id)]
+        code = request.session['poll' + str(question.poll_id)]
     else:
         context['error'] = "Użytkownik niezalogowany"
         return render(request, 'polls/question_detail.html', context)
 
+    if question.is_multiple or question.is_ranked:
+        return vote_ballot(request, question, code, context)
+
     choice = request.POST.get('choice', None)
-    new_choice = request.POST.get('new_choice', '')
+    new_choice = request.POST.get('new_choice', '').strip()
     if choice and new_choice != '':
         context['error'] = "Nie można głosować na istniejącą odpowiedź i \
                           jednocześnie proponować nową",
@@ -176,50 +420,146 @@ def vote(request, question_id):
         return render(request, 'polls/question_detail.html', context)
 
     if choice:
-        if question.choice_set.filter(pk=choice).exists():
-            choice = question.choice_set.get(pk=choice)
-        else:
+        choice = question.choice_set.filter(pk=choice).first()
+        if not choice:
             context['error'] = "Odpowiedź nie istnieje"
             return render(request, 'polls/question_detail.html', context)
 
-    if not choice and is_open:
-        if Choice.objects.filter(question__exact=question,
-                                 choice_text__exact=new_choice).exists():
-            choice = Choice.objects.filter(
-                question__exact=question, choice_text__exact=new_choice).last()
-        else:
-            choice = Choice.objects.create(
-                question=question, choice_text=new_choice)
-
-    code = AccessCode.objects.get(poll=question.poll, code=code)
-    prev_vote = Vote.objects.filter(
-        question__exact=question, code__exact=code).last()
-    if prev_vote:
-        prev_vote.choice.votes -= 1
-        prev_vote.choice.save()
-
-    choice = Choice.objects.get(pk=choice.id)
-    choice.votes += 1
-    choice.save()
-    code.counter += 1
-    code.save()
-    Vote.objects.create(question=question, choice=choice, code=code)
-    return HttpResponseRedirect(reverse('polls:poll_detail',
-                                        args=(question.poll.id,)))
+    if not choice and getattr(settings, 'POLLS_UPSTREAM_URL', None):
+        context['error'] = "Nowe odpowiedzi można proponować tylko " \
+                           "na serwerze głównym"
+        return render(request, 'polls/question_detail.html', context)
+
+    code = AccessCode.objects.get(poll_id=question.poll_id, code=code)
+
+    def cast():
+        chosen = choice
+        if not chosen and is_open:
+            chosen, _ = Choice.objects.get_or_create_normalized(question,
+                                                                new_choice)
+        cast_vote(question, code, chosen)
+
+    return counted_response(request, question, code, cast, context)
+
+
+def counted_response(request, question, code, cast, context):
+    """
+    Counts the vote unless its ballot id was already counted,
+    which is told to the voter instead of redirecting.
+    """
+    if not count_once(request.POST.get('ballot_id',
+                                       '')[:MAX_BALLOT_ID_LENGTH],
+                      question, code, cast):
+        context['error'] = DUPLICATE_BALLOT
+        return render(request, 'polls/question_detail.html', context)
+    return stick_to_primary(HttpResponseRedirect(
+        reverse('polls:poll_detail', args=(question.poll_id,))))
+
+
+def ballot_choices(request, question):
+    """
+    Returns ids of choices selected in the ballot form,
+    in order of preference for RankedQuestion,
+    or error message if the ballot is not valid.
+    """
+    choice_ids = set(question.choice_set.values_list('pk', flat=True))
+
+    if question.is_ranked:
+        ranks = {}
+        for choice_id in choice_ids:
+            rank = request.POST.get('rank_' + str(choice_id), '').strip()
+            if rank:
+                try:
+                    ranks[choice_id] = int(rank)
+                except ValueError:
+                    return None, "Zły format kolejności"
+        if len(set(ranks.values())) != len(ranks) \
+                or any(rank < 1 for rank in ranks.values()):
+            return None, "Kolejność odpowiedzi musi być różnymi liczbami"
+        selected = sorted(ranks, key=ranks.get)
+    else:
+        try:
+            selected = [int(pk) for pk in request.POST.getlist('choices')]
+        except ValueError:
+            return None, "Odpowiedź nie istnieje"
+
+    max_choices = None
+    if question.is_multiple:
+        max_choices = question.multiplechoicequestion.max_choices
+    error = check_selection(question, selected, choice_ids, max_choices)
+    if error:
+        return None, error
+    return selected, None
+
+
+def vote_ballot(request, question, code, context):
+    selected, error = ballot_choices(request, question)
+    if error:
+        context['error'] = error
+        return render(request, 'polls/question_detail.html', context)
+
+    code = AccessCode.objects.get(poll_id=question.poll_id, code=code)
+    return counted_response(request, question, code,
+                            lambda: cast_ballot(question, code, selected),
+                            context)
+
+
+@csrf_exempt
+@require_POST
+def submit_ballots(request):
+    """
+    Counts batch of ballots sent as JSON by a kiosk or relay.
+    Ballots carry ids generated by the client, so a batch can be
+    safely resent after a network failure.
+    """
+    try:
+        entries = json.loads(request.body.decode('utf-8'))['ballots']
+        if not isinstance(entries, list) \
+                or not all(isinstance(entry, dict) for entry in entries):
+            raise ValueError
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': "Niewłaściwy format żądania"},
+                            status=400)
+    if len(entries) > MAX_BALLOTS_PER_REQUEST:
+        return JsonResponse({'error': "Za dużo głosów w jednym żądaniu"},
+                            status=400)
+
+    return JsonResponse({'results': submit_batch(entries)})
+
+
+def poll_snapshot(request, poll_id):
+    """
+    Returns poll data with access codes for relays
+    holding the POLLS_RELAY_TOKEN.
+    """
+    token = getattr(settings, 'POLLS_RELAY_TOKEN', None)
+    if not token or not constant_time_compare(
+            request.META.get('HTTP_AUTHORIZATION', ''), 'Token ' + token):
+        return JsonResponse({'error': "Brak dostępu"}, status=403)
+    poll = get_object_or_404(Poll, pk=poll_id)
+    return JsonResponse(snapshot(poll))
 
 
 @user_passes_test(lambda u: u.is_superuser)
+@read_from_replica
 def codes(request, poll_id):
     poll = get_object_or_404(Poll, pk=poll_id)
-    return render(request, 'polls/poll_codes_list.html',
-                  {"codes_list": format_codes_list(poll.get_codes())})
+    codes = poll.accesscode_set.values_list('formatted_code', flat=True)
+    return stream_table(request, 'polls/poll_codes_list.html', {},
+                        'polls/codes_rows.html', 'codes_list',
+                        codes.using(codes.db).iterator())
 
 
 @user_passes_test(lambda u: u.is_superuser)
+@read_from_replica
+@profiled
 def codes_pdf(request, poll_id):
+    # xhtml2pdf and reportlab take long to import, load them on first use
+    from easy_pdf.rendering import render_to_pdf_response
+
     poll = get_object_or_404(Poll, pk=poll_id)
     options = {
-        "codes_list": format_codes_list(poll.get_codes()),
+        "codes_list": poll.get_formatted_codes(),
         'quiet': True
     }
 
@@ -229,17 +569,17 @@ def codes_pdf(request, poll_id):
 
 @user_passes_test(lambda u: u.is_superuser)
 def activate_question(request, question_id):
-    question = get_object_or_404(Question, pk=question_id)
+    question = get_object_or_404(Question.objects.select_related('poll'),
+                                 pk=question_id)
     time = request.POST.get("time")
 
-    active_questions = [question for question in Question.objects.all()
-                        if question.is_active()]
-    is_session = 'poll' + str(question.poll.id) in request.session
+    active_questions = Question.objects.active().exists()
+    is_session = 'poll' + str(question.poll_id) in request.session
+    page = questions_page(request, question.poll)
 
     context = {'poll': question.poll,
-               'questions_list': Question.objects.filter(
-                   poll__exact=question.poll).order_by(
-                   '-activation_time'),
+               'questions_list': page.object_list,
+               'page': page,
                'is_session': is_session
                }
 
@@ -258,7 +598,7 @@ def activate_question(request, question_id):
         question.activate()
 
     return HttpResponseRedirect(reverse('polls:poll_detail',
-                                        args=(question.poll.id,)))
+                                        args=(question.poll_id,)))
 
 
 @user_passes_test(lambda u: u.is_superuser)
@@ -267,9 +607,10 @@ def deactivate_question(request, question_id):
     question.deactivate()
 
     return HttpResponseRedirect(reverse('polls:poll_detail',
-                                        args=(question.poll.id,)))
+                                        args=(question.poll_id,)))
 
 
+@route_poll
 def add_comment_to_question(request, question_id):
     question = get_object_or_404(Question, pk=question_id)
 